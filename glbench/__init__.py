@@ -0,0 +1,29 @@
+#    Copyright 2015 Menno Hölscher
+#
+#    This file is part of gledger.
+
+#    gledger is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Lesser General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+
+#    gledger is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Lesser General Public License for more details.
+
+#    You should have received a copy of the GNU Lesser General Public License
+#    along with gledger.  If not, see <http://www.gnu.org/licenses/>.
+
+
+""" The benchmarks measure the hot paths of GLedger on a synthetic ledger.
+
+The ledger is generated from a seed, so every run works on the same
+accounts and journals, and the results of two runs can be compared. The
+benchmarks run on their own SQLite database, which is created for the
+run; they never touch the database in the configuration. Run them with::
+
+    python -m glbench --accounts 500 --journals-per-month 200
+
+See glbench.benchmark for the options and the baselines.
+"""
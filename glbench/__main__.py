@@ -0,0 +1,24 @@
+#    Copyright 2015 Menno Hölscher
+#
+#    This file is part of gledger.
+
+#    gledger is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Lesser General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+
+#    gledger is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Lesser General Public License for more details.
+
+#    You should have received a copy of the GNU Lesser General Public License
+#    along with gledger.  If not, see <http://www.gnu.org/licenses/>.
+
+
+""" Run the benchmarks: python -m glbench --help """
+
+import sys
+from .benchmark import main
+
+sys.exit(main())
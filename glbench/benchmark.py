@@ -0,0 +1,378 @@
+#    Copyright 2015 Menno Hölscher
+#
+#    This file is part of gledger.
+
+#    gledger is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Lesser General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+
+#    gledger is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Lesser General Public License for more details.
+
+#    You should have received a copy of the GNU Lesser General Public License
+#    along with gledger.  If not, see <http://www.gnu.org/licenses/>.
+
+
+""" This module runs the benchmarks on a synthetic ledger (see
+glbench.generator) and compares the results with a baseline.
+
+A benchmark times an operation a number of times. For every benchmark
+the throughput (operations per second), the latency percentiles and the
+number of SQL statements per operation are reported. The number of
+statements does not depend on the machine, so a change in it is a
+regression on any machine; latencies are compared within a tolerance.
+
+The benchmarks run in the order the ledger is built:
+
+    :create_from_dict: add a journal and its postings
+    :post_journal: post a journal to the balances
+    :balance_ultimo: the balance of an account with its subtree, in an
+        open month
+    :account_list: a page of the account list
+    :postings_for_account: the first and next (by cursor) page of postings
+        of an account
+    :route_*: a GET of the pages of the web interface, with the view
+        caches cleared first
+    :close_postmonth: close a postmonth, writing its ultimo balances
+    :balance_ultimo_closed: the balance of an account in a closed month
+    :year_end: create all year end journals
+
+The database is an SQLite file made for the run; the configured database
+is never used. Results and baselines are JSON::
+
+    python -m glbench --save-baseline baseline.json
+    python -m glbench --baseline baseline.json --tolerance 0.25
+"""
+
+import argparse
+import json
+import math
+import os
+import random
+import tempfile
+from collections import OrderedDict
+from datetime import datetime
+from time import perf_counter
+from sqlalchemy.orm import subqueryload
+from gledger import app, db
+from gledger.instrumentation import record_queries
+from glmodels.glaccount import AccountList, Accounts, Postmonths
+from glmodels.glcache import view_results
+from glmodels.glposting import Journals, Postings
+from glmodels.glyearend import year_end_journals
+from .generator import LedgerGenerator, LedgerSpec
+
+
+class Measurement():
+    """ The timings and statement counts of the runs of a benchmark """
+
+    def __init__(self, name):
+
+        self.name = name
+        self.durations = []
+        self.queries = []
+
+    def summary(self):
+        """ Return the results of the benchmark as a dictionary """
+
+        total = sum(self.durations)
+        runs = len(self.durations)
+        return {'runs': runs,
+                'total_seconds': round(total, 6),
+                'throughput': round(runs / total, 2) if total else None,
+                'p50_ms': percentile(self.durations, 50),
+                'p95_ms': percentile(self.durations, 95),
+                'p99_ms': percentile(self.durations, 99),
+                'max_ms': percentile(self.durations, 100),
+                'queries_per_run': round(sum(self.queries) / runs, 2)
+                                   if runs else None}
+
+
+def percentile(durations, pct):
+    """ Return the pct percentile (nearest rank) of durations in
+    milliseconds, None if there are none.
+    """
+
+    if not durations:
+        return None
+    ordered = sorted(durations)
+    rank = max(int(math.ceil(pct / 100 * len(ordered))), 1)
+    return round(ordered[rank - 1] * 1000, 3)
+
+
+class BenchmarkSuite():
+    """ Builds the ledger of spec and runs the benchmarks on it.
+
+    The read benchmarks are run samples times, on accounts and pages
+    chosen with a generator seeded from the spec.
+    """
+
+    def __init__(self, spec, samples=200):
+
+        self.spec = spec
+        self.samples = samples
+        self.generator = LedgerGenerator(spec)
+        self.rng = random.Random('{0}-samples'.format(spec.seed))
+        self.measurements = OrderedDict()
+
+    def run(self):
+        """ Create the tables, run all benchmarks and return the results,
+        a dictionary of summaries by benchmark name.
+        """
+
+        db.drop_all()
+        db.create_all()
+        self.generator.populate()
+        db.session.commit()
+        self.bench_create_from_dict()
+        self.bench_post_journal()
+        self.bench_balance_ultimo('balance_ultimo')
+        self.bench_account_list()
+        self.bench_postings_for_account()
+        self.bench_routes()
+        self.bench_close_postmonth()
+        self.bench_balance_ultimo('balance_ultimo_closed')
+        self.bench_year_end()
+        return OrderedDict((name, measurement.summary())
+                           for name, measurement in self.measurements.items())
+
+    def measure(self, name, operation, arguments):
+        """ Run operation once for every entry in arguments, timing every
+        call and counting its statements. Measuring the same name again
+        adds to the runs of the benchmark.
+        """
+
+        measurement = self.measurements.setdefault(name, Measurement(name))
+        for argument in arguments:
+            with record_queries(slowest=0) as stats:
+                start = perf_counter()
+                operation(argument)
+                measurement.durations.append(perf_counter() - start)
+            measurement.queries.append(stats.count)
+
+    def sample(self, population):
+        """ Return samples entries chosen from population """
+
+        return [self.rng.choice(population) for _ in range(self.samples)]
+
+    def bench_create_from_dict(self):
+        """ Add the journals, committing every postmonth """
+
+        for postmonth in self.generator.postmonths():
+            self.measure('create_from_dict', Journals.create_from_dict,
+                         self.generator.journals(postmonth))
+            db.session.commit()
+
+    def bench_post_journal(self):
+        """ Post the journals one by one, committing every postmonth """
+
+        def post(journal):
+            journal.post_journal()
+            db.session.flush()
+
+        for postmonth in self.generator.postmonths():
+            journals = db.session.query(Journals).\
+                filter(Journals.extkey.like('bench-{0}-%'.format(postmonth))).\
+                options(subqueryload(Journals.journalpostings)).\
+                order_by(Journals.id).all()
+            self.measure('post_journal', post, journals)
+            db.session.commit()
+
+    def bench_balance_ultimo(self, name):
+        """ Get the balance of sampled accounts in sampled postmonths """
+
+        accounts = db.session.query(Accounts).all()
+        postmonths = self.generator.postmonths()
+        arguments = zip(self.sample(accounts), self.sample(postmonths))
+        self.measure(name, lambda argument: argument[0].balance_ultimo(
+            argument[1]), arguments)
+
+    def bench_account_list(self):
+        """ Get sampled pages of the account list """
+
+        pages = range(1, self.spec.accounts // 10 + 1)
+        self.measure('account_list', lambda page: AccountList(page=page),
+                     self.sample(pages))
+
+    def bench_postings_for_account(self):
+        """ Get the first page of postings of sampled accounts, and the
+        page after it by cursor
+        """
+
+        def pages(account):
+            first = Postings.postings_for_account(account)
+            if first.next_cursor:
+                Postings.postings_for_account(account,
+                                              cursor=first.next_cursor)
+
+        accounts = db.session.query(Accounts).\
+            filter(Accounts.name.in_(self.generator.leaves)).all()
+        self.measure('postings_for_account', pages, self.sample(accounts))
+
+    def bench_routes(self):
+        """ Get the pages of the web interface, with cold view caches """
+
+        client = app.test_client()
+        names = self.generator.leaves
+        roots = [name for (name, _, parent) in self.generator.chart
+                 if parent is None]
+        extkeys = [journal['journal']['extkey'] for journal in
+                   self.generator.journals(self.generator.postmonths()[0])]
+        routes = OrderedDict([
+            ('route_accountlist', ['/accountlist']),
+            ('route_balance', ['/balance/' + name
+                               for name in self.sample(roots + names)]),
+            ('route_posts', ['/posts/' + name for name in self.sample(names)]),
+            ('route_journal', ['/journal/' + extkey
+                               for extkey in self.sample(extkeys)]),
+            ('route_trialbalance', ['/trialbalance'])])
+
+        def get(url):
+            view_results.clear()
+            response = client.get(url)
+            if response.status_code != 200:
+                raise RuntimeError('GET {0} returned {1}'.
+                                   format(url, response.status_code))
+
+        for name, urls in routes.items():
+            if len(urls) == 1:
+                urls = urls * max(self.samples // 10, 1)
+            self.measure(name, get, urls)
+
+    def bench_close_postmonth(self):
+        """ Close the postmonths, committing each """
+
+        def close(postmonth):
+            db.session.query(Postmonths).get(postmonth).close()
+            db.session.commit()
+
+        self.measure('close_postmonth', close, self.generator.postmonths())
+
+    def bench_year_end(self):
+        """ Create the year end journals for the year after the first
+        postmonth.
+        """
+
+        year = self.spec.first_month // 100 + 1
+        start_next_year = datetime(year, 1, 1)
+        num_accounts = app.config.get('YEAR_END_ACCOUNTS_PER_JOURNAL', 250)
+        self.measure('year_end', lambda start: list(year_end_journals(
+            start_next_year=start, num_accounts=num_accounts)),
+            [start_next_year] * 3)
+
+
+def save_results(spec, results, path):
+    """ Write the spec and the results to a JSON file at path """
+
+    with open(path, 'w') as results_file:
+        json.dump({'spec': spec.as_dict(), 'results': results}, results_file,
+                  indent=2)
+
+
+def load_results(path):
+    """ Read the spec and the results from a JSON file at path """
+
+    with open(path) as results_file:
+        saved = json.load(results_file)
+    return LedgerSpec(**saved['spec']), saved['results']
+
+
+def compare(results, baseline, tolerance=0.2):
+    """ Compare results with baseline, returning a list of regressions.
+
+    A benchmark regresses when it runs more statements per operation
+    than in the baseline, or when its median latency is more than
+    tolerance (a fraction) above that of the baseline.
+    """
+
+    regressions = []
+    for name, result in results.items():
+        base = baseline.get(name)
+        if base is None:
+            continue
+        if result['queries_per_run'] > base['queries_per_run']:
+            regressions.append('{0}: {1} statements per run, was {2}'.format(
+                name, result['queries_per_run'], base['queries_per_run']))
+        if result['p50_ms'] > base['p50_ms'] * (1 + tolerance):
+            regressions.append('{0}: median {1} ms, was {2} ms'.format(
+                name, result['p50_ms'], base['p50_ms']))
+    return regressions
+
+
+def format_results(results):
+    """ Return the results as a table """
+
+    lines = ['{0:<24}{1:>7}{2:>12}{3:>10}{4:>10}{5:>10}{6:>10}'.format(
+        'benchmark', 'runs', 'ops/s', 'p50 ms', 'p95 ms', 'p99 ms',
+        'queries')]
+    for name, result in results.items():
+        lines.append('{0:<24}{1:>7}{2:>12}{3:>10}{4:>10}{5:>10}{6:>10}'.format(
+            name, result['runs'], str(result['throughput']), result['p50_ms'],
+            result['p95_ms'], result['p99_ms'], result['queries_per_run']))
+    return '\n'.join(lines)
+
+
+def main(argv=None):
+    """ Run the benchmarks from the command line.
+
+    Returns the exit status: 1 if there are regressions against the
+    baseline, 0 otherwise.
+    """
+
+    defaults = LedgerSpec()
+    parser = argparse.ArgumentParser(prog='python -m glbench',
+                                     description='Benchmark GLedger on a '
+                                     'synthetic ledger')
+    parser.add_argument('--database', default=None,
+                        help='SQLite file to build the ledger in (replaced); '
+                        'default a temporary file')
+    parser.add_argument('--seed', type=int, default=defaults.seed)
+    parser.add_argument('--depth', type=int, default=defaults.depth,
+                        help='Levels in the chart of accounts')
+    parser.add_argument('--accounts', type=int, default=defaults.accounts)
+    parser.add_argument('--first-month', type=int,
+                        default=defaults.first_month)
+    parser.add_argument('--months', type=int, default=defaults.months)
+    parser.add_argument('--journals-per-month', type=int,
+                        default=defaults.journals_per_month)
+    parser.add_argument('--postings-per-journal', type=int,
+                        default=defaults.postings_per_journal)
+    parser.add_argument('--currencies', type=int,
+                        default=defaults.currencies)
+    parser.add_argument('--samples', type=int, default=200,
+                        help='Runs of every read benchmark')
+    parser.add_argument('--save-baseline', metavar='PATH',
+                        help='Write the results to PATH')
+    parser.add_argument('--baseline', metavar='PATH',
+                        help='Compare the results with the baseline at PATH')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='Allowed fraction of latency regression')
+    args = parser.parse_args(argv)
+    spec = LedgerSpec(seed=args.seed, depth=args.depth, accounts=args.accounts,
+                      first_month=args.first_month, months=args.months,
+                      journals_per_month=args.journals_per_month,
+                      postings_per_journal=args.postings_per_journal,
+                      currencies=args.currencies)
+    database = args.database
+    if database is None:
+        database = os.path.join(tempfile.mkdtemp(prefix='glbench'), 'bench.db')
+    elif os.path.exists(database):
+        os.remove(database)
+    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + \
+        os.path.abspath(database)
+    results = BenchmarkSuite(spec, samples=args.samples).run()
+    print(format_results(results))
+    if args.save_baseline:
+        save_results(spec, results, args.save_baseline)
+    if args.baseline:
+        baseline_spec, baseline = load_results(args.baseline)
+        if baseline_spec != spec:
+            print('Warning: the baseline was made for another ledger')
+        regressions = compare(results, baseline, tolerance=args.tolerance)
+        for regression in regressions:
+            print('Regression: ' + regression)
+        return 1 if regressions else 0
+    return 0
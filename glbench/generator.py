@@ -0,0 +1,187 @@
+#    Copyright 2015 Menno Hölscher
+#
+#    This file is part of gledger.
+
+#    gledger is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Lesser General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+
+#    gledger is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Lesser General Public License for more details.
+
+#    You should have received a copy of the GNU Lesser General Public License
+#    along with gledger.  If not, see <http://www.gnu.org/licenses/>.
+
+
+""" This module generates a synthetic ledger: a chart of accounts, the
+postmonths of a year and the journals posted in them.
+
+The ledger follows from a LedgerSpec. All choices are made with a random
+generator seeded from the spec (and the postmonth, for the journals), so
+the same spec always gives the same ledger, whatever order the months are
+generated in. The journals are dictionaries in the format delivered to
+/api/journal/new.
+"""
+
+import random
+from collections import namedtuple
+from datetime import date
+from glmodels.glaccount import Accounts, Postmonths
+from glmodels.glrates import Rates, exchange_rates
+
+CURRENCIES = ['EUR', 'USD', 'GBP', 'CHF', 'JPY', 'SEK', 'NOK', 'DKK']
+
+PROFIT_ACCOUNT = 'winst'
+
+
+class LedgerSpec(namedtuple('LedgerSpec',
+                            ['seed', 'depth', 'accounts', 'first_month',
+                             'months', 'journals_per_month',
+                             'postings_per_journal', 'currencies'])):
+    """ The parameters of a synthetic ledger.
+
+        :seed: the seed of the random generator
+        :depth: the number of levels of the chart of accounts
+        :accounts: the number of accounts in the chart
+        :first_month: the first postmonth (yyyymm)
+        :months: the number of postmonths
+        :journals_per_month: the journals posted in every postmonth
+        :postings_per_journal: the postings in every journal (at least 2)
+        :currencies: the number of currencies journals are in
+    """
+
+    __slots__ = ()
+
+    def as_dict(self):
+        """ Return the spec as a dictionary """
+
+        return dict(self._asdict())
+
+LedgerSpec.__new__.__defaults__ = (1, 3, 200, 201701, 12, 100, 4, 1)
+
+
+class LedgerGenerator():
+    """ Generates the ledger for a LedgerSpec """
+
+    def __init__(self, spec):
+
+        if spec.postings_per_journal < 2:
+            raise ValueError('A journal needs at least 2 postings')
+        if not 1 <= spec.currencies <= len(CURRENCIES):
+            raise ValueError('Currencies must be from 1 to ' +
+                             str(len(CURRENCIES)))
+        if spec.depth < 1 or spec.accounts < len(Accounts.VALID_ROLES):
+            raise ValueError('The chart needs a level and an account per role')
+        self.spec = spec
+        self.currencies = CURRENCIES[:spec.currencies]
+        self.chart = self._chart()
+        parents = set(parent for (_, _, parent) in self.chart)
+        self.leaves = [name for (name, _, _) in self.chart
+                       if name not in parents and name != PROFIT_ACCOUNT]
+
+    def _chart(self):
+        """ Return the chart as a list of (name, role, parent name), every
+        parent before its children.
+
+        There is a root account per role. The other accounts are spread
+        evenly over the levels below, each below a random account of the
+        level above it. The profit account for the year end is added below
+        the root of the liabilities.
+        """
+
+        rng = random.Random('{0}-chart'.format(self.spec.seed))
+        level = [(role + '00000', role, None) for role in Accounts.VALID_ROLES]
+        chart = list(level)
+        remaining = self.spec.accounts - len(chart)
+        number = 0
+        for depth in range(self.spec.depth - 1, 0, -1):
+            above, level = level, []
+            for _ in range(remaining // depth):
+                (parent, role, _) = rng.choice(above)
+                number += 1
+                level.append(('{0}{1:05d}'.format(role, number), role, parent))
+            remaining -= len(level)
+            chart.extend(level)
+        chart.append((PROFIT_ACCOUNT, 'L', 'L00000'))
+        return chart
+
+    def postmonths(self):
+        """ Return the postmonths of the ledger, in order """
+
+        year, month = divmod(self.spec.first_month, 100)
+        postmonths = []
+        for _ in range(self.spec.months):
+            postmonths.append(year * 100 + month)
+            year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+        return postmonths
+
+    def journals(self, postmonth):
+        """ Generate the journals of postmonth.
+
+        Every journal is in one currency. Its postings go to random leaf
+        accounts; the last posting balances the journal.
+        """
+
+        rng = random.Random('{0}-{1}'.format(self.spec.seed, postmonth))
+        year, month = divmod(postmonth, 100)
+        for number in range(1, self.spec.journals_per_month + 1):
+            currency = rng.choice(self.currencies)
+            valuedate = '{0:04d}-{1:02d}-{2:02d}'.format(year, month,
+                                                         rng.randint(1, 28))
+            postings = []
+            balance = 0
+            for _ in range(self.spec.postings_per_journal - 1):
+                amount = rng.randint(1, 1000000)
+                debitcredit = rng.choice(['Db', 'Cr'])
+                balance += amount if debitcredit == 'Db' else -amount
+                postings.append(self._posting(rng, currency, amount,
+                                              debitcredit, valuedate))
+            if balance == 0:
+                postings[0]['amount'] += 1
+                balance += 1 if postings[0]['debitcredit'] == 'Db' else -1
+            postings.append(self._posting(rng, currency, abs(balance),
+                                          'Cr' if balance > 0 else 'Db',
+                                          valuedate))
+            yield {"journal": {"extkey": 'bench-{0}-{1:06d}'.format(postmonth,
+                                                                    number),
+                               "postings": postings}}
+
+    def rates(self):
+        """ Return the rates of the currencies other than the ledger
+        currency, as (currency, date, rate), one from the first day of
+        every postmonth.
+        """
+
+        rng = random.Random('{0}-rates'.format(self.spec.seed))
+        rates = []
+        for currency in self.currencies:
+            if currency == exchange_rates.currency:
+                continue
+            rate = rng.uniform(0.5, 1.5)
+            for postmonth in self.postmonths():
+                rate *= rng.uniform(0.97, 1.03)
+                year, month = divmod(postmonth, 100)
+                rates.append((currency, date(year, month, 1), round(rate, 6)))
+        return rates
+
+    def _posting(self, rng, currency, amount, debitcredit, valuedate):
+        """ Return the dictionary for a posting to a random leaf account """
+
+        return {"account": rng.choice(self.leaves), "currency": currency,
+                "amount": amount, "debitcredit": debitcredit,
+                "valuedate": valuedate}
+
+    def populate(self):
+        """ Add the chart of accounts, the (active) postmonths and the
+        rates to the session.
+        """
+
+        for (name, role, parent) in self.chart:
+            Accounts.create_account(name=name, role=role, parent_name=parent)
+        for postmonth in self.postmonths():
+            Postmonths(postmonth=postmonth, monthstat=Postmonths.ACTIVE).add()
+        for (currency, rate_date, rate) in self.rates():
+            Rates.set_rate(currency, rate_date, rate)
@@ -39,4 +39,8 @@ from glmodels.glaccount import CloseDates
 from glmodels.glaccount import Postmonths
 from glmodels.glposting import Postings
 from glmodels.glposting import Journals
+from . import instrumentation
 from . import views
+from . import postingworker
+from . import spool
+from . import commands
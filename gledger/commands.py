@@ -0,0 +1,163 @@
+#    Copyright 2015 Menno Hölscher
+#
+#    This file is part of gledger.
+
+#    gledger is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Lesser General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+
+#    gledger is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Lesser General Public License for more details.
+
+#    You should have received a copy of the GNU Lesser General Public License
+#    along with gledger.  If not, see <http://www.gnu.org/licenses/>.
+
+""" This module contains the maintenance commands of GLedger. They are run
+with the flask command, e.g.::
+
+    flask rebuild-account-tree
+    flask year-end --start-next-year 2017-01-01
+    flask export-postings kas --format ndjson --output kas.ndjson
+    flask export-columnar /data/gledger
+    flask set-rate USD 2017-01-01 0.9412
+"""
+
+from time import perf_counter
+import click
+from . import app, db
+from glmodels.glaccount import Accounts, AccountTree, Postmonths,\
+    UltimoBalances
+from glmodels import glmetrics
+from glmodels.glcolumnar import ColumnarExport, ColumnarExportError
+from glmodels.glposting import Journals
+from glmodels.glrates import MissingRateError, Rates
+from glmodels.glyearend import year_end_journals
+from glviews.postingviews import PostingExport
+
+
+@app.cli.command('rebuild-account-tree')
+def rebuild_account_tree_command():
+    """ Fill the account closure table from the parent ids """
+
+    AccountTree.rebuild()
+    db.session.commit()
+    click.echo('Account tree rebuilt')
+
+
+@app.cli.command('snapshot-closed-months')
+def snapshot_closed_months_command():
+    """ Write the ultimo balances of all closed postmonths
+
+    Months closed before the snapshots were introduced get theirs.
+    Each month is committed on its own.
+    """
+
+    postmonths = [postmonth for postmonth, in
+                  db.session.query(Postmonths.postmonth).
+                  filter_by(monthstat=Postmonths.CLOSED).
+                  order_by(Postmonths.postmonth)]
+    for postmonth in postmonths:
+        try:
+            UltimoBalances.snapshot(postmonth)
+        except MissingRateError as rate_error:
+            raise click.ClickException(str(rate_error))
+        db.session.commit()
+    click.echo('{0} closed month(s) written'.format(len(postmonths)))
+
+
+year_end_seconds = glmetrics.Histogram('gledger_year_end_seconds',
+                                       'Duration of a year end run',
+                                       buckets=[1, 5, 10, 30, 60, 300, 900,
+                                                1800, 3600, 7200])
+
+
+@app.cli.command('year-end')
+@click.option('--start-next-year', type=click.DateTime(formats=['%Y-%m-%d']),
+              default=None, help='First day of the new year (yyyy-mm-dd)')
+@click.option('--accounts-per-journal', type=int, default=None,
+              help='Maximum number of accounts in one journal')
+def year_end_command(start_next_year, accounts_per_journal):
+    """ Deliver the year end journals, to be posted by the posting workers
+
+    Every journal is committed on its own. Journals delivered by an
+    earlier, interrupted run are skipped.
+    """
+
+    start = perf_counter()
+    if accounts_per_journal is None:
+        accounts_per_journal = app.config.get('YEAR_END_ACCOUNTS_PER_JOURNAL',
+                                              250)
+    delivered = 0
+    for journal in year_end_journals(start_next_year=start_next_year,
+                                     num_accounts=accounts_per_journal):
+        Journals.create_from_dict(journal)
+        db.session.commit()
+        delivered += 1
+    year_end_seconds.observe(perf_counter() - start)
+    glmetrics.push('gledger-year-end')
+    click.echo('{0} year end journal(s) delivered'.format(delivered))
+
+
+@app.cli.command('export-postings')
+@click.argument('account_name')
+@click.option('--format', 'export_format', type=click.Choice(['csv', 'ndjson']),
+              default='csv', help='Format of the export')
+@click.option('--subtree', is_flag=True,
+              help='Include the accounts below the account')
+@click.option('--from-month', default=None, help='First month (mm-yyyy)')
+@click.option('--to-month', default=None, help='Last month (mm-yyyy)')
+@click.option('--output', type=click.File('w'), default='-',
+              help='File to write to, default standard output')
+def export_postings_command(account_name, export_format, subtree, from_month,
+                            to_month, output):
+    """ Export the postings of an account as CSV or ndjson """
+
+    try:
+        posting_export = PostingExport(Accounts.get_by_name(account_name),
+                                       export_format=export_format,
+                                       subtree=subtree, from_month=from_month,
+                                       to_month=to_month)
+    except ValueError as content_error:
+        raise click.ClickException(str(content_error))
+    for line in posting_export.lines():
+        output.write(line)
+
+
+@app.cli.command('export-columnar')
+@click.argument('directory', type=click.Path(file_okay=False))
+@click.option('--batch-size', type=int, default=100000,
+              help='Postings read and written at a time')
+def export_columnar_command(directory, batch_size):
+    """ Export closed postmonths to Parquet files (needs pyarrow)
+
+    Postmonths exported before are skipped.
+    """
+
+    try:
+        exported = ColumnarExport(directory, batch_size=batch_size).export()
+    except ColumnarExportError as export_error:
+        raise click.ClickException(str(export_error))
+    click.echo('{0} postmonth(s) exported'.format(len(exported)))
+
+
+@app.cli.command('set-rate')
+@click.argument('currency')
+@click.argument('rate_date', type=click.DateTime(formats=['%Y-%m-%d']))
+@click.argument('rate')
+def set_rate_command(currency, rate_date, rate):
+    """ Set the rate of a currency from a date (yyyy-mm-dd) on
+
+    The rate is the amount in the ledger currency for one unit of the
+    currency.
+    """
+
+    try:
+        Rates.set_rate(currency.upper(), rate_date.date(), rate)
+    except ValueError as rate_error:
+        raise click.ClickException(str(rate_error))
+    db.session.commit()
+    click.echo('Rate of {0} from {1:%Y-%m-%d} set to {2}'.format(
+        currency.upper(), rate_date, rate))
@@ -0,0 +1,205 @@
+#    Copyright 2015 Menno Hölscher
+#
+#    This file is part of gledger.
+
+#    gledger is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Lesser General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+
+#    gledger is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Lesser General Public License for more details.
+
+#    You should have received a copy of the GNU Lesser General Public License
+#    along with gledger.  If not, see <http://www.gnu.org/licenses/>.
+
+
+""" Group commit for the journals delivered to /api/journal/new.
+
+Committing every journal on its own makes the database write its log for
+every small transaction. With group commit (GROUP_COMMIT = True) the
+requests hand their journal to a committer thread, which collects the
+journals arriving within GROUP_COMMIT_WINDOW seconds, or until there are
+GROUP_COMMIT_SIZE of them, adds them in one transaction and commits it.
+Every request waits until the transaction of its journal has been
+committed, and then gets its own result.
+
+A journal that is refused does not stop the others in its group. If
+the commit of the group fails, the journals are added again one by one,
+each in a transaction of its own, so only the journal causing the
+failure is refused.
+
+A request waits at most GROUP_COMMIT_TIMEOUT seconds for its journal.
+If the committer has not finished with it by then, the request gets
+GroupCommitTimeout; the journal may still be committed later, so the
+application should deliver it again (with JOURNAL_IDEMPOTENT set, a
+journal already added is not added twice).
+"""
+
+import logging
+import queue
+import threading
+from time import monotonic
+from sqlalchemy.exc import SQLAlchemyError
+from . import app, db
+from glmodels.glposting import InvalidJournalError, Journals, extkey_of
+
+
+class GroupCommitTimeout(Exception):
+    """ The journal was not committed within the timeout """
+
+    pass
+
+
+class _Waiter():
+    """ A journal waiting to be committed, with its result: the extkey
+    of the journal added, or the exception refusing it.
+    """
+
+    def __init__(self, journdict):
+
+        self.journdict = journdict
+        self.extkey = None
+        self.error = None
+        self.done = threading.Event()
+
+    def refuse(self, error):
+
+        if isinstance(error, (KeyError, TypeError, ValueError)) and\
+                not isinstance(error, InvalidJournalError):
+            error = InvalidJournalError('Invalid journal: ' + str(error))
+        self.error = error
+
+
+class GroupCommitter():
+    """ Collects journals from many requests and commits them in groups.
+
+    The committer thread is started with the first journal.
+    """
+
+    def __init__(self, window=0.005, max_journals=100, timeout=30):
+
+        self.window = window
+        self.max_journals = max_journals
+        self.timeout = timeout
+        self.waiting = queue.Queue()
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def add(self, journdict):
+        """ Add a journal, returning its extkey once it is committed.
+
+        Raises the exception refusing the journal, if it is refused, or
+        GroupCommitTimeout if it is not committed within the timeout.
+        """
+
+        waiter = _Waiter(journdict)
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, daemon=True,
+                                               name='group-commit')
+                self.thread.start()
+        self.waiting.put(waiter)
+        if not waiter.done.wait(self.timeout):
+            raise GroupCommitTimeout('Journal ' +
+                                     str(extkey_of(journdict)) +
+                                     ' not committed within ' +
+                                     str(self.timeout) + ' seconds')
+        if waiter.error is not None:
+            raise waiter.error
+        return waiter.extkey
+
+    def collect(self):
+        """ Wait for a journal, then return it with the journals arriving
+        within the window, up to max_journals.
+        """
+
+        group = [self.waiting.get()]
+        deadline = monotonic() + self.window
+        while len(group) < self.max_journals:
+            remaining = deadline - monotonic()
+            if remaining <= 0:
+                break
+            try:
+                group.append(self.waiting.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return group
+
+    def _run(self):
+        """ Commit groups until the process ends """
+
+        with app.app_context():
+            while True:
+                group = self.collect()
+                try:
+                    self.commit_group(group)
+                except Exception as exc:
+                    logging.exception('Group of journals not committed')
+                    db.session.rollback()
+                    for waiter in group:
+                        if waiter.extkey is None and waiter.error is None:
+                            waiter.error = exc
+                finally:
+                    db.session.remove()
+                    for waiter in group:
+                        waiter.done.set()
+
+    def commit_group(self, group):
+        """ Add the journals of group in one transaction and commit it.
+
+        If the commit fails, the journals are added one by one.
+        """
+
+        outcomes = Journals.create_batch([waiter.journdict for waiter in group])
+        try:
+            db.session.commit()
+        except SQLAlchemyError as dbe:
+            db.session.rollback()
+            logging.warning('Group commit failed, committing one by one: ' +
+                            str(dbe))
+            self.commit_one_by_one(group, outcomes)
+            return
+        for waiter, outcome in zip(group, outcomes):
+            if isinstance(outcome, Exception):
+                waiter.refuse(outcome)
+            else:
+                waiter.extkey = waiter.journdict['journal']['extkey']
+
+    def commit_one_by_one(self, group, outcomes):
+        """ Add and commit the journals of group one at a time """
+
+        for waiter, outcome in zip(group, outcomes):
+            if isinstance(outcome, Exception):
+                waiter.refuse(outcome)
+                continue
+            try:
+                journal = Journals.create_from_dict(waiter.journdict)
+                db.session.commit()
+                waiter.extkey = journal.extkey
+            except (InvalidJournalError, KeyError, TypeError,
+                    ValueError) as exc:
+                db.session.rollback()
+                waiter.refuse(exc)
+            except SQLAlchemyError as dbe:
+                db.session.rollback()
+                waiter.error = dbe
+
+
+_committer = None
+_committer_lock = threading.Lock()
+
+
+def group_committer():
+    """ Return the group committer of the process """
+
+    global _committer
+    with _committer_lock:
+        if _committer is None:
+            _committer = GroupCommitter(
+                window=app.config.get('GROUP_COMMIT_WINDOW', 0.005),
+                max_journals=app.config.get('GROUP_COMMIT_SIZE', 100),
+                timeout=app.config.get('GROUP_COMMIT_TIMEOUT', 30))
+        return _committer
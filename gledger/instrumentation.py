@@ -0,0 +1,224 @@
+#    Copyright 2015 Menno Hölscher
+#
+#    This file is part of gledger.
+
+#    gledger is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Lesser General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+
+#    gledger is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Lesser General Public License for more details.
+
+#    You should have received a copy of the GNU Lesser General Public License
+#    along with gledger.  If not, see <http://www.gnu.org/licenses/>.
+
+
+""" The module counts and times the SQL statements executed for a request.
+
+For every request the number of statements, the total time spent in the
+database and the slowest statements are recorded. When the request is
+done, the statistics are:
+
+    * logged, in a line per request (at QUERY_STATS_LOG_LEVEL, default
+      INFO)
+    * added to the response as X-Query-Count, X-Query-Time and
+      Server-Timing headers, in debug mode or when QUERY_STATS_HEADERS
+      is set
+    * passed to the collectors added with add_collector, e.g. to keep
+      metrics
+
+Recording for requests is switched off by setting QUERY_STATS to False.
+The statements are seen through the events of the SQLAlchemy engines,
+so every query is counted, wherever in the models it is made. Statements
+executed while a streamed response is sent, after the request itself is
+done, are not counted for the request.
+
+Statements can also be recorded outside requests, or across a number of
+them, with record_queries::
+
+    with record_queries() as stats:
+        client.get('/balance/kas')
+    assert stats.count <= 5
+"""
+
+import heapq
+import logging
+import threading
+from contextlib import contextmanager
+from time import perf_counter
+from flask import g, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from . import app
+
+
+class QueryStats():
+    """ The statements executed while recording.
+
+    Has the number of statements (count), the time spent executing them
+    in seconds (seconds) and the slowest statements, as a list of
+    (seconds, statement), slowest first.
+    """
+
+    def __init__(self, slowest=3):
+
+        self.count = 0
+        self.seconds = 0.0
+        self.keep_slowest = slowest
+        self._slowest = []
+
+    def record(self, statement, seconds):
+        """ Add an executed statement """
+
+        self.count += 1
+        self.seconds += seconds
+        if self.keep_slowest:
+            entry = (seconds, self.count, statement)
+            if len(self._slowest) < self.keep_slowest:
+                heapq.heappush(self._slowest, entry)
+            elif entry > self._slowest[0]:
+                heapq.heapreplace(self._slowest, entry)
+
+    @property
+    def slowest(self):
+        """ The slowest statements as (seconds, statement), slowest first """
+
+        return [(seconds, statement) for (seconds, _, statement)
+                in sorted(self._slowest, reverse=True)]
+
+    def as_dict(self):
+        """ Return the statistics as a dictionary, times in milliseconds """
+
+        return {'count': self.count,
+                'milliseconds': round(self.seconds * 1000, 3),
+                'slowest': [{'milliseconds': round(seconds * 1000, 3),
+                             'statement': statement}
+                            for (seconds, statement) in self.slowest]}
+
+
+_recording = threading.local()
+
+_collectors = []
+
+
+def _active():
+    """ Return the list of QueryStats recording in this thread """
+
+    if not hasattr(_recording, 'stats'):
+        _recording.stats = []
+    return _recording.stats
+
+
+@contextmanager
+def record_queries(slowest=3):
+    """ Record the statements executed in this thread in the block,
+    yielding the QueryStats they are recorded in.
+
+    Recordings may be nested; a statement is recorded in all of them.
+    """
+
+    stats = QueryStats(slowest=slowest)
+    _active().append(stats)
+    try:
+        yield stats
+    finally:
+        _active().remove(stats)
+
+
+def add_collector(collector):
+    """ Add a collector of the statistics of requests.
+
+    The collector is called as collector(request, response, stats) when
+    a request is done, stats being the QueryStats of the request.
+    """
+
+    _collectors.append(collector)
+
+
+def remove_collector(collector):
+    """ Remove a collector added with add_collector """
+
+    _collectors.remove(collector)
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def start_timing(conn, cursor, statement, parameters, context, executemany):
+    """ Keep the time a statement starts """
+
+    if _active():
+        conn.info.setdefault('query_start', []).append(perf_counter())
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def stop_timing(conn, cursor, statement, parameters, context, executemany):
+    """ Record the statement in all recordings of this thread """
+
+    starts = conn.info.get('query_start')
+    if not starts:
+        return
+    seconds = perf_counter() - starts.pop()
+    for stats in _active():
+        stats.record(statement, seconds)
+
+
+@app.before_request
+def start_recording():
+    """ Start recording the statements of the request """
+
+    if not app.config.get('QUERY_STATS', True):
+        return
+    stats = QueryStats(slowest=app.config.get('QUERY_STATS_SLOWEST', 3))
+    _active().append(stats)
+    g.query_stats = stats
+
+
+@app.after_request
+def report_queries(response):
+    """ Stop recording for the request and report the statistics """
+
+    stats = g.pop('query_stats', None)
+    if stats is None:
+        return response
+    if stats in _active():
+        _active().remove(stats)
+    if app.config.get('QUERY_STATS_HEADERS', app.debug):
+        milliseconds = '{0:.3f}'.format(stats.seconds * 1000)
+        response.headers['X-Query-Count'] = str(stats.count)
+        response.headers['X-Query-Time'] = milliseconds
+        response.headers['Server-Timing'] = 'db;dur={0};desc="{1} queries"'.\
+            format(milliseconds, stats.count)
+    level = logging.getLevelName(app.config.get('QUERY_STATS_LOG_LEVEL',
+                                                'INFO'))
+    if logging.getLogger().isEnabledFor(level):
+        logging.log(level, log_line(request, response, stats))
+    for collector in _collectors:
+        try:
+            collector(request, response, stats)
+        except Exception:
+            logging.exception('Query statistics collector failed')
+    return response
+
+
+@app.teardown_request
+def stop_recording(exc=None):
+    """ Stop recording when the request ended without a response """
+
+    stats = g.pop('query_stats', None)
+    if stats is not None and stats in _active():
+        _active().remove(stats)
+
+
+def log_line(request, response, stats):
+    """ Return the line logged for a request """
+
+    line = '{0} {1} {2}: {3} queries in {4:.1f} ms'.format(
+        request.method, request.path, response.status_code, stats.count,
+        stats.seconds * 1000)
+    if stats.slowest:
+        seconds, statement = stats.slowest[0]
+        line += '; slowest {0:.1f} ms: {1}'.format(
+            seconds * 1000, ' '.join(statement.split())[:200])
+    return line
@@ -16,15 +16,23 @@
 #    along with gledger.  If not, see <http://www.gnu.org/licenses/>.
 
 """ The module contains the interface for journal producers. The batches
-with postings are delivered to the /journal/new route. As this is the only
-route, it is clear you can not update a journal after delivery.
+with postings are delivered to the /journal/new route, or many at a time
+to the /journal/bulk route. There is no route to update a journal, it is
+clear you can not update a journal after delivery.
 
 TODO Create "insert" function to add postings to existing journal
 """
 
-from flask import Blueprint, jsonify, request
+import json
+import logging
+from itertools import islice
+from flask import Blueprint, Response, current_app, jsonify, request,\
+    stream_with_context
+from sqlalchemy.exc import SQLAlchemyError
 import glmodels.glposting as postings
 from . import db
+from .groupcommit import GroupCommitTimeout, group_committer
+from .spool import SpoolError, journal_spool
 
 postingapi = Blueprint('api', __name__)
 
@@ -70,12 +78,142 @@ def addjournal():
     
     The journal and its entries are delivered as
     a JSON file. It is decoded and the journal
-    and its postings are added to the database. """
+    and its postings are added to the database. The journal
+    is stored unprocessed, posting it to the accounts is left
+    to the posting workers (see gledger.postingworker). With
+    JOURNAL_IDEMPOTENT a journal delivered again gets the response of
+    the first delivery, and is not added again (see
+    glmodels.glposting.Journals).
+
+    With GROUP_COMMIT the journal is committed together with the
+    journals of other requests (see gledger.groupcommit); the response
+    is sent once it is committed, status 503 if that takes longer than
+    GROUP_COMMIT_TIMEOUT. With JOURNAL_SPOOL the journal is
+    written to the spool (see gledger.spool) and accepted, the status is
+    202; it is added to the ledger later. """
     
     try:
         journal = request.get_json()
-        postings.Journals.create_from_dict(journal)
-        db.session.commit()
-    except postings.InvalidJournalError as ije:
+        if current_app.config.get('JOURNAL_SPOOL', False):
+            journal_spool().append(journal)
+            response = jsonify(create_success_response(
+                app_message='Journal ' + str(postings.extkey_of(journal)) +
+                ' accepted'))
+            response.status_code = 202
+            return response
+        if current_app.config.get('GROUP_COMMIT', False):
+            extkey = group_committer().add(journal)
+        else:
+            new_journal = postings.Journals.create_from_dict(journal)
+            db.session.commit()
+            extkey = new_journal.extkey
+    except postings.DuplicateJournalError as dje:
+        raise InvalidJsonError(str(dje), status_code=409)
+    except (postings.InvalidJournalError, SpoolError) as ije:
         raise InvalidJsonError(str(ije))
-    return jsonify(create_success_response(app_message='Journal '+ extkey + ' added'))
+    except GroupCommitTimeout as gct:
+        raise InvalidJsonError(str(gct), status_code=503)
+    return jsonify(create_success_response(app_message='Journal '+
+        str(extkey) + ' added'))
+
+@postingapi.route('/journal/bulk', methods=['POST'])
+def addjournals():
+    """Receive many journals from an application in one request.
+
+    The journals are delivered as newline delimited JSON, one journal
+    in the format of /journal/new per line. The body is read line by
+    line, the journals are added and committed in groups of
+    BULK_COMMIT_SIZE (default 500). The response is newline delimited
+    JSON too: a result per journal, in the order received, with the
+    extkey of the journal, a status and a message. A result is sent
+    once the group of its journal has been committed. """
+
+    group_size = current_app.config.get('BULK_COMMIT_SIZE', 500)
+    lines = journal_lines(request.stream)
+
+    def results():
+        group = list(islice(lines, group_size))
+        while group:
+            for result in add_journal_group(group):
+                yield json.dumps(result) + '\n'
+            group = list(islice(lines, group_size))
+
+    return Response(stream_with_context(results()),
+                    mimetype='application/x-ndjson')
+
+
+def journal_lines(stream):
+    """ Decode the journals in a newline delimited stream.
+
+    Yields the journal dictionary, or the error if the line is not
+    valid JSON. Empty lines are skipped.
+    """
+
+    for line_no, line in enumerate(stream, start=1):
+        if not line.strip():
+            continue
+        try:
+            yield json.loads(line.decode('utf-8'))
+        except ValueError as ve:
+            yield InvalidJsonError('Line {0}: {1}'.format(line_no, ve))
+
+
+def add_journal_group(group):
+    """ Add a group of decoded journals in one transaction.
+
+    If the transaction can not be committed, the journals are added
+    again one by one, each in a transaction of its own, so only the
+    journal causing the failure is refused.
+
+    Returns a result dictionary for each journal in the group.
+    """
+
+    journdicts = [journdict for journdict in group
+                  if not isinstance(journdict, Exception)]
+    outcomes = postings.Journals.create_batch(journdicts)
+    try:
+        db.session.commit()
+    except SQLAlchemyError as dbe:
+        db.session.rollback()
+        logging.warning('Bulk group not committed, adding journals one by '
+                        'one: ' + str(dbe))
+        outcomes = [outcome if isinstance(outcome, Exception)
+                    else add_one_journal(journdict)
+                    for journdict, outcome in zip(journdicts, outcomes)]
+    outcomes = iter(outcomes)
+    results = []
+    for journdict in group:
+        if isinstance(journdict, Exception):
+            results.append(error_result(None, journdict.message))
+            continue
+        outcome = next(outcomes)
+        extkey = postings.extkey_of(journdict)
+        if isinstance(outcome, Exception):
+            results.append(error_result(extkey, str(outcome)))
+        else:
+            result = create_success_response(app_message='Journal ' +
+                                             str(extkey) + ' added')
+            result['extkey'] = extkey
+            results.append(result)
+    return results
+
+
+def add_one_journal(journdict):
+    """ Add and commit one journal, returning it or the exception refusing
+    it.
+    """
+
+    try:
+        journal = postings.Journals.create_from_dict(journdict)
+        db.session.commit()
+        return journal
+    except (postings.InvalidJournalError, KeyError, TypeError, ValueError,
+            SQLAlchemyError) as exc:
+        db.session.rollback()
+        return exc
+
+
+def error_result(extkey, message):
+    """ Build the result for a journal that was not added """
+
+    return {"status": "Not correct", "message": message, "extkey": extkey}
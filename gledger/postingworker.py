@@ -0,0 +1,141 @@
+#    Copyright 2015 Menno Hölscher
+#
+#    This file is part of gledger.
+
+#    gledger is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Lesser General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+
+#    gledger is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Lesser General Public License for more details.
+
+#    You should have received a copy of the GNU Lesser General Public License
+#    along with gledger.  If not, see <http://www.gnu.org/licenses/>.
+
+""" The posting workers take journals delivered through the API and post
+them to the accounts. The API only stores a journal as unprocessed, the
+workers claim unprocessed journals in batches and post them, marking each
+journal processed or failed.
+
+Workers run as separate processes, started by the "post-journals"
+command::
+
+    flask post-journals --workers 4
+
+The number of workers, the size of a batch, the lease time of a claim and
+the time to wait when there is no work are taken from the configuration
+(POSTING_WORKERS, POSTING_BATCH_SIZE, POSTING_LEASE_SECONDS and
+POSTING_POLL_SECONDS) when not passed. More than one worker needs
+POSTING_MODE atomic, in which the balances are incremented in the
+database.
+
+If POSTING_METRICS_PORT is configured, every worker serves its metrics
+(see glmodels.glmetrics) on a port of its own: the first worker on
+POSTING_METRICS_PORT, the next one on the port after it, and so on.
+"""
+
+import logging
+import multiprocessing
+import os
+import socket
+import time
+import click
+from . import app, db
+from glmodels import glmetrics
+from glmodels.glposting import Journals
+
+
+def post_batch(worker, batch_size=None, lease_seconds=None):
+    """ Claim one batch of unprocessed journals and post it.
+
+    Returns the number of journals claimed.
+    """
+
+    if batch_size is None:
+        batch_size = app.config.get('POSTING_BATCH_SIZE', 100)
+    if lease_seconds is None:
+        lease_seconds = app.config.get('POSTING_LEASE_SECONDS', 300)
+    journals = Journals.claim_unprocessed(worker, batch_size=batch_size,
+                                          lease_seconds=lease_seconds)
+    if journals:
+        failures = Journals.process_claimed(journals)
+        logging.info('Worker {0} posted {1} journal(s), {2} failed'.\
+            format(worker, len(journals) - failures, failures))
+    return len(journals)
+
+
+def run_worker(worker=None, batch_size=None, poll_seconds=None,
+               metrics_port=None):
+    """ Keep posting batches until stopped.
+
+    When no journals are waiting, the worker sleeps poll_seconds before
+    looking again. With a metrics_port, the metrics of the worker are
+    served on it.
+    """
+
+    if worker is None:
+        worker = '{0}-{1}'.format(socket.gethostname(), os.getpid())
+    if poll_seconds is None:
+        poll_seconds = app.config.get('POSTING_POLL_SECONDS', 5)
+    if metrics_port:
+        glmetrics.serve(metrics_port)
+    with app.app_context():
+        while True:
+            try:
+                claimed = post_batch(worker, batch_size=batch_size)
+            except Exception:
+                logging.exception('Worker ' + worker + ' failed on batch')
+                db.session.rollback()
+                claimed = 0
+            finally:
+                db.session.remove()
+            if not claimed:
+                time.sleep(poll_seconds)
+
+
+def start_workers(num_workers=None, batch_size=None):
+    """ Start a pool of posting worker processes and wait for them.
+
+    Raises ValueError for more than one worker in POSTING_MODE orm.
+    """
+
+    if num_workers is None:
+        num_workers = app.config.get('POSTING_WORKERS', 2)
+    if num_workers > 1 and app.config.get('POSTING_MODE', 'orm') != 'atomic':
+        raise ValueError('POSTING_MODE orm allows one posting worker only')
+    metrics_port = app.config.get('POSTING_METRICS_PORT')
+    context = multiprocessing.get_context('spawn')
+    workers = [context.Process(target=run_worker,
+                               kwargs={'batch_size': batch_size,
+                                       'metrics_port': metrics_port and
+                                       metrics_port + number})
+               for number in range(num_workers)]
+    for process in workers:
+        process.start()
+    for process in workers:
+        process.join()
+
+
+@app.cli.command('post-journals')
+@click.option('--workers', type=int, default=None,
+              help='Number of worker processes')
+@click.option('--batch-size', type=int, default=None,
+              help='Journals claimed per batch')
+@click.option('--once', is_flag=True,
+              help='Post one batch in this process and stop')
+def post_journals_command(workers, batch_size, once):
+    """ Post unprocessed journals with a pool of workers """
+
+    if once:
+        worker = '{0}-{1}'.format(socket.gethostname(), os.getpid())
+        claimed = post_batch(worker, batch_size=batch_size)
+        glmetrics.push('gledger-post-journals')
+        click.echo('{0} journal(s) claimed'.format(claimed))
+    else:
+        try:
+            start_workers(num_workers=workers, batch_size=batch_size)
+        except ValueError as worker_error:
+            raise click.ClickException(str(worker_error))
@@ -0,0 +1,420 @@
+#    Copyright 2015 Menno Hölscher
+#
+#    This file is part of gledger.
+
+#    gledger is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Lesser General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+
+#    gledger is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Lesser General Public License for more details.
+
+#    You should have received a copy of the GNU Lesser General Public License
+#    along with gledger.  If not, see <http://www.gnu.org/licenses/>.
+
+
+""" The journal spool accepts journals without waiting for the database.
+
+In spool mode (JOURNAL_SPOOL = True) a journal delivered to
+/api/journal/new is appended to a log file in SPOOL_DIRECTORY, the log
+is synced to disk, and the journal is acknowledged (202 Accepted). A
+drainer then adds the spooled journals to the ledger in large batches,
+and posts them. How fast journals are accepted no longer depends on the
+load of the database, or on it being available at all.
+
+The log is split in segments. A process appends to a segment of its
+own, named after the time it was started and the process id
+(e.g. 00001507728953123456-4242.open). When it reaches
+SPOOL_SEGMENT_BYTES, or is older than SPOOL_SEGMENT_SECONDS, the segment
+is sealed (renamed to .log) and a new one started. A journal is one
+line of JSON.
+
+The drainer reads every segment from its checkpoint (see
+glmodels.glposting.SpoolCheckpoints) on. The checkpoint is committed in
+the transaction that adds the journals, so after a crash the drainer
+continues exactly after the last journal committed: a journal is added
+once. A journal that is refused, or can not be committed, is written to
+rejected.ndjson in the spool directory with the reason, and skipped.
+Sealed segments that have been read completely are removed. There is
+one drainer; it is run with::
+
+    flask drain-spool
+
+Only complete lines are read, so the drainer can read the segments
+being written. A segment left open by a process that died may end in
+an incomplete line; that journal was never acknowledged and is dropped.
+"""
+
+import json
+import logging
+import os
+import threading
+import time
+import click
+from sqlalchemy.exc import OperationalError, SQLAlchemyError
+from . import app, db
+from glmodels.glposting import Journals, SpoolCheckpoints
+
+OPEN = '.open'
+SEALED = '.log'
+REJECTED = 'rejected.ndjson'
+
+
+class SpoolError(Exception):
+    """ A journal can not be spooled """
+    pass
+
+
+class JournalSpool():
+    """ Appends journals to the segments of this process in directory """
+
+    def __init__(self, directory, segment_bytes=64 * 1024 * 1024,
+                 segment_seconds=60):
+
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.segment_seconds = segment_seconds
+        self.lock = threading.Lock()
+        self.segment = None
+        os.makedirs(directory, exist_ok=True)
+
+    def append(self, journdict):
+        """ Append a journal and sync it to disk.
+
+        The journal is only checked to be a journal with postings; it is
+        fully checked when it is drained.
+        """
+
+        try:
+            postings = journdict['journal']['postings']
+        except (KeyError, TypeError):
+            raise SpoolError('Not a journal')
+        if not isinstance(postings, list) or not postings:
+            raise SpoolError('Empty journal')
+        line = (json.dumps(journdict, separators=(',', ':')) + '\n').\
+            encode('utf-8')
+        with self.lock:
+            if self.segment is None or self.segment.full(self):
+                self.rotate()
+            self.segment.write(line)
+
+    def rotate(self):
+        """ Seal the current segment, if any, and start a new one """
+
+        if self.segment is not None:
+            self.segment.seal()
+        self.segment = _Segment(self.directory)
+        sync_directory(self.directory)
+
+    def close(self):
+        """ Seal the current segment """
+
+        with self.lock:
+            if self.segment is not None:
+                self.segment.seal()
+                self.segment = None
+
+
+class _Segment():
+    """ The segment a process appends to """
+
+    def __init__(self, directory):
+
+        self.directory = directory
+        self.pid = os.getpid()
+        self.name = '{0:020d}-{1}'.format(int(time.time() * 1000000),
+                                          self.pid)
+        self.started = time.monotonic()
+        self.size = 0
+        self.file = open(os.path.join(directory, self.name + OPEN), 'ab')
+
+    def full(self, spool):
+        """ Is the segment to be sealed before appending? """
+
+        return self.pid != os.getpid() or self.size >= spool.segment_bytes or\
+            time.monotonic() - self.started >= spool.segment_seconds
+
+    def write(self, line):
+
+        self.file.write(line)
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.size += len(line)
+
+    def seal(self):
+
+        if self.pid != os.getpid():
+            return
+        self.file.close()
+        os.rename(os.path.join(self.directory, self.name + OPEN),
+                  os.path.join(self.directory, self.name + SEALED))
+        sync_directory(self.directory)
+
+
+def sync_directory(directory):
+    """ Sync the entries of directory to disk """
+
+    try:
+        descriptor = os.open(directory, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(descriptor)
+    except OSError:
+        pass
+    finally:
+        os.close(descriptor)
+
+
+def writer_alive(pid):
+    """ Is the process with pid (on this machine) still running? """
+
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class SpoolDrainer():
+    """ Adds the journals in the spool directory to the ledger.
+
+    Journals are read in batches of batch_size, added, posted if post
+    is true, and committed with the checkpoint of their segment.
+    """
+
+    def __init__(self, directory, batch_size=1000, post=True):
+
+        self.directory = directory
+        self.batch_size = batch_size
+        self.post = post
+
+    def segments(self):
+        """ Return the segments in the directory, oldest first, as
+        (name, path, state).
+
+        The state is SEALED, OPEN when the segment is being written, or
+        None when it was left open by a process that has died.
+        """
+
+        segments = []
+        for filename in sorted(os.listdir(self.directory)):
+            name, state = os.path.splitext(filename)
+            if state not in (OPEN, SEALED):
+                continue
+            if state == OPEN and not writer_alive(int(name.rsplit('-', 1)[1])):
+                state = None
+            segments.append((name, os.path.join(self.directory, filename),
+                             state))
+        return segments
+
+    def drain(self):
+        """ Add all complete journals in the spool.
+
+        Returns the number of journals read.
+        """
+
+        positions = SpoolCheckpoints.positions()
+        segments = self.segments()
+        SpoolCheckpoints.forget(set(positions) -
+                                set(name for name, _, _ in segments))
+        db.session.commit()
+        read = 0
+        for name, path, state in segments:
+            position = positions.get(name, 0)
+            try:
+                while True:
+                    lines, end = read_lines(path, position, self.batch_size)
+                    if not lines:
+                        break
+                    self.add_batch(name, lines, end)
+                    read += len(lines)
+                    position = end
+                size = os.path.getsize(path)
+            except FileNotFoundError:
+                continue
+            if state == OPEN or (state == SEALED and position < size):
+                continue
+            if position < size:
+                logging.warning('Incomplete journal at the end of segment ' +
+                                name + ' dropped')
+            os.remove(path)
+            SpoolCheckpoints.forget([name])
+            db.session.commit()
+        return read
+
+    def add_batch(self, segment, lines, end):
+        """ Add the journals on lines and commit them, with the checkpoint
+        of segment at end.
+
+        If the batch can not be committed, the journals are added one by
+        one. If the database can not be reached, the error is raised
+        and nothing is checkpointed.
+
+        The journals refused are written to the rejected file before the
+        checkpoint is committed: a crash in between may reject a journal
+        twice, but does not lose it.
+        """
+
+        journdicts, rejected = decode_lines(lines)
+        written = []
+        try:
+            self.add_journals(journdicts, rejected)
+            self.reject(rejected)
+            written = [line for line, _ in rejected]
+            SpoolCheckpoints.advance(segment, end)
+            db.session.commit()
+        except OperationalError:
+            db.session.rollback()
+            raise
+        except SQLAlchemyError as dbe:
+            db.session.rollback()
+            logging.warning('Spooled batch not committed, adding journals '
+                            'one by one: ' + str(dbe))
+            self.add_one_by_one(segment, lines, written)
+
+    def add_one_by_one(self, segment, lines, written=()):
+        """ Add and commit the journals on lines one at a time.
+
+        The lines on written are in the rejected file already.
+        """
+
+        for start, line in lines:
+            position = start + len(line)
+            journdicts, rejected = decode_lines([(start, line)])
+            try:
+                self.add_journals(journdicts, rejected)
+                self.reject([(refused, reason) for refused, reason in rejected
+                             if not any(refused is done for done in written)])
+                SpoolCheckpoints.advance(segment, position)
+                db.session.commit()
+            except OperationalError:
+                db.session.rollback()
+                raise
+            except SQLAlchemyError as dbe:
+                db.session.rollback()
+                if not rejected:
+                    self.reject([(line, str(dbe))])
+                SpoolCheckpoints.advance(segment, position)
+                db.session.commit()
+
+    def add_journals(self, journdicts, rejected):
+        """ Add (and post) the journals, adding the refused ones to
+        rejected. A journal delivered before (see JOURNAL_IDEMPOTENT) is
+        not posted again.
+        """
+
+        journals = []
+        for (line, journdict), outcome in zip(journdicts, Journals.create_batch(
+                [journdict for (_, journdict) in journdicts])):
+            if isinstance(outcome, Exception):
+                rejected.append((line, str(outcome)))
+            elif not outcome.replayed and\
+                    not any(outcome is journal for journal in journals):
+                journals.append(outcome)
+        if self.post and journals:
+            Journals.process_claimed(journals, commit=False)
+
+    def reject(self, rejected):
+        """ Write the journals refused to the rejected file """
+
+        if not rejected:
+            return
+        with open(os.path.join(self.directory, REJECTED), 'ab') as rejects:
+            for line, reason in rejected:
+                logging.warning('Spooled journal rejected: ' + reason)
+                rejects.write(json.dumps(
+                    {'reason': reason,
+                     'journal': line.decode('utf-8', 'replace').strip()}).
+                    encode('utf-8') + b'\n')
+            rejects.flush()
+            os.fsync(rejects.fileno())
+
+
+def read_lines(path, position, max_lines):
+    """ Read at most max_lines complete lines from path, from position on.
+
+    Returns a list of (start, line) and the position after the last line.
+    """
+
+    lines = []
+    with open(path, 'rb') as segment:
+        segment.seek(position)
+        while len(lines) < max_lines:
+            line = segment.readline()
+            if not line.endswith(b'\n'):
+                break
+            lines.append((position, line))
+            position += len(line)
+    return lines, position
+
+
+def decode_lines(lines):
+    """ Decode spooled lines, returning the (line, journal) decoded and
+    the (line, reason) of the lines that are not journals.
+    """
+
+    journdicts = []
+    rejected = []
+    for _, line in lines:
+        if not line.strip():
+            continue
+        try:
+            journdicts.append((line, json.loads(line.decode('utf-8'))))
+        except ValueError as ve:
+            rejected.append((line, 'Not JSON: ' + str(ve)))
+    return journdicts, rejected
+
+
+_spool = None
+_spool_lock = threading.Lock()
+
+
+def journal_spool():
+    """ Return the spool of this process """
+
+    global _spool
+    with _spool_lock:
+        if _spool is None:
+            _spool = JournalSpool(
+                app.config['SPOOL_DIRECTORY'],
+                segment_bytes=app.config.get('SPOOL_SEGMENT_BYTES',
+                                             64 * 1024 * 1024),
+                segment_seconds=app.config.get('SPOOL_SEGMENT_SECONDS', 60))
+        return _spool
+
+
+@app.cli.command('drain-spool')
+@click.option('--batch-size', type=int, default=None,
+              help='Journals added per transaction')
+@click.option('--no-post', is_flag=True,
+              help='Only add the journals, leave posting to the workers')
+@click.option('--once', is_flag=True,
+              help='Drain what is spooled now and stop')
+def drain_spool_command(batch_size, no_post, once):
+    """ Add the spooled journals to the ledger """
+
+    if batch_size is None:
+        batch_size = app.config.get('SPOOL_DRAIN_BATCH_SIZE', 1000)
+    drainer = SpoolDrainer(app.config['SPOOL_DIRECTORY'],
+                           batch_size=batch_size, post=not no_post)
+    poll_seconds = app.config.get('SPOOL_POLL_SECONDS', 1)
+    while True:
+        try:
+            read = drainer.drain()
+        except OperationalError:
+            logging.exception('Spool not drained, database not available')
+            db.session.rollback()
+            read = 0
+        finally:
+            db.session.remove()
+        if once:
+            click.echo('{0} journal(s) drained'.format(read))
+            return
+        if not read:
+            time.sleep(poll_seconds)
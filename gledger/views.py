@@ -1,14 +1,26 @@
 """ This module contains the routes that can be visited using the browser.
 Each route has a clear purpose, geared to different uses.
+
+The pages that are polled most (balance, postings, journal and account
+list) carry an ETag and Last-Modified made from the update timestamps
+of the data shown. A client asking again with these gets 304 Not
+Modified, which is decided with one small query, before the page is
+built.
 """
 
 import logging
-from flask import render_template, flash, request, redirect, url_for, abort
+from hashlib import sha1
+from flask import render_template, flash, request, redirect, url_for, abort,\
+    make_response, session, get_flashed_messages, Response, stream_with_context
+from werkzeug.http import is_resource_modified
 import glmodels.glaccount as accmodel
 import glmodels.glposting as journalmodel
-from glviews.accountviews import AccountView, AccountListView, BalanceView
+from glmodels.glrates import MissingRateError
+from glmodels import glmetrics
+from glviews.accountviews import AccountView, AccountListView, BalanceView,\
+    TrialBalanceView
 from glviews.postingviews import JournalView, PostingView,\
-    PostingByAccountView, JournalListView
+    PostingByAccountView, JournalListView, PostingExport
 from glviews.forms import AccountForm, NewAccountForm, SearchForm,\
     JournalSearch
 from werkzeug.exceptions import BadRequest
@@ -16,6 +28,46 @@ from . import app, db
 from glviews.tempview import PostmonthListView
 
 
+class PageValidator():
+    """ The validators (ETag and Last-Modified) of a page, to answer a
+    conditional request with 304 Not Modified before the page is built.
+
+    The ETag is made from the parts passed, which must include whatever
+    changes when the data on the page changes. A page showing flashed
+    messages gets no validators.
+    """
+
+    def __init__(self, *parts, last_modified=None):
+
+        self.etag = sha1(repr(parts).encode('utf-8')).hexdigest()
+        self.last_modified = last_modified
+
+    def unchanged(self):
+        """ Does the client have the current version of the page? """
+
+        if session.get('_flashes'):
+            return False
+        return not is_resource_modified(request.environ, etag=self.etag,
+                                        last_modified=self.last_modified)
+
+    def not_modified(self):
+        """ Return the 304 Not Modified response """
+
+        return self.apply(make_response('', 304))
+
+    def apply(self, page):
+        """ Return the response for page, with the validators """
+
+        response = make_response(page)
+        if get_flashed_messages():
+            return response
+        response.set_etag(self.etag)
+        if self.last_modified:
+            response.last_modified = self.last_modified
+        response.cache_control.no_cache = True
+        return response
+
+
 @app.route('/')
 def index():
     """This is the index page of the application. It shows
@@ -58,12 +110,17 @@ def accountlist():
     """
 
     search_for = request.args.get('search_for')
-    search_form = SearchForm()
     page_nr = request.args.get('page')
     if page_nr is None:
         page_nr = 1
     else:
         page_nr = int(page_nr)
+    last_change, num_accounts = accmodel.Accounts.last_change()
+    validator = PageValidator('accountlist', search_for, page_nr, last_change,
+                              num_accounts, last_modified=last_change)
+    if validator.unchanged():
+        return validator.not_modified()
+    search_form = SearchForm()
 
     try:
         account_list = AccountListView(search_string=search_for, page=page_nr)
@@ -76,8 +133,9 @@ def accountlist():
                                accountlist=account_list)
     if search_for:
         search_form.search_for.data = search_for
-    return render_template('accountlist.html', search_form=search_form,
-                           accountlist=account_list)
+    return validator.apply(render_template('accountlist.html',
+                                           search_form=search_form,
+                                           accountlist=account_list))
 
 @app.route('/accounts/<account_name>', methods=['GET', 'POST'], strict_slashes=False)
 def accounts(account_name=None):
@@ -137,17 +195,65 @@ def balance(account_name, postmonth=None):
 
     if account_name is None:
         abort(404, 'An account name is mandatory')
-    search_form = SearchForm()
     if postmonth is None:
         for_month = accmodel.postmonth_today()
     else:
         for_month = accmodel.Postmonths.internal(postmonth)
+    try:
+        account_key = accmodel.account_keys.by_name(account_name)
+    except accmodel.NoAccountError as content_error:
+        abort(400, str(content_error))
+    snapshot_change = None
+    if accmodel.Postmonths.status_of(for_month) == accmodel.Postmonths.CLOSED:
+        snapshot_change = accmodel.UltimoBalances.last_change(for_month)
+    if snapshot_change is not None:
+        validator = PageValidator('balance', account_key, for_month,
+                                  accmodel.Postmonths.CLOSED, snapshot_change,
+                                  last_modified=snapshot_change)
+    else:
+        last_change, num_balances, rates_change =\
+            accmodel.Balances.last_change(account_key.id, for_month)
+        validator = PageValidator('balance', account_key, for_month,
+                                  last_change, num_balances, rates_change,
+                                  last_modified=max(
+                                      (change for change in
+                                       (last_change, rates_change)
+                                       if change is not None),
+                                      default=None))
+    if validator.unchanged():
+        return validator.not_modified()
+    search_form = SearchForm()
     try:
         balance_view = BalanceView.create_view(name=account_name,
-                                               postmonth=for_month)
-    except (accmodel.NoAccountError, accmodel.InvalidPostmonthError) as content_error:
+                                               postmonth=for_month,
+                                               version=validator.etag)
+    except (accmodel.NoAccountError, accmodel.InvalidPostmonthError,
+            MissingRateError) as content_error:
         abort(400, str(content_error))
-    return render_template('balance.html', balanceview=balance_view.as_dictionary(),
+    return validator.apply(render_template('balance.html',
+                                           balanceview=balance_view.as_dictionary(),
+                                           search_form=search_form))
+
+@app.route('/trialbalance/month/<postmonth>', strict_slashes=False)
+@app.route('/trialbalance', strict_slashes=False)
+def trialbalance(postmonth=None):
+    """ This route shows the trial balance
+
+    For every account the balance at the end of the postmonth is shown,
+    with subtotals for the accounts below it. If no month is given, it
+    shows the current balances.
+    """
+
+    search_form = SearchForm()
+    try:
+        if postmonth is None:
+            for_month = accmodel.postmonth_today()
+        else:
+            for_month = accmodel.Postmonths.internal(postmonth)
+        trialbalance = TrialBalanceView(postmonth=for_month)
+    except (accmodel.InvalidPostmonthError, MissingRateError) as content_error:
+        abort(400, str(content_error))
+    return render_template('trialbalance.html', trialbalance=trialbalance,
                            search_form=search_form)
 
 @app.route('/posts/<account_name>', strict_slashes=False)
@@ -159,21 +265,82 @@ def posts(account_name, postmonth=None):
     The postings for the account and the month given
     are returned. If no month is requested, it defaults to
     use the current month, but also shows postings of previous
-    months.
+    months. The page is given by number (page) or, to page
+    through many postings, by the cursor from the page before
+    (cursor).
     """
 
-    search_form = SearchForm()
+    cursor = request.args.get('cursor')
+    page_nr = request.args.get('page')
+    if page_nr is None:
+        page_nr = 1
+    else:
+        try:
+            page_nr = int(page_nr)
+        except ValueError:
+            abort(400, 'Invalid page ' + page_nr)
     try:
         account = accmodel.Accounts.get_by_name(account_name)
     except accmodel.NoAccountError as content_error:
         abort(400, str(content_error))
     try:
-        by_account_view = PostingByAccountView(account, month=postmonth).as_dict()
+        last_change, num_postings =\
+            journalmodel.Postings.last_change(account.id, month=postmonth)
+    except accmodel.InvalidPostmonthError:
+        last_change, num_postings = None, None
+    validator = PageValidator('posts', account.id, account.updated_at,
+                              postmonth, page_nr, cursor, last_change,
+                              num_postings, last_modified=last_change)
+    if validator.unchanged():
+        return validator.not_modified()
+    search_form = SearchForm()
+    try:
+        by_account_view = PostingByAccountView.cached_dict(
+            account, month=postmonth, page=page_nr, cursor=cursor,
+            version=validator.etag)
+    except journalmodel.InvalidCursorError as content_error:
+        abort(400, str(content_error))
     except accmodel.InvalidPostmonthError as content_error:
         flash(str(content_error))
         by_account_view = None
-    return render_template('accountpostings.html', search_form=search_form,
-                           posting_list=by_account_view)
+    return validator.apply(render_template('accountpostings.html',
+                                           search_form=search_form,
+                                           posting_list=by_account_view))
+
+@app.route('/export/<account_name>', methods=['GET'])
+def export(account_name):
+    """ Export the postings of an account.
+
+    The format argument is csv (the default) or ndjson. With subtree=yes
+    the postings of the accounts below the account are exported too.
+    The months from and to (mm-yyyy) limit the export to a range of
+    months. The export is streamed, so it may be of any size.
+    """
+
+    try:
+        account = accmodel.Accounts.get_by_name(account_name)
+        posting_export = PostingExport(account,
+            export_format=request.args.get('format', 'csv'),
+            subtree=request.args.get('subtree') == 'yes',
+            from_month=request.args.get('from'),
+            to_month=request.args.get('to'))
+    except ValueError as content_error:
+        abort(400, str(content_error))
+    filename = '{0}.{1}'.format(account.name, posting_export.export_format)
+    return Response(stream_with_context(posting_export.lines()),
+                    mimetype=posting_export.mimetype,
+                    headers={'Content-Disposition':
+                             'attachment; filename="' + filename + '"'})
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """ Show the metrics of this process in the Prometheus text format
+
+    The metrics of the posting workers are served by the workers (see
+    gledger.postingworker).
+    """
+
+    return Response(glmetrics.render(), mimetype=glmetrics.CONTENT_TYPE)
 
 @app.route('/journal/<journalkey>', methods=['GET'])
 def journal(journalkey):
@@ -182,6 +349,14 @@ def journal(journalkey):
     The journalkey is the external key of the journal requested
     """
 
+    journal_state = journalmodel.Journals.state_of(journalkey)
+    if journal_state:
+        validator = PageValidator('journal', journalkey,
+                                  journal_state.updated_at,
+                                  journal_state.journalstat,
+                                  last_modified=journal_state.updated_at)
+        if validator.unchanged():
+            return validator.not_modified()
     search_form = SearchForm()
     journal_search = JournalSearch()
     if journalkey:
@@ -194,9 +369,12 @@ def journal(journalkey):
     else:
         flash('An existing journal key is required')
         journal_view = None
-    return render_template('journalpostings.html', search_form=search_form,
+    page = render_template('journalpostings.html', search_form=search_form,
                            journal_view=journal_view,
                            journal_search=journal_search)
+    if journal_state:
+        return validator.apply(page)
+    return page
 
 @app.route('/journallist', methods=['GET'])
 def journallist():
@@ -237,6 +415,8 @@ def postmonthlist():
             accmodel.Postmonths.update_from_dict(request.form)
         except accmodel.InvalidPostmonthError as ipe:
             abort(400)
+        except MissingRateError as rate_error:
+            abort(400, str(rate_error))
         db.session.commit()
     kws = dict()
     if from_month:
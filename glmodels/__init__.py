@@ -41,3 +41,15 @@ class PaginatorMixin():
         if rem > 0:
             np = np +1
         return np
+
+
+def chunked(items, size=500):
+    """ Return the items in lists of at most size items.
+
+    Used to keep "in" lists of bulk queries within the limits some
+    databases put on them.
+    """
+
+    items = list(items)
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
@@ -24,12 +24,19 @@ The postmonths are items that contain functions to process the
 posting periods.
 """
 
+import calendar
 import logging
+from collections import namedtuple
 from datetime import date, datetime
+from sqlalchemy import and_, event, func, inspect, or_
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import validates
 from sqlalchemy.orm.exc import NoResultFound
-from gledger import db
-from glmodels import PaginatorMixin
+from gledger import app, db
+from glmodels import PaginatorMixin, chunked
+from glmodels.glcache import LRUCache, view_results
+from glmodels.glmetrics import Counter
+from glmodels.glrates import Rates, exchange_rates
 
 query = db.session.query
 
@@ -165,8 +172,17 @@ class Accounts(db.Model):
         if parent:
             parent.children.append(account)
         account.add()
+        account_keys.invalidate(name=name)
         return account
 
+    @classmethod
+    def last_change(cls):
+        """ Return the time of the last change to an account and the
+        number of accounts.
+        """
+
+        return query(func.max(Accounts.updated_at), func.count(Accounts.id)).one()
+
     @classmethod
     def account_exists(cls, requested_id=None, requested_name=None):
         """ Return if an account exists, presented with an ID or
@@ -180,6 +196,41 @@ class Accounts(db.Model):
                         == [])
         raise NoAccountError('An account id or name is mandatory')
 
+    @classmethod
+    def latest_balances(cls, roles=None, limit=None, after_id=None,
+                        postmonth=None):
+        """ Return the last known balance of accounts, read in one query.
+
+        The balance is the one at the end of postmonth, if given. The
+        accounts may be limited to those with one of the roles and
+        to a number of accounts. A list of AccountBalance is returned,
+        one for every currency the account has a balance in, in order of
+        account id and currency, starting after account after_id if
+        given. Accounts without balance have balance 0 in the ledger
+        currency.
+        """
+
+        selected = query(Accounts.id)
+        if roles:
+            selected = selected.filter(Accounts.role.in_(roles))
+        if after_id is not None:
+            selected = selected.filter(Accounts.id > after_id)
+        if limit:
+            selected = selected.order_by(Accounts.id).limit(limit)
+        selected = selected.subquery()
+        latest = Balances.latest(postmonth)
+        balances = query(Accounts.id, Accounts.name, Accounts.role,
+                         Balances.currency, Balances.amount).\
+            join(selected, selected.c.id == Accounts.id).\
+            outerjoin(latest, latest.c.account_id == Accounts.id).\
+            outerjoin(Balances, and_(Balances.account_id == latest.c.account_id,
+                                     Balances.currency == latest.c.currency,
+                                     Balances.postmonth == latest.c.postmonth)).\
+            order_by(Accounts.id, Balances.currency)
+        return [AccountBalance(row.id, row.name, row.role, int(row.amount or 0),
+                               row.currency or exchange_rates.currency)
+                for row in balances]
+
     def _balance_for(self):
         """ Set up a query for the balance(s) of this account """
 
@@ -228,25 +279,58 @@ class Accounts(db.Model):
         if new_role:
             self.role = new_role
             self.updated_at = datetime.today()
+            account_keys.invalidate(name=self.name, id=self.id)
 
     def current_balance(self):
-        """ Return the last known balance of the account """
+        """ Return the last known balance of the account
+
+        The last known balance in every currency is converted to the
+        ledger currency at the rates of today.
+        """
 
-        balance_last_known = self._balance_for().order_by(Balances.postmonth.desc())\
-            .all()
-        if balance_last_known == []:
+        latest = query(Balances.currency,
+                       func.max(Balances.postmonth).label('postmonth')).\
+            filter(Balances.account_id == self.id).\
+            group_by(Balances.currency).subquery()
+        balances = query(Balances.currency, Balances.amount).\
+            join(latest, and_(Balances.currency == latest.c.currency,
+                              Balances.postmonth == latest.c.postmonth)).\
+            filter(Balances.account_id == self.id).all()
+        if balances == []:
             return 0
-        return balance_last_known[0].amount
+        return exchange_rates.total(balances, date.today())
 
     def balance_ultimo(self, postmonth, balance_so_far=0):
-        """ Return the balance of the account at the end of the postmonth """
-
-        balance_requested = self._balance_for().filter(Balances.postmonth <=
-                            postmonth).order_by(Balances.postmonth.desc()).all()
-        if balance_requested != []:
-            balance_so_far += balance_requested[0].amount
-        for child in self.children:
-            balance_so_far = child.balance_ultimo(postmonth, balance_so_far)
+        """ Return the balance of the account at the end of the postmonth
+
+        The balance includes the balances of all accounts below this
+        one in the hierarchy, in the ledger currency. For a closed month
+        it is read from the snapshot made when the month was closed.
+        Otherwise it is summed per currency in one query, from the last
+        balance at or before the postmonth for every account in the
+        subtree, and converted at the rates of the last day of the
+        postmonth.
+        """
+
+        if Postmonths.status_of(postmonth) == Postmonths.CLOSED:
+            ultimo = query(UltimoBalances).get((self.id, int(postmonth)))
+            if ultimo is not None:
+                return balance_so_far + ultimo.subtree_amount
+        subtree = query(AccountTree.descendant_id).\
+            filter(AccountTree.ancestor_id == self.id)
+        latest = query(Balances.account_id, Balances.currency,
+                       func.max(Balances.postmonth).label('postmonth')).\
+            filter(Balances.account_id.in_(subtree)).\
+            filter(Balances.postmonth <= postmonth).\
+            group_by(Balances.account_id, Balances.currency).subquery()
+        subtree_balances = query(Balances.currency, func.sum(Balances.amount)).\
+            join(latest, and_(Balances.account_id == latest.c.account_id,
+                              Balances.currency == latest.c.currency,
+                              Balances.postmonth == latest.c.postmonth)).\
+            group_by(Balances.currency).all()
+        if subtree_balances:
+            balance_so_far += exchange_rates.total(subtree_balances,
+                                                   last_day_of(postmonth))
         return balance_so_far
 
     def debit_credit(self):
@@ -272,27 +356,169 @@ class Accounts(db.Model):
 
         return (self.debit_credit() == 'Cr')
 
-    def post_amount(self, debit_credit, post_amount, value_date):
+    def post_amount(self, debit_credit, post_amount, value_date,
+                    currency=None):
         """Post an amount to this account.
 
         This is a transaction script. The script runs as follows:
-        1. Get the balance row for the postmonth
+        1. Get the balance row for the postmonth and currency (the
+           ledger currency if not passed)
         2. apply the amount (using a function) to this row
         3. return the new balance
         """
 
+        if currency is None:
+            currency = exchange_rates.currency
         postmonth = postmonth_for(value_date)
         balance_requested = self._balance_for().\
-            filter_by(postmonth=postmonth).\
-            order_by(Balances.postmonth.desc()).first()
+            filter_by(postmonth=postmonth, currency=currency).first()
         if balance_requested is None:
             balance_requested = Balances(account_id=self.id,
                                          postmonth=postmonth, amount=0,
+                                         currency=currency,
                                          value_date=datetime.today())
             balance_requested.add()
         balance_requested.update_with(debit_credit, post_amount)
         return balance_requested.amount
 
+class AccountTree(db.Model):
+    """ The account hierarchy as a closure table.
+
+    Next to the parent_id of the account, the hierarchy is kept as a
+    row for every account and each of its ancestors, including the
+    account itself. The rows for an account are its path to the top, the
+    rows for an ancestor the full subtree below it. That makes the
+    subtree of an account one simple query, without walking the
+    children.
+
+    AccountTree has the following fields:
+        :ancestor_id: the id of the account higher up (or the same)
+        :descendant_id: the id of the account below it
+        :depth: the number of levels between the two, 0 for the account
+            itself
+
+    The rows are maintained on flush, when an account is created (e.g.
+    by Accounts.create_account), its parent changes (e.g. by
+    Accounts.update_role_or_parent) or it is deleted.
+    """
+
+    __tablename__ = 'accttree'
+    ancestor_id = db.Column(db.Integer, db.ForeignKey('accounts.id'),
+                            primary_key=True)
+    descendant_id = db.Column(db.Integer, db.ForeignKey('accounts.id'),
+                              primary_key=True)
+    depth = db.Column(db.Integer, nullable=False)
+    __table_args__ = (db.Index('bydescendant', 'descendant_id',
+                               'ancestor_id'),)
+
+    @classmethod
+    def add_account(cls, connection, account_id, parent_id):
+        """ Add the paths for a new account below parent_id """
+
+        rows = [{'ancestor_id': account_id, 'descendant_id': account_id,
+                 'depth': 0}]
+        if parent_id is not None:
+            for ancestor_id, depth in connection.execute(
+                    db.select([cls.ancestor_id, cls.depth]).
+                    where(cls.descendant_id == parent_id)):
+                rows.append({'ancestor_id': ancestor_id,
+                             'descendant_id': account_id, 'depth': depth + 1})
+        connection.execute(cls.__table__.insert(), rows)
+
+    @classmethod
+    def move_account(cls, connection, account_id, parent_id):
+        """ Move the subtree of an account below another parent
+
+        The snapshots of closed months are moved along (see
+        UltimoBalances.move_subtree).
+        """
+
+        subtree = dict(connection.execute(
+            db.select([cls.descendant_id, cls.depth]).
+            where(cls.ancestor_id == account_id)).fetchall())
+        if not subtree:
+            cls.add_account(connection, account_id, parent_id)
+            return
+        old_ancestors = [ancestor_id for ancestor_id, in connection.execute(
+            db.select([cls.ancestor_id]).
+            where(cls.descendant_id == account_id).
+            where(cls.ancestor_id != account_id))]
+        for id_list in chunked(subtree):
+            connection.execute(cls.__table__.delete().
+                where(cls.descendant_id.in_(id_list)).
+                where(~cls.ancestor_id.in_(list(subtree))))
+        ancestors = []
+        if parent_id is not None:
+            ancestors = connection.execute(
+                db.select([cls.ancestor_id, cls.depth]).
+                where(cls.descendant_id == parent_id)).fetchall()
+        rows = [{'ancestor_id': ancestor_id, 'descendant_id': descendant_id,
+                 'depth': depth + subdepth + 1}
+                for ancestor_id, depth in ancestors
+                for descendant_id, subdepth in subtree.items()]
+        if rows:
+            connection.execute(cls.__table__.insert(), rows)
+        UltimoBalances.move_subtree(connection, account_id, old_ancestors,
+                                    [ancestor_id for ancestor_id, _
+                                     in ancestors])
+
+    @classmethod
+    def rebuild(cls):
+        """ Build the closure table again from the parent ids.
+
+        Use it once to fill the table for accounts created before the
+        table existed.
+        """
+
+        db.session.execute(cls.__table__.delete())
+        parents = dict(query(Accounts.id, Accounts.parent_id).all())
+        rows = []
+        for account_id in parents:
+            ancestor_id, depth = account_id, 0
+            while ancestor_id is not None and depth <= len(parents):
+                rows.append({'ancestor_id': ancestor_id,
+                             'descendant_id': account_id, 'depth': depth})
+                ancestor_id, depth = parents.get(ancestor_id), depth + 1
+        for row_list in chunked(rows):
+            db.session.execute(cls.__table__.insert(), row_list)
+
+
+@event.listens_for(db.session, 'before_flush')
+def remove_from_account_tree(session, flush_context, instances):
+    """ Remove deleted accounts from the closure table """
+
+    deleted_ids = [account.id for account in session.deleted
+                   if isinstance(account, Accounts)]
+    for id_list in chunked(deleted_ids):
+        session.execute(AccountTree.__table__.delete().
+            where(or_(AccountTree.ancestor_id.in_(id_list),
+                      AccountTree.descendant_id.in_(id_list))))
+
+
+@event.listens_for(db.session, 'after_flush')
+def maintain_account_tree(session, flush_context):
+    """ Keep the closure table in step with the parent ids of accounts """
+
+    new_accounts = {account.id: account for account in session.new
+                    if isinstance(account, Accounts)}
+    moved_accounts = [account for account in session.dirty
+                      if isinstance(account, Accounts) and
+                      inspect(account).attrs.parent_id.history.has_changes()]
+    if not new_accounts and not moved_accounts:
+        return
+    connection = session.connection()
+
+    def level(account):
+        # Parents created in the same flush go first
+        parent = new_accounts.get(account.parent_id)
+        return 0 if parent is None else level(parent) + 1
+
+    for account in sorted(new_accounts.values(), key=level):
+        AccountTree.add_account(connection, account.id, account.parent_id)
+    for account in moved_accounts:
+        AccountTree.move_account(connection, account.id, account.parent_id)
+
+
 class Balances(db.Model):
     """Balances model the balances at different moments in time
 
@@ -305,6 +531,9 @@ class Balances(db.Model):
     month. If a record for an older month is returned, that is the current
     balance; no postings for the current month have been received.
 
+    An account has a balance per currency it receives postings in. The
+    reports convert them to the ledger currency (see glmodels.glrates).
+
     Balances have the following fields:
         :id: a sequence number
         :account_id: the sequence number of the account this is the balance of
@@ -317,10 +546,13 @@ class Balances(db.Model):
     id = db.Column(db.Integer, db.Sequence('balance_id_seq'), primary_key=True)
     account_id = db.Column(db.Integer, db.ForeignKey('accounts.id'), nullable=False)
     postmonth = db.Column(db.Numeric(precision=6))
+    currency = db.Column(db.String(3), nullable=False,
+                         default=exchange_rates.currency)
     value_date = db.Column(db.DateTime, nullable=False)
     amount = db.Column(db.Numeric(precision=14))
     updated_at = db.Column(db.DateTime)
-    __table_args__ = (db.Index('bymonth', 'account_id', 'postmonth'),)
+    __table_args__ = (db.Index('bymonth', 'account_id', 'postmonth',
+                               'currency', unique=True),)
 
     @validates('postmonth')
     def validate_postmonth(self, id, postmonth):
@@ -328,9 +560,74 @@ class Balances(db.Model):
         month
         """
 
-        months_db = query(Postmonths).filter_by(postmonth=postmonth).all()
-        if (months_db != []):
-            if months_db[0].status_can_post():
+        return self.check_postmonth(postmonth)
+
+    @staticmethod
+    def last_change(account_id, postmonth):
+        """ Return the time of the last change and the number of the
+        balances, up to postmonth, of the account and the accounts below it,
+        and the time a rate was last set, as the balance is converted.
+        """
+
+        subtree = query(AccountTree.descendant_id).\
+            filter(AccountTree.ancestor_id == account_id)
+        return query(func.max(Balances.updated_at), func.count(Balances.id),
+                     query(func.max(Rates.updated_at)).as_scalar()).\
+            filter(Balances.account_id.in_(subtree)).\
+            filter(Balances.postmonth <= postmonth).one()
+
+    @staticmethod
+    def latest(postmonth=None):
+        """ Return a subquery of the postmonth of the last balance of each
+        account in each currency (account_id, currency, postmonth), at or
+        before postmonth if given.
+        """
+
+        latest = query(Balances.account_id, Balances.currency,
+                       func.max(Balances.postmonth).label('postmonth'))
+        if postmonth is not None:
+            latest = latest.filter(Balances.postmonth <= postmonth)
+        return latest.group_by(Balances.account_id, Balances.currency).\
+            subquery()
+
+    @staticmethod
+    def check_postmonth(postmonth):
+        """ Check a balance may be made for the postmonth.
+
+        That is the current month or an existing, active month.
+        """
+
+        return Balances._check_monthstat(postmonth,
+                                         Postmonths.status_of(postmonth))
+
+    @staticmethod
+    def check_postmonths(postmonths):
+        """ Check balances may be made for all of the postmonths.
+
+        The status of the months is read from the database in one query,
+        not from the cache, so a month closed by another process a moment
+        ago is not posted to. The statuses read are put in the cache.
+        """
+
+        postmonths = {int(postmonth) for postmonth in postmonths}
+        monthstats = dict()
+        for id_list in chunked(postmonths):
+            monthstats.update(query(Postmonths.postmonth,
+                                    Postmonths.monthstat).
+                              filter(Postmonths.postmonth.in_(id_list)))
+        for postmonth in sorted(postmonths):
+            monthstat = monthstats.get(postmonth, '')
+            postmonth_status.put(postmonth, monthstat)
+            Balances._check_monthstat(postmonth, monthstat)
+
+    @staticmethod
+    def _check_monthstat(postmonth, monthstat):
+        """ Check a balance may be made for the postmonth with the
+        monthstat ('' if the month does not exist)
+        """
+
+        if monthstat:
+            if monthstat == Postmonths.ACTIVE:
                 return postmonth
             raise ValueError('Postmonth not active')
         current_postmonth = postmonth_for(date.today())
@@ -355,9 +652,394 @@ class Balances(db.Model):
         else:
             self.amount -= post_amount
 
+    @classmethod
+    def apply_amounts(cls, amounts):
+        """ Apply net amounts to the balances of many accounts at once.
+
+        The amounts are a dictionary keyed by (account id, postmonth,
+        currency) with the net debit amount as value: debits count
+        positive, credits negative. The accounts and the balance rows are
+        read in bulk and each balance row is updated once. Missing
+        balance rows are created. Returns the balance rows, keyed like
+        the amounts.
+
+        The balance rows are read for update, in key order, so another
+        transaction posting to them waits for this one instead of writing
+        back an amount it read before.
+        """
+
+        account_ids = sorted({account_id for (account_id, _, _) in amounts})
+        postmonths = {postmonth for (_, postmonth, _) in amounts}
+        accounts = account_keys.by_ids(account_ids)
+        balances = dict()
+        for id_list in chunked(account_ids):
+            balance_rows = query(Balances).\
+                filter(Balances.account_id.in_(id_list)).\
+                filter(Balances.postmonth.in_(postmonths)).\
+                order_by(Balances.account_id, Balances.postmonth,
+                         Balances.currency).\
+                with_for_update().populate_existing()
+            for balance in balance_rows:
+                balances[(balance.account_id, balance.postmonth,
+                          balance.currency)] = balance
+        for key, amount in amounts.items():
+            balance = balances.get(key)
+            if balance is None:
+                account_id, postmonth, currency = key
+                balance = cls(account_id=account_id, postmonth=postmonth,
+                              currency=currency, amount=0,
+                              value_date=datetime.today())
+                balance.add()
+                balance_rows_created.on_commit(db.session)
+                balances[key] = balance
+            if accounts[balance.account_id].is_debit():
+                balance.amount += amount
+            else:
+                balance.amount -= amount
+            balance.updated_at = datetime.today()
+        return balances
+
+    @classmethod
+    def apply_amounts_atomic(cls, amounts):
+        """ Apply net amounts to balances with increments in the database.
+
+        The amounts are keyed like for apply_amounts. Instead of reading
+        the balance rows, each row is updated with "amount = amount +
+        delta" in SQL, so concurrent posting processes can neither lose
+        each others updates nor hold locks on rows they have read. A
+        missing balance row is inserted; if another process inserted it
+        first, the increment is applied to that row. Rows are updated in
+        key order, so processes lock them in the same order.
+
+        Balance instances already in the session are expired, so they
+        are read again when used.
+        """
+
+        db.session.flush()
+        accounts = account_keys.by_ids({account_id for (account_id, _, _)
+                                        in amounts})
+        for (account_id, postmonth, currency) in sorted(amounts):
+            amount = amounts[(account_id, postmonth, currency)]
+            if accounts[account_id].is_debit():
+                delta = amount
+            else:
+                delta = -amount
+            if cls._increment(account_id, postmonth, currency, delta) == 0:
+                cls.check_postmonth(postmonth)
+                try:
+                    with db.session.begin_nested():
+                        db.session.execute(cls.__table__.insert().values(
+                            account_id=account_id, postmonth=postmonth,
+                            currency=currency, amount=delta,
+                            value_date=datetime.today(),
+                            updated_at=datetime.today()))
+                    balance_rows_created.on_commit(db.session)
+                except IntegrityError:
+                    cls._increment(account_id, postmonth, currency, delta)
+        for instance in list(db.session.identity_map.values()):
+            if isinstance(instance, cls) and (instance.account_id,
+                    instance.postmonth, instance.currency) in amounts:
+                db.session.expire(instance)
+        view_results.changed(db.session)
+
+    @classmethod
+    def _increment(cls, account_id, postmonth, currency, delta):
+        """ Add delta to a balance row in the database.
+
+        Returns the number of rows updated.
+        """
+
+        result = db.session.execute(cls.__table__.update().
+            where(cls.account_id == account_id).
+            where(cls.postmonth == postmonth).
+            where(cls.currency == currency).
+            values(amount=cls.amount + delta, updated_at=datetime.today()))
+        return result.rowcount
+
     def __repr__(self):
-        return 'Balances(amount = {}, postmonth = {}, account {})'.\
-            format(self.amount, self.postmonth, self.account_id)
+        return 'Balances(amount = {} {}, postmonth = {}, account {})'.\
+            format(self.currency, self.amount, self.postmonth, self.account_id)
+
+balance_rows_created = Counter('gledger_balance_rows_created_total',
+                               'Balance rows created by posting')
+
+
+class UltimoBalances(db.Model):
+    """ The balances of the accounts at the end of a closed postmonth.
+
+    When a postmonth is closed, the ultimo balance of every account is
+    written here, both the balance of the account itself (amount) and
+    of the account with all accounts below it (subtree_amount). As no
+    more postings are made to a closed month, these do not change; a
+    historic balance is then read by its key instead of being summed
+    from the balance rows. Reopening the month removes its snapshot.
+
+    The amounts are in the ledger currency, converted at the rates of the
+    last day of the postmonth. When a rate is set that applies to that
+    day, the snapshot is written again (see resnapshot_for_rates).
+
+    Fields:
+        :account_id: the id of the account
+        :postmonth: the closed postmonth
+        :amount: the balance of the account
+        :subtree_amount: the balance of the account and its descendants
+    """
+
+    __tablename__ = 'ultimobalances'
+    account_id = db.Column(db.Integer, db.ForeignKey('accounts.id'),
+                           primary_key=True)
+    postmonth = db.Column(db.Integer, primary_key=True)
+    amount = db.Column(db.Numeric(precision=14), nullable=False)
+    subtree_amount = db.Column(db.Numeric(precision=14), nullable=False)
+    created_at = db.Column(db.DateTime, nullable=False)
+
+    @classmethod
+    def snapshot(cls, postmonth):
+        """ Write the ultimo balances of all accounts for the postmonth.
+
+        A snapshot already present for the month is replaced. The
+        balances are read in two queries, one for the accounts and one
+        for the subtrees, both per currency, converted in one go and
+        inserted in bulk. Accounts that never had a balance in their
+        subtree are left out.
+        """
+
+        postmonth = int(postmonth)
+        cls.discard(postmonth)
+        latest = Balances.latest(postmonth)
+        own = query(Balances.account_id, Balances.currency, Balances.amount).\
+            join(latest, and_(Balances.account_id == latest.c.account_id,
+                              Balances.currency == latest.c.currency,
+                              Balances.postmonth == latest.c.postmonth)).all()
+        subtree = query(AccountTree.ancestor_id, Balances.currency,
+                        func.sum(Balances.amount)).\
+            join(latest, latest.c.account_id == AccountTree.descendant_id).\
+            join(Balances, and_(Balances.account_id == latest.c.account_id,
+                                Balances.currency == latest.c.currency,
+                                Balances.postmonth == latest.c.postmonth)).\
+            group_by(AccountTree.ancestor_id, Balances.currency).all()
+        on_date = last_day_of(postmonth)
+        amounts = dict()
+        subtree_amounts = dict()
+        for (account_id, _, _), amount in zip(own, exchange_rates.convert(
+                [(currency, amount) for _, currency, amount in own], on_date)):
+            amounts[account_id] = amounts.get(account_id, 0) + amount
+        for (account_id, _, _), amount in zip(subtree, exchange_rates.convert(
+                [(currency, amount) for _, currency, amount in subtree],
+                on_date)):
+            subtree_amounts[account_id] = subtree_amounts.get(account_id, 0)\
+                + amount
+        created_at = datetime.today()
+        rows = [{'account_id': account_id, 'postmonth': postmonth,
+                 'amount': amounts.get(account_id, 0),
+                 'subtree_amount': subtree_amount,
+                 'created_at': created_at}
+                for account_id, subtree_amount in subtree_amounts.items()]
+        for chunk in chunked(rows):
+            db.session.execute(cls.__table__.insert(), chunk)
+        return len(rows)
+
+    @classmethod
+    def move_subtree(cls, connection, account_id, old_ancestors,
+                     new_ancestors):
+        """ Move the subtree amounts of an account in all snapshots from
+        its old ancestors to its new ones.
+
+        The subtree of the account itself does not change, so in every
+        snapshot its subtree amount is taken off the old ancestors and
+        added to the new ones; a new ancestor without a row in the
+        snapshot gets one. The rows changed get a new created_at, and the
+        views cached as final are dropped.
+        """
+
+        moved = dict(connection.execute(
+            db.select([cls.postmonth, cls.subtree_amount]).
+            where(cls.account_id == account_id)).fetchall())
+        if not moved:
+            return
+        created_at = datetime.today()
+        existing = set()
+        for id_list in chunked(new_ancestors):
+            existing.update(connection.execute(
+                db.select([cls.account_id, cls.postmonth]).
+                where(cls.account_id.in_(id_list))).fetchall())
+        for postmonth, amount in moved.items():
+            for ancestors, delta in [(old_ancestors, -amount),
+                                     (new_ancestors, amount)]:
+                for id_list in chunked(ancestors):
+                    connection.execute(cls.__table__.update().
+                        where(cls.postmonth == postmonth).
+                        where(cls.account_id.in_(id_list)).
+                        values(subtree_amount=cls.subtree_amount + delta,
+                               created_at=created_at))
+            rows = [{'account_id': ancestor_id, 'postmonth': postmonth,
+                     'amount': 0, 'subtree_amount': amount,
+                     'created_at': created_at}
+                    for ancestor_id in new_ancestors
+                    if (ancestor_id, postmonth) not in existing]
+            if rows:
+                connection.execute(cls.__table__.insert(), rows)
+        view_results.clear()
+
+    @staticmethod
+    def converted_with(currency, rate_date):
+        """ Return the postmonths with a snapshot converted with the rate
+        of currency from rate_date, up to the next rate of the currency.
+        """
+
+        next_date = query(func.min(Rates.rate_date)).\
+            filter(Rates.currency == currency).\
+            filter(Rates.rate_date > rate_date).scalar()
+        months = query(UltimoBalances.postmonth).distinct().\
+            filter(UltimoBalances.postmonth >= postmonth_for(rate_date))
+        if next_date is not None:
+            months = months.filter(
+                UltimoBalances.postmonth < postmonth_for(next_date))
+        return [postmonth for postmonth, in months]
+
+    @staticmethod
+    def last_change(postmonth):
+        """ Return the time the snapshot of the postmonth last changed """
+
+        return query(func.max(UltimoBalances.created_at)).\
+            filter(UltimoBalances.postmonth == int(postmonth)).scalar()
+
+    @classmethod
+    def discard(cls, postmonth):
+        """ Remove the snapshot of the postmonth """
+
+        query(cls).filter(cls.postmonth == int(postmonth)).\
+            delete(synchronize_session='fetch')
+
+
+@event.listens_for(db.session, 'after_flush')
+def resnapshot_for_rates(session, flush_context):
+    """ Write the snapshots converted with a rate set or replaced again,
+    so a closed month reports the same balance as its trial balance.
+    """
+
+    rates = [rate for rate in list(session.new) + list(session.dirty)
+             if isinstance(rate, Rates)]
+    if not rates:
+        return
+    exchange_rates.clear()
+    postmonths = set()
+    for rate in rates:
+        postmonths.update(UltimoBalances.converted_with(rate.currency,
+                                                        rate.rate_date))
+    for postmonth in sorted(postmonths):
+        UltimoBalances.snapshot(postmonth)
+
+
+class AccountKey(namedtuple('AccountKey', ['id', 'name', 'role'])):
+    """ The keys of an account: its id, name and role.
+
+    This is what postings and views need to know of an account most of
+    the time.
+    """
+
+    __slots__ = ()
+
+    def is_debit(self):
+        """ Is this a debit account? """
+
+        return self.role in ['A', 'E']
+
+
+class AccountBalance(namedtuple('AccountBalance',
+                                ['id', 'name', 'role', 'balance',
+                                 'currency'])):
+    """ The keys of an account with its balance in a currency at some
+    moment
+    """
+
+    __slots__ = ()
+
+    def debit_credit(self):
+        """ Return the debit/credit indicator of the account """
+
+        return 'Db' if self.role in ['A', 'E'] else 'Cr'
+
+
+class AccountKeys():
+    """ A cache of the keys of accounts, to be found by name or id.
+
+    Journal feeds use the same accounts over and over. Instead of reading
+    the account from the database for every posting, ingestion, posting
+    and the views look up the keys here. The cache is bounded to
+    ACCOUNT_CACHE_SIZE accounts.
+
+    Creating an account or changing its role invalidates its entry.
+    Other processes (like the posting workers) see the change when their
+    entry expires, after ACCOUNT_CACHE_SECONDS.
+    """
+
+    def __init__(self, maxsize=5000, ttl=60):
+
+        self.cache = LRUCache(maxsize=maxsize, ttl=ttl)
+
+    def by_name(self, name):
+        """ Return the keys of the account named name """
+
+        account_key = self.cache.get(('name', name))
+        if account_key is None:
+            account_key = self._put(Accounts.get_by_name(name))
+        return account_key
+
+    def by_id(self, account_id):
+        """ Return the keys of the account with id account_id """
+
+        return self.by_ids([account_id])[account_id]
+
+    def by_ids(self, account_ids):
+        """ Return a dictionary of account keys by id for the ids passed.
+
+        The accounts not cached are read in one query (per chunk).
+        """
+
+        found = dict()
+        missing = []
+        for account_id in set(account_ids):
+            account_key = self.cache.get(('id', account_id))
+            if account_key is None:
+                missing.append(account_id)
+            else:
+                found[account_id] = account_key
+        for id_list in chunked(missing):
+            for account in query(Accounts.id, Accounts.name, Accounts.role).\
+                    filter(Accounts.id.in_(id_list)):
+                found[account.id] = self._put(account)
+        for account_id in missing:
+            if account_id not in found:
+                raise NoAccountError('No account for id ' + str(account_id))
+        return found
+
+    def _put(self, account):
+        """ Cache the keys of the account """
+
+        account_key = AccountKey(account.id, account.name, account.role)
+        self.cache.put(('name', account_key.name), account_key)
+        self.cache.put(('id', account_key.id), account_key)
+        return account_key
+
+    def invalidate(self, name=None, id=None):
+        """ Remove an account from the cache, by name and/or id """
+
+        account_key = None
+        if name is not None:
+            account_key = self.cache.get(('name', name))
+            self.cache.invalidate(('name', name))
+        if id is not None:
+            account_key = self.cache.get(('id', id)) or account_key
+            self.cache.invalidate(('id', id))
+        if account_key is not None:
+            self.cache.invalidate(('name', account_key.name))
+            self.cache.invalidate(('id', account_key.id))
+
+
+account_keys = AccountKeys(maxsize=app.config.get('ACCOUNT_CACHE_SIZE', 5000),
+                           ttl=app.config.get('ACCOUNT_CACHE_SECONDS', 60))
+
 
 class AccountList(list):
     """ A list of accounts is returned for showing
@@ -409,6 +1091,104 @@ class AccountList(list):
             account_dictionary[account.name] = account
         return account_dictionary
 
+TrialBalanceLine = namedtuple('TrialBalanceLine', ['id', 'name', 'role',
+                                                   'parent_id', 'level',
+                                                   'balance', 'debit',
+                                                   'credit', 'subtotal'])
+
+
+class TrialBalance(list):
+    """ The trial balance lists the ultimo balance of every account for a
+    postmonth.
+
+    Each line holds the balance of the account itself, split in a debit
+    and a credit amount, and the subtotal of the account and all
+    accounts below it. The lines are in hierarchy order, each account
+    followed by its children, with the level in the hierarchy (0 for the
+    top) for indenting.
+
+    The balances are read in one query (the last balance row at or
+    before the postmonth for every account and currency) and converted
+    to the ledger currency (currency) in one go, at the rates of the last
+    day of the postmonth. The subtotals are added up from the bottom of
+    the hierarchy in memory.
+    """
+
+    def __init__(self, postmonth=None):
+
+        if postmonth is None:
+            postmonth = postmonth_today()
+        self.postmonth = postmonth
+        self.currency = exchange_rates.currency
+        latest = Balances.latest(postmonth)
+        rows = query(Accounts.id, Accounts.name, Accounts.role,
+                     Accounts.parent_id, Balances.currency, Balances.amount).\
+            outerjoin(latest, latest.c.account_id == Accounts.id).\
+            outerjoin(Balances, and_(Balances.account_id == latest.c.account_id,
+                                     Balances.currency == latest.c.currency,
+                                     Balances.postmonth == latest.c.postmonth)).\
+            order_by(Accounts.name).all()
+        with_balance = [row for row in rows if row.amount is not None]
+        balances = {}
+        for row, amount in zip(with_balance, exchange_rates.convert(
+                [(row.currency, row.amount) for row in with_balance],
+                last_day_of(postmonth))):
+            balances[row.id] = balances.get(row.id, 0) + amount
+        accounts = {}
+        for row in rows:
+            accounts.setdefault(row.id, row)
+        children = {}
+        roots = []
+        for row in accounts.values():
+            if row.parent_id in accounts:
+                children.setdefault(row.parent_id, []).append(row.id)
+            else:
+                roots.append(row.id)
+        subtotals = {}
+        # Depth first: every account is listed before its children and
+        # totalled after them
+        order = []
+        stack = [(account_id, 0) for account_id in reversed(roots)]
+        while stack:
+            account_id, level = stack.pop()
+            order.append((account_id, level))
+            for child_id in reversed(children.get(account_id, [])):
+                stack.append((child_id, level + 1))
+        for account_id, _ in reversed(order):
+            subtotals[account_id] = balances.get(account_id, 0) +\
+                sum(subtotals[child_id]
+                    for child_id in children.get(account_id, []))
+        self.total_debit = 0
+        self.total_credit = 0
+        for account_id, level in order:
+            row = accounts[account_id]
+            balance = balances.get(account_id, 0)
+            debit, credit = self.debit_credit_split(row.role, balance)
+            self.total_debit += debit
+            self.total_credit += credit
+            self.append(TrialBalanceLine(row.id, row.name, row.role,
+                                         row.parent_id, level,
+                                         balance, debit, credit,
+                                         subtotals[account_id]))
+
+    @staticmethod
+    def debit_credit_split(role, amount):
+        """ Return the debit and credit part of an account balance.
+
+        A balance is kept positive on the side of the account (debit for
+        assets and expenses, credit for liabilities and income), so a
+        negative balance is on the other side.
+        """
+
+        if role in ['A', 'E']:
+            debit_amount = amount
+        else:
+            debit_amount = -amount
+        if debit_amount >= 0:
+            return debit_amount, 0
+        return 0, -debit_amount
+
+
 class CloseDates(db.Model):
     """ This is the history of closed accounting periods.
     
@@ -441,20 +1221,59 @@ class Postmonths(db.Model):
 
         self.updated_at = datetime.today()
         db.session.add(self)
+        postmonth_status.invalidate(self.postmonth)
 
     def close(self):
         """ Close the postmonth for posting
         
         This will make sure that no more postings are made to this
-        period, like after you have closed the books.
+        period, like after you have closed the books. The ultimo
+        balances of the month are kept in UltimoBalances.
         """
 
         self.monthstat = self.CLOSED
+        postmonth_status.invalidate(self.postmonth)
+        UltimoBalances.snapshot(self.postmonth)
+
+    def reopen(self):
+        """ Open the postmonth for posting again
+
+        The ultimo balances kept for the month, and the views cached as
+        final for it, no longer hold.
+        """
+
+        self.monthstat = self.ACTIVE
+        postmonth_status.invalidate(self.postmonth)
+        UltimoBalances.discard(self.postmonth)
+        view_results.clear()
 
     @validates('monthstat')
     def validate_monthstat(self, id, monthstat):
         if (monthstat != self.ACTIVE) and (monthstat != self.CLOSED):
             raise InvalidPostmonthError('Invalid status in postmonth')
+        if self.postmonth is None:
+            postmonth_status.clear()
+        else:
+            postmonth_status.invalidate(self.postmonth)
+        return monthstat
+
+    @staticmethod
+    def status_of(postmonth):
+        """ Return the monthstat of a postmonth, '' if it doesn't exist.
+
+        The status is kept in a cache, as it is checked for every
+        balance that is made. Changing the status of a month, by closing
+        it or by updating it from a list or dictionary, drops it from the
+        cache. Other processes (like the posting workers) see the change
+        when their entry expires, after POSTMONTH_CACHE_SECONDS.
+        """
+
+        postmonth = int(postmonth)
+        monthstat = postmonth_status.get(postmonth)
+        if monthstat is None:
+            month_db = query(Postmonths).filter_by(postmonth=postmonth).first()
+            monthstat = month_db.monthstat if month_db else ''
+            postmonth_status.put(postmonth, monthstat)
         return monthstat
 
     @staticmethod
@@ -518,7 +1337,13 @@ class Postmonths(db.Model):
             for newdata in postmonths:
                 if int(newdata[0]) == postmonth.postmonth \
                     and not newdata[1] == postmonth.monthstat:
-                    postmonth.monthstat = newdata[1]
+                    if newdata[1] == Postmonths.CLOSED:
+                        postmonth.close()
+                    elif newdata[1] == Postmonths.ACTIVE:
+                        postmonth.reopen()
+                    else:
+                        postmonth.monthstat = newdata[1]
+                        postmonth_status.invalidate(postmonth.postmonth)
 
     @staticmethod
     def update_from_dict(postmonthdict):
@@ -571,6 +1396,10 @@ class Postmonths(db.Model):
         
         return self.str()
 
+postmonth_status = LRUCache(maxsize=app.config.get('POSTMONTH_CACHE_SIZE', 240),
+                            ttl=app.config.get('POSTMONTH_CACHE_SECONDS', 60))
+
+
 class PostmonthList(PaginatorMixin, list):
     """ The list holds a number of postmonths.
     
@@ -617,6 +1446,13 @@ def postmonth_for(postdate):
 
     return postdate.year * 100 + postdate.month
 
+def last_day_of(postmonth):
+    """ Return the date of the last day of a postmonth """
+
+    year, month = divmod(int(postmonth), 100)
+    return date(year, month, calendar.monthrange(year, month)[1])
+
+
 def postmonth_today():
     """ Return the postmonth for today's date"""
 
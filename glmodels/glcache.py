@@ -0,0 +1,184 @@
+#    Copyright 2015 Menno Hölscher
+#
+#    This file is part of gledger.
+
+#    gledger is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Lesser General Public License as published
+#    by the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+
+#    gledger is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Lesser General Public License for more details.
+
+#    You should have received a copy of the GNU Lesser General Public License
+#    along with gledger.  If not, see <http://www.gnu.org/licenses/>.
+
+""" The module contains the caches the models keep in the process. These
+hold data that is read very often and changes rarely, like the id and role
+for an account name.
+
+A cache is local to the process. The models invalidate entries when they
+change the data, and every cache is cleared when a database transaction is
+rolled back, as the cache may hold data that was never committed. Rolling
+back a savepoint leaves the caches, and the results the transaction
+changed, alone.
+
+The results of views on the ledger are kept in a ResultCache
+(view_results). Results for closed postmonths do not change and are kept
+until dropped for space; other results expire after RESULT_CACHE_SECONDS,
+or earlier when a transaction changing the ledger commits. A change made
+by another process is not seen that way, so the views put a version of
+the data they show in the key, like the validator of the page.
+"""
+
+from collections import OrderedDict
+from threading import RLock
+from time import monotonic
+from sqlalchemy import event
+from gledger import app, db
+
+
+class LRUCache():
+    """ A cache of a bounded size, dropping the least recently used entry
+    when full.
+
+    Entries may be given a time to live in seconds, after which they are
+    no longer returned. The default is ttl; None means entries live until
+    they are invalidated or dropped.
+
+    The cache counts hits and misses, to judge if it is worth its keep.
+    """
+
+    def __init__(self, maxsize=1000, ttl=None):
+
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = RLock()
+        _all_caches.append(self)
+
+    def get(self, key, default=None):
+        """ Return the value for key, default if it is not cached """
+
+        with self.lock:
+            if key in self.entries:
+                value, expires = self.entries[key]
+                if expires is None or expires > monotonic():
+                    self.entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self.entries[key]
+            self.misses += 1
+            return default
+
+    def put(self, key, value, ttl=None, forever=False):
+        """ Cache the value for key, for ttl seconds if given, without
+        expiry if forever.
+        """
+
+        if ttl is None:
+            ttl = self.ttl
+        expires = None if forever or ttl is None else monotonic() + ttl
+        with self.lock:
+            self.entries[key] = (value, expires)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, key):
+        """ Remove the entry for key, if it is cached """
+
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def clear(self):
+        """ Remove all entries """
+
+        with self.lock:
+            self.entries.clear()
+
+    def __len__(self):
+
+        return len(self.entries)
+
+    def __contains__(self, key):
+
+        return key in self.entries
+
+
+class ResultCache(LRUCache):
+    """ A cache for results computed from the ledger, like views.
+
+    A result is final when it can not change anymore (it is about a
+    closed postmonth); it is kept without expiry. Other results expire
+    after ttl seconds. They are also dropped, by moving to a new
+    version, when a transaction that was marked as changing the ledger
+    commits.
+    """
+
+    def __init__(self, maxsize=1000, ttl=None):
+
+        super().__init__(maxsize=maxsize, ttl=ttl)
+        self.version = 0
+
+    def get_or_compute(self, key, compute, final=False):
+        """ Return the cached result for key, calling compute to get it
+        if it is not cached.
+        """
+
+        if final:
+            key = ('final',) + tuple(key)
+        else:
+            key = (self.version,) + tuple(key)
+        result = self.get(key, _missing)
+        if result is _missing:
+            result = compute()
+            self.put(key, result, forever=final)
+        return result
+
+    def changed(self, session):
+        """ Mark the transaction of session as changing the ledger """
+
+        session.info.setdefault('changed_results', set()).add(id(self))
+
+    def bump(self):
+        """ Drop all results that are not final """
+
+        with self.lock:
+            self.version += 1
+            for key in [key for key in self.entries if key[0] != 'final']:
+                del self.entries[key]
+
+
+_missing = object()
+
+_all_caches = []
+
+
+@event.listens_for(db.session, 'after_soft_rollback')
+def clear_caches(session, previous_transaction):
+    """ Clear all caches after the rollback of a transaction """
+
+    if previous_transaction.parent is not None:
+        return
+    session.info.pop('changed_results', None)
+    for cache in _all_caches:
+        cache.clear()
+
+
+@event.listens_for(db.session, 'after_commit')
+def bump_result_caches(session):
+    """ Drop the results that may have changed by the committed transaction """
+
+    changed = session.info.pop('changed_results', set())
+    for cache in _all_caches:
+        if id(cache) in changed:
+            cache.bump()
+
+
+view_results = ResultCache(maxsize=app.config.get('RESULT_CACHE_SIZE', 2000),
+                           ttl=app.config.get('RESULT_CACHE_SECONDS', 10))
@@ -0,0 +1,203 @@
+#    Copyright 2015 Menno Hölscher
+#
+#    This file is part of gledger.
+
+#    gledger is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Lesser General Public License as published
+#    by the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+
+#    gledger is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Lesser General Public License for more details.
+
+#    You should have received a copy of the GNU Lesser General Public License
+#    along with gledger.  If not, see <http://www.gnu.org/licenses/>.
+
+""" This module exports the postings and balances to columnar files
+(Parquet), for analysis with tools that read these, without querying the
+ledger database.
+
+The export is written to a directory, in one partition per postmonth::
+
+    postings/postmonth=201709/part-0.parquet
+    balances/postmonth=201709/part-0.parquet
+
+Amounts are integers in cents, account names, currencies and journal
+keys are dictionary encoded. Only closed postmonths are exported, as
+their data do not change anymore; a postmonth already in the directory
+is skipped, so running the export again only adds the months closed
+since.
+
+The export needs pyarrow, which is not needed for anything else and
+so is not required to run GLedger.
+"""
+
+import os
+from gledger import db
+from glmodels.glaccount import Accounts, Postmonths
+from glmodels.glposting import Postings
+
+try:
+    import pyarrow
+    import pyarrow.parquet as parquet
+except ImportError:
+    pyarrow = None
+    parquet = None
+
+
+class ColumnarExportError(Exception):
+    """ The columnar export can not be made """
+
+    pass
+
+
+def posting_schema():
+    """ Return the schema of the postings files """
+
+    return pyarrow.schema([
+        ('id', pyarrow.int64()),
+        ('extkey', pyarrow.dictionary(pyarrow.int32(), pyarrow.string())),
+        ('account', pyarrow.dictionary(pyarrow.int32(), pyarrow.string())),
+        ('postmonth', pyarrow.int32()),
+        ('value_date', pyarrow.date32()),
+        ('debcred', pyarrow.dictionary(pyarrow.int8(), pyarrow.string())),
+        ('amount', pyarrow.int64()),
+        ('currency', pyarrow.dictionary(pyarrow.int8(), pyarrow.string()))])
+
+
+def balance_schema():
+    """ Return the schema of the balances files """
+
+    return pyarrow.schema([
+        ('account_id', pyarrow.int64()),
+        ('account', pyarrow.dictionary(pyarrow.int32(), pyarrow.string())),
+        ('role', pyarrow.dictionary(pyarrow.int8(), pyarrow.string())),
+        ('postmonth', pyarrow.int32()),
+        ('amount', pyarrow.int64()),
+        ('currency', pyarrow.dictionary(pyarrow.int8(), pyarrow.string()))])
+
+
+class ColumnarExport():
+    """ The export of the ledger to a directory of Parquet files.
+
+    The postings of a month are read and written in batches of
+    batch_size rows, each batch a row group of the file, so the memory
+    used does not grow with the size of the month.
+    """
+
+    def __init__(self, directory, batch_size=100000):
+
+        if pyarrow is None:
+            raise ColumnarExportError('The columnar export needs pyarrow')
+        self.directory = directory
+        self.batch_size = batch_size
+
+    def export(self):
+        """ Export the closed postmonths not exported before.
+
+        Returns the list of postmonths exported.
+        """
+
+        exported = []
+        for postmonth in self.months_to_export():
+            self.write_postings(postmonth)
+            self.write_balances(postmonth)
+            exported.append(postmonth)
+        return exported
+
+    def months_to_export(self):
+        """ Return the closed postmonths that are not in the directory """
+
+        closed = db.session.query(Postmonths.postmonth).\
+            filter_by(monthstat=Postmonths.CLOSED).\
+            order_by(Postmonths.postmonth)
+        return [postmonth for postmonth, in closed
+                if not os.path.exists(self.partition('balances', postmonth))]
+
+    def partition(self, table, postmonth):
+        """ Return the file for a table and postmonth """
+
+        return os.path.join(self.directory, table,
+                            'postmonth={0}'.format(postmonth), 'part-0.parquet')
+
+    def write_postings(self, postmonth):
+        """ Write the postings of the postmonth """
+
+        schema = posting_schema()
+        with self._writer('postings', postmonth, schema) as writer:
+            batch = []
+            for row in Postings.rows_for_month(postmonth,
+                                               batch_size=self.batch_size):
+                batch.append(row)
+                if len(batch) >= self.batch_size:
+                    writer.write_table(self._postings_table(batch, schema))
+                    batch = []
+            if batch:
+                writer.write_table(self._postings_table(batch, schema))
+
+    def write_balances(self, postmonth):
+        """ Write the ultimo balances of all accounts for the postmonth,
+        a row for every currency of an account, not converted.
+
+        The balances file of a month is written last, so its presence
+        marks the month as exported.
+        """
+
+        schema = balance_schema()
+        balances = Accounts.latest_balances(postmonth=postmonth)
+        with self._writer('balances', postmonth, schema) as writer:
+            writer.write_table(pyarrow.table({
+                'account_id': [balance.id for balance in balances],
+                'account': [balance.name for balance in balances],
+                'role': [balance.role for balance in balances],
+                'postmonth': [int(postmonth)] * len(balances),
+                'amount': [int(balance.balance) for balance in balances],
+                'currency': [balance.currency for balance in balances]},
+                schema=schema))
+
+    def _writer(self, table, postmonth, schema):
+        """ Return a writer for the file of the table and postmonth """
+
+        return _PartitionWriter(self.partition(table, postmonth), schema)
+
+    @staticmethod
+    def _postings_table(rows, schema):
+        """ Return the arrow table for a batch of posting rows """
+
+        return pyarrow.table({
+            'id': [row.id for row in rows],
+            'extkey': [row.extkey for row in rows],
+            'account': [row.account for row in rows],
+            'postmonth': [int(row.postmonth) for row in rows],
+            'value_date': [row.value_date.date() for row in rows],
+            'debcred': [row.debcred for row in rows],
+            'amount': [int(row.amount) for row in rows],
+            'currency': [row.currency for row in rows]}, schema=schema)
+
+
+class _PartitionWriter():
+    """ Write a Parquet file under a temporary name, renaming it to its
+    own name when complete. An interrupted export leaves no partial file.
+    """
+
+    def __init__(self, path, schema):
+
+        self.path = path
+        self.temporary = path + '.tmp'
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.writer = parquet.ParquetWriter(self.temporary, schema)
+
+    def __enter__(self):
+
+        return self.writer
+
+    def __exit__(self, exc_type, exc_value, traceback):
+
+        self.writer.close()
+        if exc_type is None:
+            os.replace(self.temporary, self.path)
+        else:
+            os.remove(self.temporary)
+        return False
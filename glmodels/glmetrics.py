@@ -0,0 +1,312 @@
+#    Copyright 2015 Menno Hölscher
+#
+#    This file is part of gledger.
+
+#    gledger is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Lesser General Public License as published
+#    by the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+
+#    gledger is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Lesser General Public License for more details.
+
+#    You should have received a copy of the GNU Lesser General Public License
+#    along with gledger.  If not, see <http://www.gnu.org/licenses/>.
+
+""" The module keeps the metrics of the process: counters, histograms and
+gauges, shown in the Prometheus text format on the /metrics page.
+
+Metrics are kept in the process. The web interface counts the journals
+it receives, the posting workers the journals they post; every posting
+worker serves its own metrics on a port from POSTING_METRICS_PORT when
+that is configured. A command, like the year end, pushes its metrics to
+the Prometheus Pushgateway at METRICS_PUSHGATEWAY, if configured, before
+it ends.
+
+Counts of things done in a database transaction, like journals posted,
+are recorded with on_commit: they are added when the transaction
+commits and dropped when it (or the savepoint they were recorded in) is
+rolled back.
+"""
+
+import logging
+import threading
+from abc import ABC, abstractmethod
+from bisect import bisect_left
+from urllib.request import Request, urlopen
+from wsgiref.simple_server import WSGIRequestHandler, make_server
+from sqlalchemy import event
+from sqlalchemy.orm import scoped_session
+from gledger import db
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+class Metric(ABC):
+    """ A metric, with a value for every combination of its labels """
+
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.values = dict()
+        self.lock = threading.Lock()
+        registry.append(self)
+
+    def _key(self, labels):
+
+        if set(labels) != set(self.labelnames):
+            raise ValueError('Metric {0} has labels {1}'.format(
+                self.name, ', '.join(self.labelnames)))
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    @abstractmethod
+    def samples(self):
+        """ Return the samples as (name suffix, labels, value) tuples """
+
+    def render(self):
+        """ Return the metric in the text format """
+
+        lines = ['# HELP {0} {1}'.format(self.name, self.documentation),
+                 '# TYPE {0} {1}'.format(self.name, self.kind)]
+        for suffix, labels, value in self.samples():
+            lines.append('{0}{1}{2} {3}'.format(self.name, suffix,
+                                                format_labels(labels),
+                                                format_value(value)))
+        return '\n'.join(lines) + '\n'
+
+
+class RecordedMetric(Metric):
+    """ A metric the values of which are recorded as things happen """
+
+    @abstractmethod
+    def record(self, value, **labels):
+        """ Record value, the way of the kind of metric """
+
+    def on_commit(self, session, value=1, **labels):
+        """ Record value when the transaction of session commits """
+
+        if isinstance(session, scoped_session):
+            session = session()
+        session.info.setdefault('metrics', []).append(
+            (session.transaction, self, value, labels))
+
+
+class Counter(RecordedMetric):
+    """ A count that only goes up """
+
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        """ Add amount to the count """
+
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    record = inc
+
+    def value(self, **labels):
+        """ Return the count """
+
+        return self.values.get(self._key(labels), 0)
+
+    def samples(self):
+
+        with self.lock:
+            values = sorted(self.values.items())
+        if not values and not self.labelnames:
+            values = [((), 0)]
+        return [('', dict(zip(self.labelnames, key)), value)
+                for key, value in values]
+
+
+class Histogram(RecordedMetric):
+    """ Counts observations in buckets, with their count and sum """
+
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=None):
+
+        super().__init__(name, documentation, labelnames=labelnames)
+        self.buckets = sorted(buckets)
+
+    def observe(self, amount, **labels):
+        """ Count an observation """
+
+        key = self._key(labels)
+        with self.lock:
+            counts, total = self.values.get(key,
+                                            ([0] * (len(self.buckets) + 1), 0))
+            counts[bisect_left(self.buckets, amount)] += 1
+            self.values[key] = (counts, total + amount)
+
+    record = observe
+
+    def count(self, **labels):
+        """ Return the number of observations """
+
+        counts, _ = self.values.get(self._key(labels), ([0], 0))
+        return sum(counts)
+
+    def samples(self):
+
+        with self.lock:
+            values = sorted((key, (list(counts), total)) for key, (counts, total)
+                            in self.values.items())
+        if not values and not self.labelnames:
+            values = [((), ([0] * (len(self.buckets) + 1), 0))]
+        samples = []
+        for key, (counts, total) in values:
+            labels = dict(zip(self.labelnames, key))
+            cumulative = 0
+            for bound, count in zip(self.buckets + [float('inf')], counts):
+                cumulative += count
+                samples.append(('_bucket', dict(labels, le=format_value(bound)),
+                                cumulative))
+            samples.append(('_sum', labels, total))
+            samples.append(('_count', labels, cumulative))
+        return samples
+
+
+class Gauge(Metric):
+    """ A value read when the metrics are shown.
+
+    The function returns the value, or a dictionary of values keyed by
+    the tuple of label values. As nothing is recorded into a gauge, it
+    has no record or on_commit.
+    """
+
+    kind = 'gauge'
+
+    def __init__(self, name, documentation, function, labelnames=()):
+
+        super().__init__(name, documentation, labelnames=labelnames)
+        self.function = function
+
+    def samples(self):
+
+        values = self.function()
+        if not self.labelnames:
+            values = {(): values}
+        return [('', dict(zip(self.labelnames, key)), value)
+                for key, value in sorted(values.items())]
+
+
+def format_labels(labels):
+    """ Return the labels as in the text format """
+
+    if not labels:
+        return ''
+    return '{' + ','.join('{0}="{1}"'.format(name, str(value).
+                          replace('\\', '\\\\').replace('"', '\\"').
+                          replace('\n', '\\n'))
+                          for name, value in labels.items()) + '}'
+
+
+def format_value(value):
+    """ Return a number as in the text format """
+
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value)) if abs(value) < 1e15 else repr(value)
+    return str(value)
+
+
+registry = []
+
+
+def render():
+    """ Return all metrics in the text format """
+
+    parts = []
+    for metric in registry:
+        try:
+            parts.append(metric.render())
+        except Exception:
+            logging.exception('Metric ' + metric.name + ' not rendered')
+    return ''.join(parts)
+
+
+def metrics_app(environ, start_response):
+    """ The WSGI application serving the metrics of a posting worker.
+
+    Gauges read the database in the session of the serving thread. Every
+    scrape is rendered in an application context of its own, which
+    removes the session when it ends, so the next scrape does not read
+    the snapshot of a transaction left open.
+    """
+
+    from gledger import app
+    with app.app_context():
+        page = render()
+    start_response('200 OK', [('Content-Type', CONTENT_TYPE)])
+    return [page.encode('utf-8')]
+
+
+def serve(port):
+    """ Serve the metrics over HTTP on port, in a background thread """
+
+    class QuietHandler(WSGIRequestHandler):
+        def log_message(self, format, *args):
+            pass
+
+    server = make_server('', port, metrics_app, handler_class=QuietHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
+
+
+def push(job, gateway=None):
+    """ Push all metrics to the Pushgateway at gateway, replacing those
+    of job there. Does nothing if no gateway is passed or configured.
+    """
+
+    from gledger import app
+    gateway = gateway or app.config.get('METRICS_PUSHGATEWAY')
+    if not gateway:
+        return
+    url = '{0}/metrics/job/{1}'.format(gateway.rstrip('/'), job)
+    try:
+        urlopen(Request(url, data=render().encode('utf-8'), method='PUT',
+                        headers={'Content-Type': CONTENT_TYPE}), timeout=10)
+    except OSError:
+        logging.exception('Metrics not pushed to ' + url)
+
+
+def _within(transaction, ended):
+    """ Is transaction the ended transaction or one inside it? """
+
+    while transaction is not None:
+        if transaction is ended:
+            return True
+        transaction = transaction.parent
+    return False
+
+
+@event.listens_for(db.session, 'after_commit')
+def record_committed(session):
+    """ Record the metrics of a transaction when it commits """
+
+    if session.transaction is not None and\
+            session.transaction.parent is not None:
+        return
+    for (_, metric, value, labels) in session.info.pop('metrics', []):
+        metric.record(value, **labels)
+
+
+@event.listens_for(db.session, 'after_soft_rollback')
+def drop_rolled_back(session, previous_transaction):
+    """ Drop the metrics of a transaction or savepoint rolled back """
+
+    pending = session.info.get('metrics')
+    if pending:
+        session.info['metrics'] = [entry for entry in pending
+                                   if not _within(entry[0],
+                                                  previous_transaction)]
@@ -21,13 +21,23 @@ new correcting postings. This is because postings are part of a journal,
 a composite of postings that belong together and always need to balance.
 """
 
+import json
 import logging
-from datetime import datetime
-from sqlalchemy.orm import validates
+from datetime import datetime, timedelta
+from decimal import Decimal, InvalidOperation
+from hashlib import sha256
+from time import perf_counter
+from uuid import uuid4
+from sqlalchemy import and_, event, func, or_
+from sqlalchemy.orm import validates, subqueryload
 from sqlalchemy.orm.exc import NoResultFound
-from gledger import db
-from .glaccount import Accounts, postmonth_for, NoAccountError, Postmonths,\
-    ShortSearchStringError
+from gledger import app, db
+from glmodels import chunked
+from glmodels.glcache import view_results
+from glmodels.glmetrics import Counter, Gauge, Histogram
+from glmodels.glrates import exchange_rates
+from .glaccount import Accounts, AccountTree, Balances, postmonth_for,\
+    NoAccountError, Postmonths, ShortSearchStringError, account_keys
 
 
 query = db.session.query
@@ -56,9 +66,22 @@ class NoJournalError(ValueError):
 
 class JournalBalanceError(InvalidJournalError):
     """ The postings in a journal do not balance
+
+    The imbalances are a dictionary with, for every journal that does
+    not balance, a dictionary of the balance per currency that does not
+    balance.
     """
 
-    pass
+    def __init__(self, imbalances):
+
+        self.imbalances = imbalances
+        super().__init__('; '.join(
+            'Journal {0} does not balance: {1}'.format(
+                journal_label(journal),
+                ', '.join('{0} {1}'.format(currency, format_amount(amount))
+                          for currency, amount in sorted(
+                              currencies.items(), key=lambda item: str(item[0]))))
+            for journal, currencies in imbalances.items()))
 
 
 class InvalidDebitCreditError(InvalidJournalError):
@@ -75,6 +98,28 @@ class NoPostingInJournal(InvalidJournalError):
     pass
 
 
+class DuplicateJournalError(InvalidJournalError):
+    """ A journal was delivered again with the key of an earlier journal,
+    but with other content
+    """
+
+    pass
+
+
+class LeaseLostError(Exception):
+    """ A posting worker no longer holds the lease on journals it posted
+    """
+
+    pass
+
+
+class InvalidCursorError(ValueError):
+    """ A cursor to continue a list of postings from can not be decoded
+    """
+
+    pass
+
+
 class Journals(db.Model):
     """ The journal is the way postings are delivered by clients.
 
@@ -89,6 +134,16 @@ class Journals(db.Model):
         :extkey: the key to the callings systems object, this is optional
         :journalstat: the status of the journal
         :updated_at: The timestamp of the last update
+        :leased_by: the claim of the posting worker processing the journal
+        :leased_until: until when the claim of the worker holds
+        :content_hash: the hash of the journal as it was delivered
+
+    With JOURNAL_IDEMPOTENT in the configuration, a journal delivered
+    with the extkey of an earlier journal is not added again: the
+    earlier journal is returned instead (and marked replayed). If
+    JOURNAL_IDEMPOTENCY_HASH is set too, the content must be the same
+    as that of the earlier journal, or a DuplicateJournalError is raised.
+    The earlier journal is found through the index on extkey.
     """
 
     __tablename__ = 'journals'
@@ -97,11 +152,18 @@ class Journals(db.Model):
     journalpostings = db.relationship('Postings', backref='journal')
     journalstat = db.Column(db.String(1), nullable=False)
     updated_at = db.Column(db.DateTime, nullable=False)
+    leased_by = db.Column(db.String(64), nullable=True)
+    leased_until = db.Column(db.DateTime, nullable=True)
+    content_hash = db.Column(db.String(64), nullable=True)
+    __table_args__ = (db.Index('bystatus', 'journalstat', 'id'),
+                      db.Index('byextkey', 'extkey'))
 
     UNPROCESSED = 'U'
     PROCESSED = 'P'
     FAILED = 'F'
 
+    replayed = False
+
     @classmethod
     def get_by_id(cls, requested_id):
         """ Return the journal row for requested_id
@@ -116,24 +178,120 @@ class Journals(db.Model):
             raise NoJournalError('No journal for id ' + str(requested_id))
 
     @classmethod
-    def create_from_dict(cls, journdict):
+    def create_from_dict(cls, journdict, flush=True, idempotent=None):
         """Creates a new journal including posting from
         a dictionary created from json
+
+        If the journal is refused, it is taken out of the session again.
+        The new journal is flushed, unless flush is False. If idempotent
+        (by default JOURNAL_IDEMPOTENT) and the extkey was delivered
+        before, the earlier journal is returned.
         """
 
         if 'postings' not in journdict['journal']\
                 or journdict['journal']['postings'] is None:
             raise NoPostingInJournal('Empty journal')
+        if idempotent is None:
+            idempotent = app.config.get('JOURNAL_IDEMPOTENT', False)
+        if idempotent:
+            originals = cls.originals_for([journdict])
+            if originals:
+                return cls._replay(originals.popitem()[1], journdict)
         newjournal = cls(journalstat=cls.UNPROCESSED,
-                         extkey=journdict['journal']['extkey'])
+                         extkey=journdict['journal']['extkey'],
+                         content_hash=content_hash(journdict))
         newjournal.add()
-        for posting in journdict["journal"]["postings"]:
-            try:
-                Postings.create_from_dict(posting, newjournal)
-            except NoAccountError as exc:
-                raise InvalidJournalError(str(exc)) from exc
+        try:
+            with db.session.no_autoflush:
+                for posting in journdict["journal"]["postings"]:
+                    try:
+                        Postings.create_from_dict(posting, newjournal)
+                    except NoAccountError as exc:
+                        raise InvalidJournalError(str(exc)) from exc
+        except Exception:
+            newjournal.discard()
+            raise
+        journals_received.on_commit(db.session)
+        postings_per_journal.on_commit(db.session,
+                                       len(newjournal.journalpostings))
+        if flush:
+            db.session.flush()
         return newjournal
 
+    @classmethod
+    def create_batch(cls, journdicts, idempotent=None):
+        """ Create journals from a list of dictionaries created from json.
+
+        A journal that can not be created is left out, it does not stop
+        the others. Nothing is flushed, so the journals of the batch are
+        inserted together. Returns a list with, for each dictionary, the
+        new journal or the exception that refused it.
+
+        If idempotent (by default JOURNAL_IDEMPOTENT), the journals
+        delivered before are looked up in one query; for these, and for
+        keys repeated within the batch, the earlier journal is returned.
+        """
+
+        if idempotent is None:
+            idempotent = app.config.get('JOURNAL_IDEMPOTENT', False)
+        originals = cls.originals_for(journdicts) if idempotent else {}
+        created = dict()
+        results = []
+        for journdict in journdicts:
+            try:
+                extkey = extkey_of(journdict)
+                if extkey in originals:
+                    results.append(cls._replay(originals[extkey], journdict))
+                    continue
+                if extkey in created:
+                    results.append(cls._replay(created[extkey], journdict,
+                                               mark=False))
+                    continue
+                journal = cls.create_from_dict(journdict, flush=False,
+                                               idempotent=False)
+                if idempotent and extkey is not None:
+                    created[extkey] = journal
+                results.append(journal)
+            except (InvalidJournalError, KeyError, TypeError,
+                    ValueError) as exc:
+                results.append(exc)
+        return results
+
+    @classmethod
+    def originals_for(cls, journdicts):
+        """ Return the journals delivered before with the extkeys of
+        journdicts, by extkey.
+
+        If there are more journals with a key, the first is returned.
+        """
+
+        extkeys = set(extkey for extkey in map(extkey_of, journdicts)
+                      if extkey is not None)
+        originals = dict()
+        with db.session.no_autoflush:
+            for key_list in chunked(extkeys):
+                for journal in query(cls).filter(cls.extkey.in_(key_list)).\
+                        order_by(cls.id.desc()):
+                    originals[journal.extkey] = journal
+        return originals
+
+    @classmethod
+    def _replay(cls, original, journdict, mark=True):
+        """ Return the original journal for a journal delivered again,
+        marked replayed if mark (it is not when it was created in the
+        same batch).
+        """
+
+        if app.config.get('JOURNAL_IDEMPOTENCY_HASH', False) and\
+                original.content_hash is not None and\
+                original.content_hash != content_hash(journdict):
+            raise DuplicateJournalError('Journal ' + str(original.extkey) +
+                                        ' was delivered with other content')
+        if mark:
+            original.replayed = True
+        journals_replayed.inc()
+        return original
+
     @classmethod
     def postings_for_id(cls, journal_id):
         """ Assemble the postings in journal with id journal_id
@@ -157,6 +315,15 @@ class Journals(db.Model):
             raise NoJournalError('No journal with key ' + extkey)
         return journal
 
+    @classmethod
+    def state_of(cls, extkey):
+        """ Return the time of the last update and the status of the
+        journal with extkey, None if there is no such journal.
+        """
+
+        return query(Journals.updated_at, Journals.journalstat).\
+            filter_by(extkey=extkey).first()
+
     @classmethod
     def journals_for_search(cls, search_string=None, page=1, pagelength=25):
         """ Return journals that have the search string
@@ -195,6 +362,101 @@ class Journals(db.Model):
             raise NoJournalError('No journal for key ' + str(journal_key))
         return journal.journalpostings
 
+    @classmethod
+    def claim_unprocessed(cls, worker, batch_size=100, lease_seconds=300):
+        """ Claim a batch of unprocessed journals for a posting worker.
+
+        Journals that are unprocessed and not claimed, or whose claim has
+        expired, are leased to the worker for lease_seconds. The claim is
+        made with a conditional update and committed, so two workers
+        never get the same journal; a journal of a worker that died is
+        picked up again when its lease expires. Returns the claimed
+        journals with their postings loaded.
+        """
+
+        now = datetime.today()
+        not_leased = or_(cls.leased_until.is_(None), cls.leased_until < now)
+        candidates = [journal_id for (journal_id,) in query(cls.id).\
+            filter(cls.journalstat == cls.UNPROCESSED).filter(not_leased).\
+            order_by(cls.id).limit(batch_size)]
+        if not candidates:
+            return []
+        lease = '{0}:{1}'.format(worker, uuid4().hex)[-64:]
+        db.session.execute(cls.__table__.update().
+            where(cls.id.in_(candidates)).
+            where(cls.journalstat == cls.UNPROCESSED).where(not_leased).
+            values(leased_by=lease,
+                   leased_until=now + timedelta(seconds=lease_seconds)))
+        db.session.commit()
+        return query(cls).filter(cls.id.in_(candidates)).\
+            filter_by(leased_by=lease).\
+            options(subqueryload(cls.journalpostings)).order_by(cls.id).all()
+
+    @classmethod
+    def process_claimed(cls, journals, commit=True):
+        """ Post claimed journals and release them.
+
+        The journals are posted as one batch. If that fails, they are
+        posted one by one, each in a savepoint, so a journal that can not
+        be posted is marked failed without stopping the others. Returns
+        the number of journals that failed. The transaction is committed,
+        unless commit is False.
+
+        The leases are released only if the worker still holds them. If a
+        lease expired and the journal was claimed by another worker, the
+        batch is rolled back and LeaseLostError raised, so the journals
+        are not posted twice.
+        """
+
+        try:
+            with db.session.begin_nested():
+                cls.post_journals(journals)
+            failures = 0
+        except (InvalidJournalError, ValueError) as exc:
+            logging.info('Batch not posted, posting one by one: ' + str(exc))
+            failures = 0
+            for journal in journals:
+                try:
+                    with db.session.begin_nested():
+                        cls.post_journals([journal])
+                except (InvalidJournalError, ValueError) as exc:
+                    logging.warning('Journal ' + str(journal.extkey) +
+                                    ' failed: ' + str(exc))
+                    journal.journalstat = cls.FAILED
+                    journals_processed.on_commit(db.session,
+                                                 journalstat=cls.FAILED)
+                    failures += 1
+        cls.release([journal for journal in journals
+                     if journal.leased_by is not None])
+        if commit:
+            db.session.commit()
+        return failures
+
+    @classmethod
+    def release(cls, journals):
+        """ Release the leases on journals, with a conditional update per
+        lease. Rolls back and raises LeaseLostError if a lease has expired
+        or is held by another worker now.
+        """
+
+        db.session.flush()
+        now = datetime.today()
+        released = 0
+        for lease in {journal.leased_by for journal in journals}:
+            for id_list in chunked([journal.id for journal in journals
+                                    if journal.leased_by == lease]):
+                released += db.session.execute(cls.__table__.update().
+                    where(cls.id.in_(id_list)).
+                    where(cls.leased_by == lease).
+                    where(cls.leased_until >= now).
+                    values(leased_by=None, leased_until=None)).rowcount
+        if released != len(journals):
+            db.session.rollback()
+            raise LeaseLostError('Lease on {0} of {1} journal(s) lost'.format(
+                len(journals) - released, len(journals)))
+        for journal in journals:
+            db.session.expire(journal, ['leased_by', 'leased_until'])
+
     @validates('journalstat')
     def validate_status(self, id, journalstat):
         """ Check if the status is valid
@@ -214,6 +476,54 @@ class Journals(db.Model):
         self.updated_at = datetime.today()
         db.session.add(self)
 
+    def discard(self):
+        """ Take this journal and its postings out of the session
+
+        Only for a journal that has not been flushed yet.
+        """
+
+        for posting in self.journalpostings:
+            if posting in db.session:
+                db.session.expunge(posting)
+        if self in db.session:
+            db.session.expunge(self)
+
+    def check_balance(self):
+        """ Check that the postings of this journal balance, in every
+        currency.
+
+        Raises a JournalBalanceError naming every currency that does not
+        balance.
+        """
+
+        type(self).check_balances([self])
+
+    @classmethod
+    def check_balances(cls, journals):
+        """ Check that the postings of every journal balance, in every
+        currency.
+
+        Debits and credits are summed per journal and currency in one
+        pass over the postings of all journals. Raises a
+        JournalBalanceError for all journals and currencies that do not
+        balance.
+        """
+
+        totals = dict()
+        for journal in journals:
+            for posting in journal.journalpostings:
+                key = (journal, posting.currency)
+                if posting.is_debit():
+                    totals[key] = totals.get(key, 0) + posting.amount
+                else:
+                    totals[key] = totals.get(key, 0) - posting.amount
+        imbalances = dict()
+        for (journal, currency), total in totals.items():
+            if total != 0:
+                imbalances.setdefault(journal, dict())[currency] = total
+        if imbalances:
+            raise JournalBalanceError(imbalances)
+
     def post_journal(self):
         """ Post the posting of this journal to the accounts.
 
@@ -221,25 +531,112 @@ class Journals(db.Model):
         balance, it is marked for being unprocessable.
         """
 
-        journal_balance = 0
-        if self.journalpostings:
-            firstpostingccy = self.journalpostings[0].currency
-        for posting in self.journalpostings:
-            if not posting.currency == firstpostingccy:
-                continue
-            if posting.is_debit():
-                journal_balance += posting.amount
+        type(self).post_journals([self])
+
+    @classmethod
+    def post_journals(cls, journals, atomic=None):
+        """ Post the postings of a batch of journals to the accounts.
+
+        All journals are checked to balance in every currency, and the
+        postmonths they post to are checked to be open (read from the
+        database, not the cache), before any balance is touched. The
+        postings of all journals are then netted per account, postmonth
+        and currency, so every balance row is read and updated only once,
+        however many postings it receives.
+
+        If atomic is true, balances are incremented in the database
+        instead of read and written back (see
+        Balances.apply_amounts_atomic). If it is None, the configuration
+        value POSTING_MODE decides: "atomic" or the default "orm".
+        """
+
+        start = perf_counter()
+        cls.check_balances(journals)
+        amounts = dict()
+        for journal in journals:
+            for posting in journal.journalpostings:
+                key = (posting.accounts_id, postmonth_for(posting.value_date),
+                       posting.currency)
+                if posting.is_debit():
+                    amounts[key] = amounts.get(key, 0) + posting.amount
+                else:
+                    amounts[key] = amounts.get(key, 0) - posting.amount
+        Balances.check_postmonths({postmonth for (_, postmonth, _)
+                                   in amounts})
+        if atomic is None:
+            atomic = app.config.get('POSTING_MODE', 'orm') == 'atomic'
+        try:
+            if atomic:
+                Balances.apply_amounts_atomic(amounts)
             else:
-                journal_balance -= posting.amount
-        if not journal_balance == 0:
-            raise JournalBalanceError('Journal balance = ' +
-                                      str(journal_balance))
-        for posting in self.journalpostings:
-            try:
-                posting.apply()
-            except NoAccountError as exc:
-                raise InvalidJournalError(str(exc)) from exc
-        self.journalstat = self.PROCESSED
+                Balances.apply_amounts(amounts)
+        except NoAccountError as exc:
+            raise InvalidJournalError(str(exc)) from exc
+        now = datetime.today()
+        for journal in journals:
+            journal.journalstat = cls.PROCESSED
+            journals_processed.on_commit(db.session,
+                                         journalstat=cls.PROCESSED)
+            if journal.updated_at is not None:
+                posting_latency.on_commit(
+                    db.session, (now - journal.updated_at).total_seconds())
+        post_journals_seconds.observe(perf_counter() - start)
+
+    @classmethod
+    def count_by_status(cls):
+        """ Return the number of journals per journalstat, as a
+        dictionary keyed by a tuple of the journalstat.
+        """
+
+        return dict(((journalstat,), count) for journalstat, count in
+                    query(cls.journalstat, func.count(cls.id)).
+                    group_by(cls.journalstat))
+
+
+class SpoolCheckpoints(db.Model):
+    """ How far a segment of the journal spool (see gledger.spool) has
+    been added to the ledger.
+
+    The checkpoint of a segment is updated in the transaction that adds
+    the journals read from it, so the journals and the checkpoint are
+    committed together: after a crash, the spool is read again from
+    exactly after the last journal committed.
+
+    Fields:
+        :segment: the name of the segment
+        :position: the offset in the segment after the last line added
+        :updated_at: the timestamp of the last update
+    """
+
+    __tablename__ = 'spoolcheckpoints'
+    segment = db.Column(db.String(64), primary_key=True)
+    position = db.Column(db.BigInteger, nullable=False)
+    updated_at = db.Column(db.DateTime, nullable=False)
+
+    @classmethod
+    def positions(cls):
+        """ Return the position of every segment, by segment name """
+
+        return dict(query(cls.segment, cls.position))
+
+    @classmethod
+    def advance(cls, segment, position):
+        """ Set the position of segment, in the current transaction """
+
+        checkpoint = query(cls).get(segment)
+        if checkpoint is None:
+            checkpoint = cls(segment=segment)
+            db.session.add(checkpoint)
+        checkpoint.position = position
+        checkpoint.updated_at = datetime.today()
+
+    @classmethod
+    def forget(cls, segments):
+        """ Remove the checkpoints of segments, in the current transaction """
+
+        if segments:
+            query(cls).filter(cls.segment.in_(list(segments))).\
+                delete(synchronize_session=False)
 
 
 class Postings(db.Model):
@@ -264,12 +661,16 @@ class Postings(db.Model):
     journals_id = db.Column(db.Integer, db.ForeignKey('journals.id'),
                             nullable=False)
     postmonth = db.Column(db.Numeric(precision=6))
-    currency = db.Column(db.String(3), nullable=False, default='EUR')
+    currency = db.Column(db.String(3), nullable=False,
+                         default=exchange_rates.currency)
     amount = db.Column(db.Numeric(precision=14), nullable=False)
     debcred = db.Column(db.String(2), nullable=False)
     db.CheckConstraint("debcred in ('Db', 'Cr')", name='debcredval'),
     value_date = db.Column(db.DateTime, nullable=False)
     updated_at = db.Column(db.DateTime, nullable=False)
+    __table_args__ = (db.Index('byaccount', 'accounts_id', 'updated_at', 'id'),)
+
+    CURSOR_FORMAT = '%Y%m%d%H%M%S%f'
 
     @classmethod
     def create_from_dict(cls, posting, for_journal):
@@ -282,47 +683,178 @@ class Postings(db.Model):
         value_date = datetime(int(posting["valuedate"][0:4]),
                               int(posting["valuedate"][5:7]),
                               int(posting["valuedate"][8:10]))
+        try:
+            amount = Decimal(str(posting["amount"]))
+        except InvalidOperation:
+            raise InvalidJournalError('Invalid amount ' +
+                                      str(posting["amount"]))
         newposting = cls(postmonth=postmonth_for(value_date),
                          value_date=value_date,
                          currency=posting["currency"],
-                         amount=posting["amount"],
+                         amount=amount,
                          debcred=posting["debitcredit"])
         newposting.accounts_id = newposting._id_for_account(posting["account"])
         newposting.journal = for_journal
         newposting.add()
-        for_journal.journalpostings.append(newposting)
         return newposting
 
     @classmethod
-    def postings_for_account(cls, account, pagelength=25, page=1, month=None):
+    def postings_for_account(cls, account, pagelength=25, page=1, month=None,
+                             cursor=None):
         """ This method gets a list of postings for the account passed.
 
         It has a pagelength for the number of postings. -1 is unlimited
         (warning: That may return very many postings!
+
+        The postings are newest first. A page is found either by its
+        number or, cheaper, by a cursor: the next_cursor of the list of
+        the page before. With a cursor, the database continues from the
+        last posting shown instead of skipping all postings of earlier
+        pages, so every page costs the same. The total number of
+        postings is only counted for numbered pages.
         """
 
         posts = query(Postings).filter_by(accounts_id=account.id)
-        posts = posts.order_by(Postings.updated_at.desc())
+        posts = posts.order_by(Postings.updated_at.desc(), Postings.id.desc())
         if month:
             posts = posts.filter_by(postmonth=Postmonths.internal(month))
-        if not pagelength == -1:
-            posts = posts.limit(pagelength)
         if page is None:
             page = 1
-        if not page == 1:
-            posts = posts.offset((page - 1) * pagelength)
+        if cursor:
+            updated_at, posting_id = cls.decode_cursor(cursor)
+            posts = posts.filter(or_(Postings.updated_at < updated_at,
+                                     and_(Postings.updated_at == updated_at,
+                                          Postings.id < posting_id)))
+            num_posts = None
+        else:
+            num_posts = query(Postings).filter_by(accounts_id=account.id)
+            if month:
+                num_posts = num_posts.filter_by(
+                    postmonth=Postmonths.internal(month))
+            num_posts = num_posts.count()
+            if not page == 1:
+                posts = posts.offset((page - 1) * pagelength)
+        if not pagelength == -1:
+            posts = posts.limit(pagelength + 1)
         posts = posts.all()
-        num_posts = query(Postings).filter_by(accounts_id=account.id)
-        num_posts = num_posts.count()
+        next_cursor = None
+        if not pagelength == -1 and len(posts) > pagelength:
+            posts = posts[:pagelength]
+            next_cursor = cls.encode_cursor(posts[-1])
         return PostingList(posts, page=page, pagelength=pagelength,
-                           num_records=num_posts)
+                           num_records=num_posts, next_cursor=next_cursor)
+
+    @classmethod
+    def last_change(cls, account_id, month=None):
+        """ Return the time of the last change and the number of the
+        postings of the account, in the month if given.
+        """
+
+        changes = query(func.max(Postings.updated_at), func.count(Postings.id)).\
+            filter(Postings.accounts_id == account_id)
+        if month:
+            changes = changes.filter(Postings.postmonth ==
+                                     Postmonths.internal(month))
+        return changes.one()
+
+    @classmethod
+    def encode_cursor(cls, posting):
+        """ Return the cursor to continue a list after posting """
+
+        return '{0}-{1}'.format(posting.updated_at.strftime(cls.CURSOR_FORMAT),
+                                posting.id)
+
+    @classmethod
+    def decode_cursor(cls, cursor):
+        """ Return the timestamp and id a cursor points at """
+
+        try:
+            timestamp, posting_id = cursor.split('-')
+            return (datetime.strptime(timestamp, cls.CURSOR_FORMAT),
+                    int(posting_id))
+        except ValueError as ve:
+            raise InvalidCursorError('Invalid cursor ' + str(cursor)) from ve
+
+    @classmethod
+    def view_rows(cls, posting_ids=None, journal_id=None):
+        """ Return the data to show postings, read in one query.
+
+        Each row holds the posting fields, the name of the account
+        (account) and the external key of the journal (extkey). The
+        postings are either those with the posting_ids, in the order
+        of the ids, or those of the journal with journal_id.
+        """
+
+        rows_query = cls._view_query()
+        if journal_id is not None:
+            return rows_query.filter(Postings.journals_id == journal_id).\
+                order_by(Postings.id).all()
+        rows = {}
+        for ids in chunked(posting_ids):
+            for row in rows_query.filter(Postings.id.in_(ids)):
+                rows[row.id] = row
+        return [rows[posting_id] for posting_id in posting_ids
+                if posting_id in rows]
+
+    @classmethod
+    def export_rows(cls, account, subtree=False, from_month=None,
+                    to_month=None, batch_size=1000):
+        """ Generate the postings of an account for export, oldest first.
+
+        With subtree the postings of all accounts below the account are
+        included. The months (in the edited form mm-yyyy) limit the
+        postings to a range of months, both included. The rows are the
+        same as those of view_rows, with the value date. They are read
+        from the database in batches of batch_size, so any number of
+        postings can be exported in constant memory.
+        """
+
+        rows_query = cls._view_query()
+        if subtree:
+            rows_query = rows_query.filter(Postings.accounts_id.in_(
+                query(AccountTree.descendant_id).
+                filter(AccountTree.ancestor_id == account.id)))
+        else:
+            rows_query = rows_query.filter(Postings.accounts_id == account.id)
+        if from_month:
+            rows_query = rows_query.filter(
+                Postings.postmonth >= Postmonths.internal(from_month))
+        if to_month:
+            rows_query = rows_query.filter(
+                Postings.postmonth <= Postmonths.internal(to_month))
+        rows_query = rows_query.order_by(Postings.id).\
+            execution_options(stream_results=True).yield_per(batch_size)
+        for row in rows_query:
+            yield row
+
+    @classmethod
+    def rows_for_month(cls, postmonth, batch_size=1000):
+        """ Generate the postings of a postmonth, in the rows of
+        export_rows, read in batches of batch_size.
+        """
+
+        rows_query = cls._view_query().\
+            filter(Postings.postmonth == int(postmonth)).\
+            order_by(Postings.id).\
+            execution_options(stream_results=True).yield_per(batch_size)
+        for row in rows_query:
+            yield row
+
+    @classmethod
+    def _view_query(cls):
+        """ Set up the query for postings with account name and extkey """
+
+        return query(Postings.id, Postings.postmonth, Postings.value_date,
+                     Postings.amount, Postings.currency, Postings.debcred,
+                     Accounts.name.label('account'), Journals.extkey).\
+            join(Accounts, Postings.accounts_id == Accounts.id).\
+            join(Journals, Postings.journals_id == Journals.id)
 
     def _id_for_account(self, from_name):
         """ Get an ID for an account for which we only have the name
         """
 
-        account = Accounts.get_by_name(from_name)
-        return account.id
+        return account_keys.by_name(from_name).id
 
     @classmethod
     def get_by_id(cls, posting_id):
@@ -365,7 +897,88 @@ class Postings(db.Model):
         """
 
         account = Accounts.get_by_id(self.accounts_id)
-        account.post_amount(self.debcred, self.amount, self.value_date)
+        account.post_amount(self.debcred, self.amount, self.value_date,
+                            currency=self.currency)
+
+
+@event.listens_for(db.session, 'after_flush')
+def mark_ledger_changed(session, flush_context):
+    """ Mark a transaction that changes postings or balances, so the
+    cached views are refreshed when it commits.
+    """
+
+    for instance in list(session.new) + list(session.dirty) +\
+            list(session.deleted):
+        if isinstance(instance, (Postings, Balances)):
+            view_results.changed(session)
+            return
+
+
+journals_received = Counter('gledger_journals_received_total',
+                            'Journals received')
+
+journals_replayed = Counter('gledger_journals_replayed_total',
+                            'Journals delivered again and not added')
+
+journals_processed = Counter('gledger_journals_processed_total',
+                             'Journals posted or failed, by journalstat',
+                             labelnames=['journalstat'])
+
+journals_by_status = Gauge('gledger_journals',
+                           'Journals in the ledger, by journalstat',
+                           Journals.count_by_status,
+                           labelnames=['journalstat'])
+
+postings_per_journal = Histogram('gledger_postings_per_journal',
+                                 'Postings in the journals received',
+                                 buckets=[2, 3, 4, 6, 8, 12, 16, 25, 50,
+                                          100, 250, 1000])
+
+posting_latency = Histogram('gledger_journal_posting_latency_seconds',
+                            'Time from receiving a journal to posting it',
+                            buckets=[0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 300,
+                                     900, 3600, 14400, 86400])
+
+post_journals_seconds = Histogram('gledger_post_journals_seconds',
+                                  'Duration of posting a batch of journals',
+                                  buckets=[0.001, 0.0025, 0.005, 0.01, 0.025,
+                                           0.05, 0.1, 0.25, 0.5, 1, 2.5, 5,
+                                           10])
+
+
+def extkey_of(journdict):
+    """ Return the extkey of a journal dictionary, None if it has none """
+
+    try:
+        return journdict['journal']['extkey']
+    except (KeyError, TypeError):
+        return None
+
+
+def journal_label(journal):
+    """ Return how a journal is named in messages """
+
+    if journal.extkey is not None:
+        return str(journal.extkey)
+    if journal.id is not None:
+        return 'id ' + str(journal.id)
+    return '(new)'
+
+
+def format_amount(amount):
+    """ Return an amount for a message, without decimals if it has none """
+
+    return str(int(amount)) if amount == int(amount) else str(amount)
+
+
+def content_hash(journdict):
+    """ Return the hash of a journal dictionary, the same for the same
+    content however it is formatted.
+    """
+
+    canonical = json.dumps(journdict, sort_keys=True, separators=(',', ':'),
+                           default=str)
+    return sha256(canonical.encode('utf-8')).hexdigest()
 
 
 class PostingList(list):
@@ -374,15 +987,18 @@ class PostingList(list):
 
     The page info is the page number we are  on, the length of a page
     in records and the total number of available records over all
-    pages.
+    pages (None when not counted), and the cursor for the next page
+    (None on the last page).
     """
 
-    def __init__(self, posting_list, page=1, pagelength=25, num_records=None):
+    def __init__(self, posting_list, page=1, pagelength=25, num_records=None,
+                 next_cursor=None):
 
         self.extend(posting_list)
         self.page = page
         self.pagelength = pagelength
         self.num_records = num_records
+        self.next_cursor = next_cursor
 
 
 class JournalList(list):
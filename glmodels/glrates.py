@@ -0,0 +1,188 @@
+#    Copyright 2015 Menno Hölscher
+#
+#    This file is part of gledger.
+
+#    gledger is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Lesser General Public License as published
+#    by the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+
+#    gledger is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Lesser General Public License for more details.
+
+#    You should have received a copy of the GNU Lesser General Public License
+#    along with gledger.  If not, see <http://www.gnu.org/licenses/>.
+
+""" In this module we find the exchange rates, to report balances kept in
+several currencies in one currency: the ledger currency
+(LEDGER_CURRENCY, EUR by default).
+
+A rate is the amount in the ledger currency for one unit of a currency,
+from its date until the date of the next rate of that currency. The
+rates in use are cached in the process by currency and date
+(exchange_rates), so a report converts its rows with at most one query
+for the rates it did not convert with before.
+"""
+
+from datetime import datetime
+from decimal import Decimal, InvalidOperation, ROUND_HALF_EVEN
+from sqlalchemy import and_, event, func
+from gledger import app, db
+from glmodels import chunked
+from glmodels.glcache import LRUCache, view_results
+
+query = db.session.query
+
+
+class MissingRateError(ValueError):
+    """ There is no rate to convert a currency on a date """
+
+    pass
+
+
+class Rates(db.Model):
+    """ The rate of a currency from a date on.
+
+    Fields:
+        :currency: the currency code (ISO)
+        :rate_date: the first date the rate applies to
+        :rate: the amount in the ledger currency for one unit of currency
+        :updated_at: when the rate was set
+    """
+
+    __tablename__ = 'rates'
+    currency = db.Column(db.String(3), primary_key=True)
+    rate_date = db.Column(db.Date, primary_key=True)
+    rate = db.Column(db.Numeric(precision=18, scale=8), nullable=False)
+    updated_at = db.Column(db.DateTime)
+
+    @classmethod
+    def set_rate(cls, currency, rate_date, rate):
+        """ Set the rate of currency from rate_date on.
+
+        The cached rates and the cached views are dropped, now and when
+        the transaction commits, as they may have been converted with
+        the rate replaced. The snapshots of closed months converted with
+        it are written again when the rate is flushed (see
+        glmodels.glaccount.resnapshot_for_rates).
+        """
+
+        if currency == exchange_rates.currency:
+            raise ValueError('The ledger currency has no rate')
+        try:
+            rate = Decimal(str(rate))
+        except InvalidOperation:
+            raise ValueError('Invalid rate ' + str(rate))
+        if not rate > 0:
+            raise ValueError('A rate must be positive')
+        existing = query(cls).get((currency, rate_date))
+        if existing is None:
+            existing = cls(currency=currency, rate_date=rate_date)
+            db.session.add(existing)
+        existing.rate = rate
+        existing.updated_at = datetime.today()
+        db.session.info['rates_changed'] = True
+        exchange_rates.clear()
+        view_results.clear()
+        return existing
+
+    def __repr__(self):
+        return 'Rates(currency = {}, rate_date = {}, rate = {})'.\
+            format(self.currency, self.rate_date, self.rate)
+
+
+class ExchangeRates():
+    """ A cache of the rates to convert amounts to the ledger currency,
+    keyed by currency and the date converted on.
+
+    The rate on a date is the last rate at or before that date. Reports
+    convert on a few dates only (the last day of a postmonth, today), so
+    after the first report on a date its rates are found here. The cache
+    is bounded to RATE_CACHE_SIZE entries.
+    """
+
+    def __init__(self, currency='EUR', maxsize=1000):
+
+        self.currency = currency
+        self.cache = LRUCache(maxsize=maxsize)
+
+    def rates_on(self, currencies, on_date):
+        """ Return a dictionary of the rate per currency on on_date.
+
+        The rates not cached are read in one query (per chunk). Raises
+        MissingRateError if a currency has no rate on or before the date.
+        """
+
+        if isinstance(on_date, datetime):
+            on_date = on_date.date()
+        found = dict()
+        missing = []
+        for currency in set(currencies):
+            if currency == self.currency:
+                found[currency] = 1
+                continue
+            rate = self.cache.get((currency, on_date))
+            if rate is None:
+                missing.append(currency)
+            else:
+                found[currency] = rate
+        for currency_list in chunked(missing):
+            latest = query(Rates.currency,
+                           func.max(Rates.rate_date).label('rate_date')).\
+                filter(Rates.currency.in_(currency_list)).\
+                filter(Rates.rate_date <= on_date).\
+                group_by(Rates.currency).subquery()
+            for currency, rate in query(Rates.currency, Rates.rate).\
+                    join(latest, and_(Rates.currency == latest.c.currency,
+                                      Rates.rate_date == latest.c.rate_date)):
+                rate = Decimal(rate)
+                self.cache.put((currency, on_date), rate)
+                found[currency] = rate
+        for currency in missing:
+            if currency not in found:
+                raise MissingRateError('No rate for ' + str(currency) +
+                                       ' on ' + str(on_date))
+        return found
+
+    def convert(self, amounts, on_date):
+        """ Convert a list of (currency, amount) to the ledger currency.
+
+        The rates of all currencies in the list are looked up once, then
+        every amount is multiplied by its rate and rounded to a whole
+        cent. Amounts in the ledger currency are returned as they are.
+        """
+
+        amounts = list(amounts)
+        rates = self.rates_on({currency for currency, _ in amounts}, on_date)
+        return [amount if rates[currency] == 1 else
+                int((Decimal(amount) * rates[currency]).
+                    quantize(Decimal(1), rounding=ROUND_HALF_EVEN))
+                for currency, amount in amounts]
+
+    def total(self, amounts, on_date):
+        """ Return the sum of a list of (currency, amount) in the ledger
+        currency.
+        """
+
+        return sum(self.convert(amounts, on_date))
+
+    def clear(self):
+        """ Drop all cached rates """
+
+        self.cache.clear()
+
+
+exchange_rates = ExchangeRates(
+    currency=app.config.get('LEDGER_CURRENCY', 'EUR'),
+    maxsize=app.config.get('RATE_CACHE_SIZE', 1000))
+
+
+@event.listens_for(db.session, 'after_commit')
+def drop_replaced_rates(session):
+    """ Drop the cached rates and views after rates were set """
+
+    if session.info.pop('rates_changed', False):
+        exchange_rates.clear()
+        view_results.clear()
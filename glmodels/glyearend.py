@@ -19,21 +19,40 @@
 the models. It is about constructing the journal that will take care of
 starting the new year with expense and income accounts zeroised and
 profit taken to the balance sheet.
+
+A large chart of accounts is closed by a series of journals, each for
+a bounded number of accounts and each balanced by its own profit
+posting (see year_end_journals).
+
+Balances in other currencies than the ledger currency are closed in
+their own currency: a journal has a profit posting for every currency,
+so it balances in every currency and no exchange result is booked.
 """
 
 from datetime import datetime
 from dateutil.relativedelta import relativedelta
 from sqlalchemy import desc
 from gledger import db
-from glmodels.glaccount import Accounts, CloseDates, Postmonths
+from glmodels.glaccount import Accounts, CloseDates, Postmonths, postmonth_for
+from glmodels.glposting import Journals
+from glmodels.glrates import exchange_rates
 from json import dumps
 
 
 profit_account_key = "winst"
 
 class YearEndJournal(dict):
+    """ The journal nullifying the profit and loss accounts at year end.
+
+    The journal holds at most num_accounts accounts, the first ones in
+    order of id after after_account_id (if given), and the profit on
+    these accounts per currency. The id of the last account in the journal is kept in
+    last_account_id (None if there were no accounts left). If an extkey
+    is passed, it is put in the journal.
+    """
 
-    def __init__(self, start_next_year=None, num_accounts=250):
+    def __init__(self, start_next_year=None, num_accounts=250,
+                 after_account_id=None, extkey=None):
 
         last_close = db.session.query(CloseDates).\
             order_by(desc(CloseDates.closing_date)).first()
@@ -52,16 +71,25 @@ class YearEndJournal(dict):
             else:
                 raise ValueError('No previous closing date: pass one')
         self._check_postmonths_closed(self.start_next_year)
-        profit_loss_accounts = type(self).get_applicable_accounts(num_accounts=num_accounts)
+        profit_loss_balances = type(self).get_applicable_balances(
+            num_accounts=num_accounts, after_account_id=after_account_id,
+            postmonth=postmonth_for(self.start_next_year - relativedelta(days=1)))
         postings = list()
-        profit_amount = 0
-        for account in profit_loss_accounts:
+        profit_amounts = {exchange_rates.currency: 0}
+        self.last_account_id = None
+        for account in profit_loss_balances:
             postings.append(self.posting_dict_for(account))
-            counter = account.current_balance() if account.debit_credit() == 'Db'\
-                else - account.current_balance()
-            profit_amount += counter
-        postings.append(self.profit_posting(profit_amount))
+            profit_amounts[account.currency] = \
+                profit_amounts.get(account.currency, 0) +\
+                (account.balance if account.debit_credit() == 'Db'
+                 else - account.balance)
+            self.last_account_id = account.id
+        for currency in sorted(profit_amounts):
+            postings.append(self.profit_posting(profit_amounts[currency],
+                                                currency=currency))
         self["journal"] = {"function": "insert", "postings": postings}
+        if extkey is not None:
+            self["journal"]["extkey"] = extkey
 
     @classmethod
     def get_applicable_accounts(cls, num_accounts=None):
@@ -70,7 +98,6 @@ class YearEndJournal(dict):
 
         This routine just returns the accounts, contains no further
         processing
-        TODO Make the query a responsibility of Accounts!
         """
 
         q = db.session.query(Accounts).filter(Accounts.
@@ -79,6 +106,20 @@ class YearEndJournal(dict):
             q = q.limit(num_accounts)
         return q.all()
 
+    @classmethod
+    def get_applicable_balances(cls, num_accounts=None, after_account_id=None,
+                                postmonth=None):
+        """ Get the profit and loss accounts with their balance at the end
+        of postmonth (or the last known balance).
+
+        The balances of all accounts are read in one query, as a list of
+        AccountBalance with an entry for every currency of an account.
+        """
+
+        return Accounts.latest_balances(roles=['I', 'E'], limit=num_accounts,
+                                        after_id=after_account_id,
+                                        postmonth=postmonth)
+
     def _check_postmonths_closed(self, start_next_year):
         """ Check that all postmonths are CloseDates
 
@@ -95,21 +136,25 @@ class YearEndJournal(dict):
 
     def posting_dict_for(self, account):
         """ Create a dictionary for a posting nullifying balance on account
+
+        The account is an AccountBalance, holding the balance to nullify
+        in its currency.
         """
 
         posting = dict()
         posting['account'] = account.name
-        posting['currency'] = 'EUR'
-        posting['amount'] = -1 * account.current_balance()
+        posting['currency'] = account.currency
+        posting['amount'] = -1 * account.balance
         posting['debitcredit'] = account.debit_credit()
         posting['valuedate'] = self.start_next_year.strftime('%Y-%m-%d')
         return posting
 
-    def profit_posting(self, for_amount):
+    def profit_posting(self, for_amount, currency=None):
         """ Add the posting for the profit to the journal.
 
         The amount is considered debit, the account is asked for its sign
-        to get debit/credit. 
+        to get debit/credit. The currency is the ledger currency if not
+        passed.
         """
 
         account = db.session.query(Accounts).\
@@ -117,8 +162,8 @@ class YearEndJournal(dict):
         debit_account = account.is_debit()
         posting = dict()
         posting['account'] = account.name
-        posting['currency'] = 'EUR'
-        posting['amount'] = for_amount if debit_account else -1 * amount
+        posting['currency'] = currency or exchange_rates.currency
+        posting['amount'] = for_amount if debit_account else -1 * for_amount
         posting['debitcredit'] = account.debit_credit()
         posting['valuedate'] = self.start_next_year.strftime('%Y-%m-%d')
         return posting
@@ -128,3 +173,43 @@ class YearEndJournal(dict):
         """
 
         return dumps(self)
+
+
+def year_end_extkey(start_next_year, sequence):
+    """ Return the extkey of the sequence-th year end journal for the year
+    ending before start_next_year.
+    """
+
+    return 'yearend-{0:%Y%m%d}-{1:05d}'.format(start_next_year, sequence)
+
+
+def year_end_journals(start_next_year=None, num_accounts=250, skip_existing=True):
+    """ Generate the year end journals, each for at most num_accounts accounts.
+
+    Every journal balances by itself, as it has its own profit posting,
+    so the journals can be posted independently and in parallel. The
+    extkey of a journal is derived from the start of the next year and
+    the sequence number of the journal. The accounts are taken in order
+    of id, so a run that was interrupted yields the same journals again;
+    with skip_existing journals already delivered are left out.
+    """
+
+    journal = YearEndJournal(start_next_year=start_next_year,
+                             num_accounts=num_accounts)
+    start_next_year = journal.start_next_year
+    journal['journal']['extkey'] = year_end_extkey(start_next_year, 1)
+    existing = set()
+    if skip_existing:
+        prefix = year_end_extkey(start_next_year, 0)[:-5]
+        existing = set(extkey for extkey, in db.session.query(Journals.extkey).\
+            filter(Journals.extkey.like(prefix + '%')))
+    sequence = 1
+    while journal.last_account_id is not None:
+        if journal['journal']['extkey'] not in existing:
+            yield journal
+        sequence += 1
+        journal = YearEndJournal(start_next_year=start_next_year,
+                                 num_accounts=num_accounts,
+                                 after_account_id=journal.last_account_id,
+                                 extkey=year_end_extkey(start_next_year,
+                                                        sequence))
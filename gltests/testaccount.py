@@ -16,14 +16,17 @@
 #    along with gledger.  If not, see <http://www.gnu.org/licenses/>.
 
 import unittest
+from unittest import mock
 from decimal import Decimal
 import gledger
 import glviews.accountviews as accviews
 import glviews.forms as glforms
 import glmodels.glaccount as accmodel
+import glmodels.glcache as glcache
+import glmodels.glrates as glrates
 from sqlalchemy.exc import DatabaseError
 from sqlalchemy.orm.exc import NoResultFound
-from datetime import date,datetime
+from datetime import date, datetime, timedelta
 import logging
 
 class TestDBCreation(unittest.TestCase) :
@@ -285,6 +288,496 @@ class TestAccountStructures(unittest.TestCase) :
     def test_get_parent(self) :
         self.assertEqual(self.ch1.parentaccount().name, self.parent.name, 'Parentaccount returned should be the parent')
         
+class TestAccountKeys(unittest.TestCase):
+
+    def setUp(self):
+        self.acc51 = accmodel.Accounts.create_account(name='kaspost', role='A')
+        gledger.db.session.flush()
+
+    def tearDown(self):
+        gledger.db.session.rollback()
+
+    def test_keys_by_name(self):
+        """ The keys of an account are found by name """
+        account_key = accmodel.account_keys.by_name('kaspost')
+        self.assertEqual(account_key.id, self.acc51.id, 'Wrong id for name')
+        self.assertEqual(account_key.role, 'A', 'Wrong role for name')
+
+    def test_keys_cached(self):
+        """ A second lookup is answered from the cache """
+        accmodel.account_keys.by_name('kaspost')
+        hits = accmodel.account_keys.cache.hits
+        accmodel.account_keys.by_id(self.acc51.id)
+        self.assertEqual(accmodel.account_keys.cache.hits, hits + 1,
+                         'Lookup by id not cached')
+
+    def test_role_change_invalidates(self):
+        """ Changing the role of an account drops it from the cache """
+        accmodel.account_keys.by_name('kaspost')
+        self.acc51.update_role_or_parent(new_role='L')
+        self.assertEqual(accmodel.account_keys.by_name('kaspost').role, 'L',
+                         'Role change not seen')
+
+    def test_unknown_account(self):
+        """ An unknown account raises an error """
+        with self.assertRaises(accmodel.NoAccountError):
+            accmodel.account_keys.by_name('kasnotthere')
+
+    def test_rollback_clears(self):
+        """ A rollback clears the cache """
+        accmodel.account_keys.by_name('kaspost')
+        gledger.db.session.rollback()
+        self.assertNotIn(('name', 'kaspost'), accmodel.account_keys.cache,
+                         'Cache not cleared on rollback')
+
+    def test_savepoint_rollback_keeps(self):
+        """ Rolling back a savepoint leaves the caches alone """
+        accmodel.account_keys.by_name('kaspost')
+        glcache.view_results.changed(gledger.db.session())
+        gledger.db.session.begin_nested()
+        gledger.db.session.rollback()
+        self.assertIn(('name', 'kaspost'), accmodel.account_keys.cache,
+                      'Cache cleared on savepoint rollback')
+        self.assertIn(id(glcache.view_results),
+                      gledger.db.session.info.get('changed_results', ()),
+                      'Changed results dropped on savepoint rollback')
+
+    def test_keys_expire(self):
+        """ A role changed by another process is seen when the entry
+        expires
+        """
+        accmodel.account_keys.by_name('kaspost')
+        gledger.db.session.execute(accmodel.Accounts.__table__.update().
+            where(accmodel.Accounts.id == self.acc51.id).values(role='L'))
+        gledger.db.session.expire_all()
+        self.assertEqual(accmodel.account_keys.by_name('kaspost').role, 'A')
+        later = glcache.monotonic() + accmodel.account_keys.cache.ttl + 1
+        with mock.patch.object(glcache, 'monotonic', return_value=later):
+            self.assertEqual(accmodel.account_keys.by_name('kaspost').role,
+                             'L', 'Role change of other process not seen')
+
+
+class TestAccountTree(unittest.TestCase):
+
+    def setUp(self):
+        add_postmonths([201504, 201507, 201508])
+        self.acc52 = accmodel.Accounts.create_account(name='kantoor', role='E')
+        self.acc53 = accmodel.Accounts.create_account(name='papier', role='E',
+                                                      parent_name='kantoor')
+        self.acc54 = accmodel.Accounts.create_account(name='blokken', role='E',
+                                                      parent_name='papier')
+        self.acc55 = accmodel.Accounts.create_account(name='inventaris', role='E')
+        gledger.db.session.flush()
+        for account, postmonth, amount in [(self.acc52, 201507, 1726),
+                (self.acc54, 201507, 740), (self.acc54, 201508, 1814),
+                (self.acc55, 201504, 500)]:
+            account.balances.append(accmodel.Balances(postmonth=postmonth,
+                amount=amount, value_date=datetime(2015, 7, 1)))
+        gledger.db.session.flush()
+
+    def tearDown(self):
+        gledger.db.session.rollback()
+
+    def ancestors_of(self, account):
+        return {ancestor for (ancestor,) in
+                gledger.db.session.query(accmodel.AccountTree.ancestor_id).
+                filter_by(descendant_id=account.id)}
+
+    def test_paths_created(self):
+        """ A new account gets a path to all its ancestors """
+        self.assertEqual(self.ancestors_of(self.acc54),
+                         {self.acc52.id, self.acc53.id, self.acc54.id})
+
+    def test_subtree_balance(self):
+        """ The balance of a subtree is the sum of the last balances """
+        self.assertEqual(self.acc52.balance_ultimo(201506), 0)
+        self.assertEqual(self.acc52.balance_ultimo(201507), 2466)
+        self.assertEqual(self.acc52.balance_ultimo(201508), 3540)
+        self.assertEqual(self.acc53.balance_ultimo(201508), 1814)
+
+    def test_move_subtree(self):
+        """ Changing the parent moves the whole subtree """
+        self.acc53.update_role_or_parent(new_parent='inventaris')
+        gledger.db.session.flush()
+        self.assertEqual(self.ancestors_of(self.acc54),
+                         {self.acc55.id, self.acc53.id, self.acc54.id})
+        self.assertEqual(self.acc52.balance_ultimo(201508), 1726)
+        self.assertEqual(self.acc55.balance_ultimo(201508), 2314)
+
+    def test_rebuild(self):
+        """ The closure table can be rebuilt from the parent ids """
+        accmodel.AccountTree.rebuild()
+        self.assertEqual(self.ancestors_of(self.acc54),
+                         {self.acc52.id, self.acc53.id, self.acc54.id})
+        self.assertEqual(self.acc52.balance_ultimo(201508), 3540)
+
+
+class TestUltimoBalances(unittest.TestCase):
+
+    def setUp(self):
+        add_postmonths([201607, 201608])
+        self.acc60 = accmodel.Accounts.create_account(name='ub kantoor', role='E')
+        self.acc61 = accmodel.Accounts.create_account(name='ub papier', role='E',
+                                                      parent_name='ub kantoor')
+        self.acc62 = accmodel.Accounts.create_account(name='ub leeg', role='E')
+        gledger.db.session.flush()
+        for account, postmonth, amount in [(self.acc60, 201607, 300),
+                (self.acc61, 201607, 120), (self.acc61, 201608, 80)]:
+            account.balances.append(accmodel.Balances(postmonth=postmonth,
+                amount=amount, value_date=datetime(2016, 7, 1)))
+        gledger.db.session.flush()
+        self.pm = gledger.db.session.query(accmodel.Postmonths).\
+            filter_by(postmonth=201607).first()
+
+    def tearDown(self):
+        gledger.db.session.rollback()
+
+    def ultimo(self, account, postmonth):
+        return gledger.db.session.query(accmodel.UltimoBalances).\
+            get((account.id, postmonth))
+
+    def test_close_writes_snapshot(self):
+        """ Closing a month keeps the ultimo balance of the accounts """
+        self.pm.close()
+        self.assertEqual(self.ultimo(self.acc60, 201607).amount, 300)
+        self.assertEqual(self.ultimo(self.acc60, 201607).subtree_amount, 420)
+        self.assertEqual(self.ultimo(self.acc61, 201607).subtree_amount, 120)
+        self.assertIsNone(self.ultimo(self.acc62, 201607),
+                          'Snapshot for account without balances')
+
+    def test_closed_month_from_snapshot(self):
+        """ The balance of a closed month is read from the snapshot """
+        self.pm.close()
+        gledger.db.session.flush()
+        with mock.patch.object(accmodel.Balances, 'latest') as latest:
+            self.assertEqual(self.acc60.balance_ultimo(201607), 420)
+        latest.assert_not_called()
+        self.assertEqual(self.acc60.balance_ultimo(201608), 380)
+
+    def test_move_updates_snapshot(self):
+        """ Moving an account moves its amounts in the snapshots along """
+        self.pm.close()
+        self.acc61.update_role_or_parent(new_parent='ub leeg')
+        gledger.db.session.flush()
+        self.assertEqual(self.ultimo(self.acc60, 201607).subtree_amount, 300)
+        self.assertEqual(self.ultimo(self.acc62, 201607).amount, 0)
+        self.assertEqual(self.ultimo(self.acc62, 201607).subtree_amount, 120)
+        lines = {line.name: line for line in
+                 accmodel.TrialBalance(postmonth=201607)}
+        self.assertEqual(self.acc62.balance_ultimo(201607),
+                         lines['ub leeg'].subtotal)
+
+    @mock.patch.object(gledger.db.session, 'remove')
+    def test_move_changes_etag(self, remove):
+        """ The balance page of a closed month changes with a move """
+        self.pm.close()
+        gledger.db.session.flush()
+        client = gledger.app.test_client()
+        etag = client.get('/balance/ub%20kantoor/month/07-2016').\
+            headers['ETag']
+        self.acc61.update_role_or_parent(new_parent='ub leeg')
+        gledger.db.session.flush()
+        rv = client.get('/balance/ub%20kantoor/month/07-2016',
+                        headers={'If-None-Match': etag})
+        self.assertEqual(rv.status_code, 200, 'Stale balance not sent again')
+        self.assertIn(b'3.00', rv.data)
+
+    def test_reopen_discards_snapshot(self):
+        """ Reopening a month removes its snapshot """
+        accmodel.Postmonths.update_from_dict({'201607': 'c'})
+        self.assertIsNotNone(self.ultimo(self.acc60, 201607))
+        accmodel.Postmonths.update_from_dict({'201607': 'a'})
+        self.assertIsNone(self.ultimo(self.acc60, 201607))
+
+
+class TestTrialBalance(unittest.TestCase):
+
+    def setUp(self):
+        add_postmonths([201507, 201508])
+        self.acc56 = accmodel.Accounts.create_account(name='tb activa', role='A')
+        self.acc57 = accmodel.Accounts.create_account(name='tb bank', role='A',
+                                                      parent_name='tb activa')
+        self.acc58 = accmodel.Accounts.create_account(name='tb kas', role='A',
+                                                      parent_name='tb activa')
+        self.acc59 = accmodel.Accounts.create_account(name='tb omzet', role='I')
+        gledger.db.session.flush()
+        for account, postmonth, amount in [(self.acc57, 201507, 1000),
+                (self.acc57, 201508, 1500), (self.acc58, 201507, -200),
+                (self.acc59, 201507, 800)]:
+            account.balances.append(accmodel.Balances(postmonth=postmonth,
+                amount=amount, value_date=datetime(2015, 7, 1)))
+        gledger.db.session.flush()
+        self.app = gledger.app.test_client()
+        self.app.testing = True
+
+    def tearDown(self):
+        gledger.db.session.rollback()
+
+    def lines_for(self, postmonth):
+        return {line.name: line for line in
+                accmodel.TrialBalance(postmonth=postmonth)
+                if line.name.startswith('tb ')}
+
+    def test_balances_for_month(self):
+        """ The trial balance has the last balance of each account """
+        lines = self.lines_for(201507)
+        self.assertEqual(lines['tb bank'].balance, 1000)
+        self.assertEqual(self.lines_for(201508)['tb bank'].balance, 1500)
+        self.assertEqual(lines['tb activa'].balance, 0)
+
+    def test_subtotals(self):
+        """ The subtotal adds the accounts below an account """
+        lines = self.lines_for(201508)
+        self.assertEqual(lines['tb activa'].subtotal, 1300)
+        self.assertEqual(lines['tb activa'].level + 1, lines['tb kas'].level)
+
+    def test_debit_credit_split(self):
+        """ The balances are split in debit and credit """
+        lines = self.lines_for(201507)
+        self.assertEqual((lines['tb bank'].debit, lines['tb bank'].credit),
+                         (1000, 0))
+        self.assertEqual((lines['tb kas'].debit, lines['tb kas'].credit),
+                         (0, 200))
+        self.assertEqual((lines['tb omzet'].debit, lines['tb omzet'].credit),
+                         (0, 800))
+
+    def test_trial_balance_page(self):
+        """ The trial balance page shows the accounts """
+        rv = self.app.get('/trialbalance/month/07-2015')
+        self.assertIn(b'tb omzet', rv.data, 'Account not on trial balance')
+        self.assertIn(b'-2.00', rv.data, 'Subtotal not on trial balance')
+
+
+class TestViewResults(unittest.TestCase):
+
+    def setUp(self):
+        add_postmonths([201609, 201610])
+        self.acc63 = accmodel.Accounts.create_account(name='vr bank', role='A')
+        gledger.db.session.flush()
+        self.acc63.balances.append(accmodel.Balances(postmonth=201609,
+            amount=1250, value_date=datetime(2016, 9, 1)))
+        gledger.db.session.flush()
+
+    def tearDown(self):
+        gledger.db.session.rollback()
+
+    def test_closed_month_kept(self):
+        """ A view for a closed month is kept when the ledger changes """
+        gledger.db.session.query(accmodel.Postmonths).\
+            filter_by(postmonth=201609).first().close()
+        view1 = accviews.BalanceView.create_view(id=self.acc63.id,
+                                                 postmonth=201609)
+        glcache.view_results.bump()
+        view2 = accviews.BalanceView.create_view(id=self.acc63.id,
+                                                 postmonth=201609)
+        self.assertIs(view1, view2, 'Closed month view not kept')
+        self.assertEqual(view2.balance, 1250)
+
+    def test_open_month_refreshed(self):
+        """ A view for an open month is dropped when the ledger changes """
+        view3 = accviews.BalanceView.create_view(id=self.acc63.id,
+                                                 postmonth=201610)
+        self.assertIs(view3, accviews.BalanceView.create_view(
+            id=self.acc63.id, postmonth=201610), 'View not cached')
+        glcache.view_results.bump()
+        self.assertIsNot(view3, accviews.BalanceView.create_view(
+            id=self.acc63.id, postmonth=201610), 'Open month view kept')
+
+    @mock.patch.object(gledger.db.session, 'remove')
+    def test_change_elsewhere_matches_etag(self, remove):
+        """ A balance changed by another process is not sent from the
+        cache under the validator of the new balance
+        """
+        app = gledger.app.test_client()
+        rv1 = app.get('/balance/vr%20bank/month/10-2016')
+        self.assertIn(b'12.50', rv1.data, 'Wrong balance')
+        gledger.db.session.execute(accmodel.Balances.__table__.update().
+            where(accmodel.Balances.account_id == self.acc63.id).
+            values(amount=2000, updated_at=datetime.today()))
+        rv2 = app.get('/balance/vr%20bank/month/10-2016')
+        self.assertNotEqual(rv1.headers['ETag'], rv2.headers['ETag'])
+        self.assertIn(b'20.00', rv2.data, 'Cached balance sent as new')
+
+    def test_closed_again_elsewhere(self):
+        """ A month reopened and closed again by another process is not
+        shown from its former view
+        """
+        gledger.db.session.query(accmodel.Postmonths).\
+            filter_by(postmonth=201609).first().close()
+        gledger.db.session.flush()
+        view1 = accviews.BalanceView.create_view(id=self.acc63.id,
+                                                 postmonth=201609)
+        gledger.db.session.execute(accmodel.Balances.__table__.update().
+            where(accmodel.Balances.account_id == self.acc63.id).
+            values(amount=2000))
+        with mock.patch.object(accmodel, 'datetime') as later:
+            later.today.return_value = datetime.today() + timedelta(seconds=1)
+            accmodel.UltimoBalances.snapshot(201609)
+        view2 = accviews.BalanceView.create_view(id=self.acc63.id,
+                                                 postmonth=201609)
+        self.assertEqual((view1.balance, view2.balance), (1250, 2000),
+                         'Former view of closed month shown')
+
+    def test_commit_of_change_refreshes(self):
+        """ Committing a change to the balances drops views of open months """
+        accviews.BalanceView.create_view(id=self.acc63.id, postmonth=201610)
+        version = glcache.view_results.version
+        glcache.view_results.changed(gledger.db.session)
+        glcache.bump_result_caches(gledger.db.session)
+        self.assertEqual(glcache.view_results.version, version + 1)
+        self.assertEqual(len(glcache.view_results), 0, 'Views not dropped')
+
+
+class TestCurrencyBalances(unittest.TestCase):
+
+    def setUp(self):
+        add_postmonths([201507, 201508])
+        self.acc64 = accmodel.Accounts.create_account(name='cb activa', role='A')
+        self.acc65 = accmodel.Accounts.create_account(name='cb bank', role='A',
+                                                      parent_name='cb activa')
+        gledger.db.session.flush()
+        for account, postmonth, currency, amount in [
+                (self.acc65, 201507, 'EUR', 1000),
+                (self.acc65, 201507, 'USD', 500),
+                (self.acc64, 201508, 'USD', 200)]:
+            account.balances.append(accmodel.Balances(postmonth=postmonth,
+                currency=currency, amount=amount,
+                value_date=datetime(2015, 7, 1)))
+        glrates.Rates.set_rate('USD', date(2015, 7, 1), '0.9')
+        glrates.Rates.set_rate('USD', date(2015, 8, 15), '0.8')
+        gledger.db.session.flush()
+        self.app = gledger.app.test_client()
+        self.app.testing = True
+
+    def tearDown(self):
+        gledger.db.session.rollback()
+
+    def test_rate_on_date(self):
+        """ The rate on a date is the last one at or before it """
+        rates = glrates.exchange_rates
+        self.assertEqual(rates.rates_on(['USD', 'EUR'], date(2015, 7, 31)),
+                         {'USD': Decimal('0.9'), 'EUR': 1})
+        self.assertEqual(rates.rates_on(['USD'], date(2015, 8, 14)),
+                         {'USD': Decimal('0.9')})
+        self.assertEqual(rates.rates_on(['USD'], date(2015, 8, 31)),
+                         {'USD': Decimal('0.8')})
+
+    def test_rates_cached(self):
+        """ A rate used before on a date is not read again """
+        glrates.exchange_rates.rates_on(['USD'], date(2015, 7, 31))
+        with mock.patch.object(glrates, 'query') as rate_query:
+            glrates.exchange_rates.convert([('USD', 100), ('USD', 300)],
+                                           date(2015, 7, 31))
+        rate_query.assert_not_called()
+
+    def test_missing_rate(self):
+        """ Converting a currency without a rate on the date fails """
+        with self.assertRaises(glrates.MissingRateError):
+            glrates.exchange_rates.rates_on(['GBP'], date(2015, 7, 31))
+        with self.assertRaises(glrates.MissingRateError):
+            glrates.exchange_rates.rates_on(['USD'], date(2015, 6, 30))
+
+    def test_set_rate_drops_cached(self):
+        """ Setting a rate drops the rates cached """
+        glrates.exchange_rates.rates_on(['USD'], date(2015, 7, 31))
+        glrates.Rates.set_rate('USD', date(2015, 7, 20), '0.95')
+        self.assertEqual(glrates.exchange_rates.rates_on(['USD'],
+                                                         date(2015, 7, 31)),
+                         {'USD': Decimal('0.95')})
+
+    def test_convert_rounds(self):
+        """ Converted amounts are rounded to whole cents """
+        self.assertEqual(glrates.exchange_rates.convert(
+            [('USD', 333), ('EUR', 333)], date(2015, 7, 31)), [300, 333])
+
+    def test_balance_ultimo_converted(self):
+        """ The balance of a subtree is converted at the end of the month """
+        self.assertEqual(self.acc65.balance_ultimo(201507), 1450)
+        self.assertEqual(self.acc64.balance_ultimo(201508), 1560)
+
+    def test_trial_balance_converted(self):
+        """ The trial balance is in the ledger currency """
+        lines = {line.name: line for line in
+                 accmodel.TrialBalance(postmonth=201508)
+                 if line.name.startswith('cb ')}
+        self.assertEqual(lines['cb bank'].balance, 1400)
+        self.assertEqual(lines['cb activa'].balance, 160)
+        self.assertEqual(lines['cb activa'].subtotal, 1560)
+        rv = self.app.get('/trialbalance/month/08-2015')
+        self.assertIn(b'(EUR)', rv.data, 'No currency on trial balance')
+        self.assertIn(b'15.60', rv.data, 'Subtotal not converted')
+
+    def test_snapshot_converted(self):
+        """ A closed month keeps its balances converted """
+        gledger.db.session.query(accmodel.Postmonths).\
+            filter_by(postmonth=201507).first().close()
+        ultimo = gledger.db.session.query(accmodel.UltimoBalances).\
+            get((self.acc65.id, 201507))
+        self.assertEqual((ultimo.amount, ultimo.subtree_amount), (1450, 1450))
+
+    def test_rate_rewrites_snapshot(self):
+        """ Setting a rate for a closed month writes its snapshot again """
+        gledger.db.session.query(accmodel.Postmonths).\
+            filter_by(postmonth=201507).first().close()
+        gledger.db.session.flush()
+        glrates.Rates.set_rate('USD', date(2015, 8, 20), '0.5')
+        gledger.db.session.flush()
+        ultimo = gledger.db.session.query(accmodel.UltimoBalances).\
+            get((self.acc65.id, 201507))
+        self.assertEqual(ultimo.amount, 1450, 'Later rate used')
+        glrates.Rates.set_rate('USD', date(2015, 7, 20), '0.95')
+        gledger.db.session.flush()
+        gledger.db.session.expire_all()
+        ultimo = gledger.db.session.query(accmodel.UltimoBalances).\
+            get((self.acc65.id, 201507))
+        self.assertEqual(ultimo.amount, 1475, 'Snapshot not written again')
+        self.assertEqual(accmodel.UltimoBalances.converted_with(
+            'USD', date(2015, 8, 15)), [], 'Month after next rate')
+
+    @mock.patch.object(gledger.db.session, 'remove')
+    def test_close_missing_rate(self, remove):
+        """ A month that can not be converted is not closed """
+        self.acc65.balances.append(accmodel.Balances(postmonth=201507,
+            currency='GBP', amount=100, value_date=datetime(2015, 7, 1)))
+        gledger.db.session.flush()
+        rv = self.app.post('/postmonthlist', data={'201507': 'c'})
+        self.assertEqual(rv.status_code, 400, 'Missing rate not reported')
+        self.assertIn(b'GBP', rv.data, 'Currency not reported')
+        gledger.db.session.query(accmodel.Postmonths).\
+            filter_by(postmonth=201507).first().monthstat = 'c'
+        with mock.patch.object(gledger.db.session, 'commit',
+                               gledger.db.session.flush):
+            result = gledger.app.test_cli_runner().invoke(
+                args=['snapshot-closed-months'])
+        self.assertEqual(result.exit_code, 1, 'Command did not fail')
+        self.assertIn('No rate for GBP', result.output, 'No message')
+
+    @mock.patch.object(gledger.db.session, 'remove')
+    def test_balance_etag_rates(self, remove):
+        """ Setting a rate changes the validator of an open month """
+        rv = self.app.get('/balance/cb%20bank')
+        etag = rv.headers['ETag']
+        glrates.Rates.set_rate('USD', date(2015, 9, 1), '0.7')
+        gledger.db.session.flush()
+        rv = self.app.get('/balance/cb%20bank',
+                          headers={'If-None-Match': etag})
+        self.assertEqual(rv.status_code, 200, 'Converted balance not sent')
+
+    def test_balance_per_currency(self):
+        """ Posting in another currency keeps a balance of its own """
+        self.acc65.post_amount('Db', Decimal('100'), datetime.today(),
+                               currency='USD')
+        self.acc65.post_amount('Db', Decimal('40'), datetime.today())
+        accmodel.Balances.apply_amounts({(self.acc65.id,
+            accmodel.postmonth_today(), 'USD'): Decimal('25')})
+        gledger.db.session.flush()
+        balances = gledger.db.session.query(accmodel.Balances.currency,
+                                            accmodel.Balances.amount).\
+            filter_by(account_id=self.acc65.id,
+                      postmonth=accmodel.postmonth_today())
+        self.assertEqual(sorted(balances), [('EUR', 40), ('USD', 125)])
+
+
 class TestPostmonthActions(unittest.TestCase):
     
     def tearDown(self):
@@ -349,6 +842,40 @@ class TestPostmonthActions(unittest.TestCase):
         gledger.db.session.flush()
         self.assertFalse(pm3.status_can_post(), 'Can post to closed month')
 
+    def test_status_of_postmonth(self):
+        """ The status of a postmonth is read once, then cached """
+
+        pm4 = accmodel.Postmonths(postmonth=201710, monthstat = 'a')
+        pm4.add()
+        gledger.db.session.flush()
+        self.assertEqual(accmodel.Postmonths.status_of(201710), 'a')
+        hits = accmodel.postmonth_status.hits
+        self.assertEqual(accmodel.Postmonths.status_of(201710), 'a')
+        self.assertEqual(accmodel.postmonth_status.hits, hits + 1,
+                         'Status not cached')
+
+    def test_close_refreshes_status(self):
+        """ Closing a postmonth is seen by the status check """
+
+        pm5 = accmodel.Postmonths(postmonth=201711, monthstat = 'a')
+        pm5.add()
+        gledger.db.session.flush()
+        self.assertEqual(accmodel.Postmonths.status_of(201711), 'a')
+        pm5.close()
+        self.assertEqual(accmodel.Postmonths.status_of(201711), 'c')
+        with self.assertRaises(ValueError):
+            accmodel.Balances.check_postmonth(201711)
+
+    def test_update_refreshes_status(self):
+        """ Updating postmonths from a dictionary is seen by the status check """
+
+        pm6 = accmodel.Postmonths(postmonth=201712, monthstat = 'a')
+        pm6.add()
+        gledger.db.session.flush()
+        self.assertEqual(accmodel.Postmonths.status_of(201712), 'a')
+        accmodel.Postmonths.update_from_dict({'201712': 'c'})
+        self.assertEqual(accmodel.Postmonths.status_of(201712), 'c')
+
 class TestPostmonthList(unittest.TestCase):
 
     def setUp(self):
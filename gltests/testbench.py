@@ -0,0 +1,96 @@
+#    Copyright 2015 Menno Hölscher
+#
+#    This file is part of gledger.
+
+#    gledger is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Lesser General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+
+#    gledger is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Lesser General Public License for more details.
+
+#    You should have received a copy of the GNU Lesser General Public License
+#    along with gledger.  If not, see <http://www.gnu.org/licenses/>.
+
+import unittest
+from glbench.benchmark import compare, percentile
+from glbench.generator import LedgerGenerator, LedgerSpec, PROFIT_ACCOUNT
+
+
+class TestLedgerGenerator(unittest.TestCase):
+
+    def setUp(self):
+
+        self.spec = LedgerSpec(seed=7, depth=3, accounts=40,
+                               journals_per_month=10, postings_per_journal=5,
+                               currencies=3)
+        self.generator = LedgerGenerator(self.spec)
+
+    def test_same_seed_same_ledger(self):
+        """ The same spec generates the same chart and journals """
+
+        other = LedgerGenerator(self.spec)
+        self.assertEqual(self.generator.chart, other.chart)
+        self.assertEqual(list(self.generator.journals(201703)),
+                         list(other.journals(201703)))
+
+    def test_chart(self):
+        """ The chart has the accounts and depth of the spec, parents
+        before children
+        """
+
+        names = [name for (name, _, _) in self.generator.chart]
+        self.assertEqual(len(names), self.spec.accounts + 1)
+        self.assertIn(PROFIT_ACCOUNT, names)
+        depth = {}
+        for (name, _, parent) in self.generator.chart:
+            self.assertTrue(parent is None or parent in depth)
+            depth[name] = 1 if parent is None else depth[parent] + 1
+        self.assertEqual(max(depth.values()), self.spec.depth)
+
+    def test_journals_balance(self):
+        """ Every journal balances in its one currency """
+
+        journals = list(self.generator.journals(201712))
+        self.assertEqual(len(journals), self.spec.journals_per_month)
+        for journal in journals:
+            postings = journal['journal']['postings']
+            self.assertEqual(len(postings), self.spec.postings_per_journal)
+            self.assertEqual(len(set(p['currency'] for p in postings)), 1)
+            self.assertEqual(sum(p['amount'] if p['debitcredit'] == 'Db'
+                                 else -p['amount'] for p in postings), 0)
+            self.assertTrue(all(p['valuedate'].startswith('2017-12')
+                                for p in postings))
+
+    def test_postmonths(self):
+        """ The postmonths run over the year end """
+
+        spec = self.spec._replace(first_month=201711, months=3)
+        self.assertEqual(LedgerGenerator(spec).postmonths(),
+                         [201711, 201712, 201801])
+
+
+class TestBenchmarkResults(unittest.TestCase):
+
+    def test_percentile(self):
+        """ Percentiles are the nearest rank, in milliseconds """
+
+        durations = [i / 1000 for i in range(1, 101)]
+        self.assertEqual(percentile(durations, 50), 50)
+        self.assertEqual(percentile(durations, 99), 99)
+        self.assertIsNone(percentile([], 50))
+
+    def test_compare(self):
+        """ More statements or a slower median are regressions """
+
+        baseline = {'a': {'queries_per_run': 2, 'p50_ms': 10},
+                    'b': {'queries_per_run': 2, 'p50_ms': 10}}
+        results = {'a': {'queries_per_run': 2, 'p50_ms': 11.5},
+                   'b': {'queries_per_run': 3, 'p50_ms': 13},
+                   'c': {'queries_per_run': 9, 'p50_ms': 99}}
+        regressions = compare(results, baseline, tolerance=0.2)
+        self.assertEqual(len(regressions), 2)
+        self.assertTrue(all(r.startswith('b:') for r in regressions))
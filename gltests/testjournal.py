@@ -16,14 +16,35 @@
 #    along with gledger.  If not, see <http://www.gnu.org/licenses/>.
 
 import unittest
+from unittest import mock
 from datetime import date, datetime
+from decimal import Decimal
 import logging
 import json
-from sqlalchemy.exc import DatabaseError
+import os
+import tempfile
+import threading
+from sqlalchemy.exc import DatabaseError, OperationalError
 import gledger
+import gledger.groupcommit as groupcommit
+import gledger.postingworker as postingworker
+import gledger.spool as spool
+from gledger.instrumentation import add_collector, record_queries,\
+    remove_collector
 import glviews.postingviews as postviews
 import glmodels.glposting as posts
 import glmodels.glaccount as accmodel
+import glmodels.glcolumnar as columnar
+from glmodels import glmetrics
+from gltests.testaccount import add_postmonths
+
+def count_statements(action):
+    """ Run action, returning the number of SQL statements it executed """
+
+    with record_queries() as stats:
+        action()
+    return stats.count
+
 
 class testPostCreation(unittest.TestCase) :
     def setUp(self) :
@@ -410,6 +431,16 @@ class TestJournalView(unittest.TestCase):
 
         journal_view4 = postviews.JournalView(self.journ8id)
         self.assertEqual(len(journal_view4.as_dict()['postings']), 3, 'Incorrect number of postingviews')
+
+    def test_journalview_reads_postings_once(self):
+        """ The postings of a journal view are read in one query """
+
+        journal_view5 = postviews.JournalView(self.journ8id)
+        self.assertEqual(count_statements(journal_view5.as_dict), 0,
+                         'Postings read again')
+        self.assertEqual(count_statements(
+            lambda: journal_view5.createpostingviews_for_journal(
+                journal_id=self.journ8id)), 1, 'Too many queries')
         
 class TestViewJournal(unittest.TestCase):
 
@@ -449,6 +480,28 @@ class TestViewJournal(unittest.TestCase):
         self.assertIn(b'kas', rv.data, '"kas" not in response')
         self.assertIn(b'btw (ontvangen)', rv.data, '"btw" not in response')
 
+    @mock.patch.object(gledger.db.session, 'remove')
+    def test_journal_not_modified(self, remove):
+        """ A journal that did not change is answered with 304 """
+
+        rv = self.app.get('/journal/RK7098')
+        self.assertIn('ETag', rv.headers, 'No ETag for journal')
+        rv = self.app.get('/journal/RK7098',
+                          headers={'If-None-Match': rv.headers['ETag']})
+        self.assertEqual(rv.status_code, 304, 'Unchanged journal sent again')
+
+    @mock.patch.object(gledger.db.session, 'remove')
+    def test_changed_journal_sent(self, remove):
+        """ A journal that changed is sent again """
+
+        rv = self.app.get('/journal/RK7098')
+        self.journ10.journalstat = posts.Journals.PROCESSED
+        gledger.db.session.flush()
+        rv = self.app.get('/journal/RK7098',
+                          headers={'If-None-Match': rv.headers['ETag']})
+        self.assertEqual(rv.status_code, 200, 'Changed journal not sent')
+        self.assertIn(b'status P', rv.data, 'Journal not in response')
+
 class TestAccountPostingViewing(unittest.TestCase):
 
     def setUp(self):
@@ -497,6 +550,32 @@ class TestAccountPostingViewing(unittest.TestCase):
         post_list4 = posts.Postings.postings_for_account(self.kas_account, month='09-2016')
         self.assertEqual(len(post_list4), 17, 'Wrong number of postings')
 
+    def test_cursor_continues_list(self):
+        """ A cursor continues the list after the last posting of a page """
+
+        page1 = posts.Postings.postings_for_account(self.kas_account, pagelength=20)
+        page2 = posts.Postings.postings_for_account(self.kas_account, pagelength=20,
+                                                    cursor=page1.next_cursor)
+        self.assertEqual(len(page2), 20, 'Wrong number of postings')
+        self.assertFalse(set(p.id for p in page1) & set(p.id for p in page2),
+                         'Pages overlap')
+        self.assertIsNone(page2.num_records, 'Postings counted for cursor')
+
+    def test_cursor_on_last_page(self):
+        """ The last page has no cursor to continue from """
+
+        page1 = posts.Postings.postings_for_account(self.kas_account, pagelength=30)
+        page2 = posts.Postings.postings_for_account(self.kas_account, pagelength=30,
+                                                    cursor=page1.next_cursor)
+        self.assertEqual(len(page2), 20, 'Wrong number of postings')
+        self.assertIsNone(page2.next_cursor, 'Cursor on last page')
+
+    def test_invalid_cursor_fails(self):
+        """ A cursor that can not be decoded is refused """
+
+        with self.assertRaises(posts.InvalidCursorError):
+            posts.Postings.postings_for_account(self.kas_account, cursor='x-y')
+
 
 class TestPostingsByAccountView(unittest.TestCase):
 
@@ -562,6 +641,15 @@ class TestPostingsByAccountView(unittest.TestCase):
         posting_view6 = postviews.PostingByAccountView(self.kas_account, page=2)
         self.assertEqual(posting_view6.page, 2, 'Wrong or no view page')        
 
+    def test_view_dict_in_one_query(self):
+        """ The dictionary for a page of postings takes one query """
+
+        posting_view7 = postviews.PostingByAccountView(self.kas_account)
+        self.assertEqual(count_statements(posting_view7.as_dict), 1,
+                         'Too many queries')
+        self.assertEqual(posting_view7.as_dict()['postings'][0]['extkey'],
+                         'DR990', 'Wrong extkey')
+
 
 class TestViewPostingsAccount(unittest.TestCase):
 
@@ -610,6 +698,160 @@ class TestViewPostingsAccount(unittest.TestCase):
         self.assertIn(b'21.76', rv.data, 'Amount for 09-2017 not in list')
         self.assertNotIn(b'195.84', rv.data, 'Amount for 08-2017 in list')
 
+    def test_older_postings_keep_month(self):
+        """ The link to older postings stays in the month selected """
+
+        rv = self.app.get("/posts/kas/month/08-2017")
+        self.assertIn(b'/posts/kas/month/08-2017?cursor=', rv.data,
+                      'Month lost by link to older postings')
+
+    def test_invalid_page(self):
+        """ A page that is not a number is refused """
+
+        rv = self.app.get("/posts/kas?page=abc")
+        self.assertEqual(rv.status_code, 400, 'Invalid page accepted')
+
+    @mock.patch.object(gledger.db.session, 'remove')
+    def test_new_posting_changes_list(self, remove):
+        """ The list is not sent again until a posting is added """
+
+        rv = self.app.get("/posts/kas")
+        etag = rv.headers['ETag']
+        rv = self.app.get("/posts/kas", headers={'If-None-Match': etag})
+        self.assertEqual(rv.status_code, 304, 'Unchanged list sent again')
+        create_posting_to_kas(self, 1000, 201709, self.journ12.id)
+        gledger.db.session.flush()
+        rv = self.app.get("/posts/kas", headers={'If-None-Match': etag})
+        self.assertEqual(rv.status_code, 200, 'Changed list not sent')
+
+
+class TestPostingExport(unittest.TestCase):
+
+    def setUp(self):
+
+        create_accounts(self)
+        self.journ13 = posts.Journals(journalstat = posts.Journals.UNPROCESSED,\
+                                extkey='EX1616')
+        self.journ13.add()
+        gledger.db.session.flush()
+        for i in range(30):
+            create_posting_to_kas(self, 100 + i, 201708 if i < 10 else 201709,
+                                  self.journ13.id)
+        self.acc9 = accmodel.Accounts.create_account(name='kleine kas', role='A',
+                                                     parent_name='kas')
+        gledger.db.session.flush()
+        posts.Postings(accounts_id=self.acc9.id, journals_id=self.journ13.id,
+                       postmonth=201709, value_date=datetime(2017, 9, 3),
+                       amount=999, debcred='Db').add()
+        gledger.db.session.flush()
+        self.kas_account = accmodel.Accounts.get_by_name('kas')
+        self.app = gledger.app.test_client()
+        self.app.testing = True
+
+    def tearDown(self):
+
+        gledger.db.session.rollback()
+
+    def test_export_csv(self):
+        """ The export in CSV has a header and a line per posting """
+
+        lines = ''.join(postviews.PostingExport(self.kas_account).lines()).\
+            splitlines()
+        self.assertEqual(len(lines), 31, 'Wrong number of lines')
+        self.assertTrue(lines[0].startswith('id,extkey,account'), 'No header')
+        self.assertIn('EX1616,kas,08-2017', lines[1], 'Wrong posting')
+
+    def test_export_ndjson(self):
+        """ The export in ndjson has a JSON object per posting """
+
+        lines = list(postviews.PostingExport(self.kas_account,
+            export_format='ndjson', from_month='09-2017').lines())
+        self.assertEqual(len(lines), 20, 'Wrong number of postings')
+        self.assertEqual(json.loads(lines[0])['amount'], '1.10',
+                         'Wrong amount')
+
+    def test_export_subtree(self):
+        """ The postings of the accounts below can be included """
+
+        lines = list(postviews.PostingExport(self.kas_account,
+            export_format='ndjson', subtree=True, to_month='09-2017').lines())
+        self.assertEqual(len(lines), 31, 'Wrong number of postings')
+        self.assertEqual(json.loads(lines[-1])['account'], 'kleine kas',
+                         'Subtree posting not exported')
+
+    def test_invalid_month_refused(self):
+        """ A month range that can not be read is refused before export """
+
+        with self.assertRaises(accmodel.InvalidPostmonthError):
+            postviews.PostingExport(self.kas_account, from_month='2017-09')
+
+    def test_export_route(self):
+        """ The export is streamed by the export route """
+
+        rv = self.app.get('/export/kas?format=ndjson&subtree=yes')
+        self.assertEqual(rv.mimetype, 'application/x-ndjson')
+        self.assertEqual(len(rv.data.splitlines()), 31,
+                         'Wrong number of postings')
+        rv = self.app.get('/export/kas?format=xml')
+        self.assertEqual(rv.status_code, 400, 'Unknown format accepted')
+
+
+@unittest.skipIf(columnar.pyarrow is None, 'pyarrow is not installed')
+class TestColumnarExport(unittest.TestCase):
+
+    def setUp(self):
+
+        create_accounts(self)
+        add_postmonths([201808, 201809])
+        self.journ14 = posts.Journals(journalstat = posts.Journals.UNPROCESSED,\
+                                extkey='CE1808')
+        self.journ14.add()
+        gledger.db.session.flush()
+        for i in range(12):
+            create_posting_to_kas(self, 1000 + i, 201808 if i < 5 else 201809,
+                                  self.journ14.id)
+        self.acc7.balances.append(accmodel.Balances(postmonth=201808,
+            amount=5010, value_date=datetime(2018, 8, 31)))
+        gledger.db.session.flush()
+        gledger.db.session.query(accmodel.Postmonths).\
+            filter_by(postmonth=201808).first().close()
+        gledger.db.session.flush()
+        self.directory = tempfile.TemporaryDirectory()
+        self.export = columnar.ColumnarExport(self.directory.name,
+                                              batch_size=2)
+
+    def tearDown(self):
+
+        self.directory.cleanup()
+        gledger.db.session.rollback()
+
+    def test_closed_month_exported(self):
+        """ The postings and balances of a closed month are written """
+
+        exported = self.export.export()
+        self.assertIn(201808, exported, 'Closed month not exported')
+        self.assertNotIn(201809, exported, 'Open month exported')
+        postings = columnar.parquet.read_table(
+            self.export.partition('postings', 201808))
+        self.assertEqual(postings.num_rows, 5, 'Wrong number of postings')
+        self.assertEqual(postings.column('amount').to_pylist(),
+                         [1000, 1001, 1002, 1003, 1004], 'Wrong amounts')
+        self.assertEqual(str(postings.schema.field('account').type),
+                         'dictionary<values=string, indices=int32, ordered=0>')
+        balances = columnar.parquet.read_table(
+            self.export.partition('balances', 201808)).to_pylist()
+        self.assertIn(5010, [balance['amount'] for balance in balances
+                             if balance['account'] == 'kas'])
+
+    def test_export_is_incremental(self):
+        """ A month that was exported before is not exported again """
+
+        self.export.export()
+        self.assertNotIn(201808, self.export.export(),
+                         'Month exported again')
+        self.assertFalse(os.path.exists(
+            self.export.partition('postings', 201808) + '.tmp'))
+
 
 class TestJournalSearchList(unittest.TestCase):
 
@@ -794,7 +1036,817 @@ class TestJournalListFunctions(unittest.TestCase):
         for extkey in extkeys:
             self.assertNotIn(extkey.encode(), rv2.data, 'Duplicaten in 2e pagina')
 
-        
+
+class TestBatchPosting(unittest.TestCase):
+
+    def setUp(self):
+
+        create_accounts(self)
+        self.journ15 = posts.Journals(journalstat=posts.Journals.UNPROCESSED,\
+                                extkey='BP1501')
+        self.journ15.add()
+        self.journ16 = posts.Journals(journalstat=posts.Journals.UNPROCESSED,\
+                                extkey='BP1502')
+        self.journ16.add()
+        gledger.db.session.flush()
+        posting_to_journal(self.journ15)
+        posting_to_journal(self.journ16)
+        gledger.db.session.flush()
+
+    def tearDown(self):
+
+        gledger.db.session.rollback()
+
+    def test_post_batch(self):
+        """ A batch of journals is posted to the accounts """
+
+        posts.Journals.post_journals([self.journ15, self.journ16])
+        self.assertEqual(accmodel.Accounts.get_by_name("kas").current_balance(),
+                         460, 'Account not correctly updated (kas)')
+        self.assertEqual(accmodel.Accounts.get_by_name("verkopen").current_balance(),
+                         -500, 'Account not correctly updated (verkopen)')
+
+    def test_one_balance_per_month(self):
+        """ Postings to the same account and month share one balance row """
+
+        posts.Journals.post_journals([self.journ15, self.journ16])
+        gledger.db.session.flush()
+        kas = accmodel.Accounts.get_by_name("kas")
+        self.assertEqual(len(kas.balances), 1, 'More than one balance row')
+
+    def test_batch_status_processed(self):
+        """ All journals in the batch are marked processed """
+
+        posts.Journals.post_journals([self.journ15, self.journ16])
+        self.assertEqual(self.journ15.journalstat, posts.Journals.PROCESSED)
+        self.assertEqual(self.journ16.journalstat, posts.Journals.PROCESSED)
+
+    def test_unbalanced_batch_posts_nothing(self):
+        """ If one journal does not balance, no balance is touched """
+
+        post16 = posts.Postings(accounts_id = accmodel.Accounts.get_by_name("kas").id,
+                                journals_id = self.journ16.id, postmonth = 201609,
+                                value_date = datetime.now(), amount=5, debcred='Db')
+        post16.add()
+        gledger.db.session.flush()
+        gledger.db.session.expire(self.journ16, ['journalpostings'])
+        with self.assertRaises(posts.JournalBalanceError):
+            posts.Journals.post_journals([self.journ15, self.journ16])
+        self.assertEqual(accmodel.Accounts.get_by_name("kas").current_balance(),
+                         0, 'Balance updated for unbalanced batch')
+
+    def test_post_batch_atomic(self):
+        """ Balances can be incremented in the database """
+
+        posts.Journals.post_journals([self.journ15], atomic=True)
+        posts.Journals.post_journals([self.journ16], atomic=True)
+        kas = accmodel.Accounts.get_by_name("kas")
+        self.assertEqual(kas.current_balance(), 460,
+                         'Account not correctly updated (kas)')
+        self.assertEqual(len(kas.balances), 1, 'More than one balance row')
+        self.assertEqual(accmodel.Accounts.get_by_name("verkopen").current_balance(),
+                         -500, 'Account not correctly updated (verkopen)')
+
+    def test_atomic_insert_race(self):
+        """ A balance row inserted by another process after the update
+        found none gets the increment
+        """
+
+        kas = accmodel.Accounts.get_by_name("kas")
+        postmonth = accmodel.postmonth_today()
+        increment = accmodel.Balances._increment
+        raced = []
+
+        def insert_elsewhere(account_id, postmonth, currency, delta):
+            if raced:
+                return increment(account_id, postmonth, currency, delta)
+            raced.append(delta)
+            gledger.db.session.execute(accmodel.Balances.__table__.insert().
+                values(account_id=account_id, postmonth=postmonth,
+                       currency=currency, amount=100,
+                       value_date=datetime.today()))
+            return 0
+
+        with mock.patch.object(accmodel.Balances, '_increment',
+                               side_effect=insert_elsewhere):
+            accmodel.Balances.apply_amounts_atomic(
+                {(kas.id, postmonth, 'EUR'): Decimal('60')})
+        amounts = gledger.db.session.query(accmodel.Balances.amount).\
+            filter_by(account_id=kas.id, postmonth=postmonth).all()
+        self.assertEqual(amounts, [(160,)], 'Increment of race lost')
+
+    def test_month_closed_elsewhere(self):
+        """ A month closed by another process is not posted to, even if
+        its status is still cached as active
+        """
+
+        postmonth = accmodel.postmonth_today()
+        accmodel.Postmonths(postmonth=postmonth, monthstat='a').add()
+        gledger.db.session.flush()
+        self.assertEqual(accmodel.Postmonths.status_of(postmonth), 'a')
+        gledger.db.session.execute(accmodel.Postmonths.__table__.update().
+            where(accmodel.Postmonths.postmonth == postmonth).
+            values(monthstat='c'))
+        with self.assertRaises(ValueError):
+            posts.Journals.post_journals([self.journ15])
+        self.assertEqual(accmodel.Postmonths.status_of(postmonth), 'c',
+                         'Status read not cached')
+
+
+class TestPostingQueue(unittest.TestCase):
+
+    def setUp(self):
+
+        create_accounts(self)
+        self.journ17 = posts.Journals(journalstat=posts.Journals.UNPROCESSED,\
+                                extkey='PQ1701')
+        self.journ17.add()
+        self.journ18 = posts.Journals(journalstat=posts.Journals.UNPROCESSED,\
+                                extkey='PQ1702')
+        self.journ18.add()
+        gledger.db.session.flush()
+        posting_to_journal(self.journ17)
+        post17 = posts.Postings(accounts_id = accmodel.Accounts.get_by_name("kas").id,
+                                journals_id = self.journ18.id, postmonth = 201609,
+                                value_date = datetime.now(), amount=17, debcred='Db')
+        post17.add()
+        gledger.db.session.flush()
+        # The queue commits its claims; keep the test in one transaction
+        self.no_commit = mock.patch.object(gledger.db.session, 'commit',
+                                           gledger.db.session.flush)
+        self.no_commit.start()
+
+    def tearDown(self):
+
+        self.no_commit.stop()
+        gledger.db.session.rollback()
+
+    def test_claim_journals(self):
+        """ Unprocessed journals are claimed by a worker """
+
+        claimed = posts.Journals.claim_unprocessed('test', batch_size=1000)
+        self.assertIn(self.journ17, claimed, 'Journal not claimed')
+        self.assertTrue(self.journ17.leased_by.startswith('test:'),
+                        'No lease on claimed journal')
+
+    def test_claimed_not_claimed_again(self):
+        """ A claimed journal is not handed to another worker """
+
+        posts.Journals.claim_unprocessed('test1', batch_size=1000)
+        claimed = posts.Journals.claim_unprocessed('test2', batch_size=1000)
+        self.assertNotIn(self.journ17, claimed, 'Journal claimed twice')
+
+    def test_process_claimed(self):
+        """ Claimed journals are posted or marked failed """
+
+        claimed = posts.Journals.claim_unprocessed('test', batch_size=1000)
+        claimed = [journal for journal in claimed
+                   if journal in (self.journ17, self.journ18)]
+        failures = posts.Journals.process_claimed(claimed)
+        self.assertEqual(failures, 1, 'Unbalanced journal not failed')
+        self.assertEqual(self.journ17.journalstat, posts.Journals.PROCESSED)
+        self.assertEqual(self.journ18.journalstat, posts.Journals.FAILED)
+        self.assertIsNone(self.journ17.leased_by, 'Lease not released')
+        self.assertEqual(accmodel.Accounts.get_by_name("kas").current_balance(),
+                         230, 'Balance not updated for posted journal')
+
+    def test_orm_mode_one_worker(self):
+        """ Workers reading and writing back balances are not started in
+        parallel
+        """
+
+        with mock.patch.dict(gledger.app.config, {'POSTING_MODE': 'orm'}):
+            with self.assertRaises(ValueError):
+                postingworker.start_workers(num_workers=2)
+
+    def test_lost_lease_rolls_back(self):
+        """ Journals claimed again by another worker are not posted """
+
+        claimed = posts.Journals.claim_unprocessed('test', batch_size=1000)
+        claimed = [journal for journal in claimed if journal is self.journ17]
+        gledger.db.session.execute(posts.Journals.__table__.update().
+            where(posts.Journals.id == self.journ17.id).
+            values(leased_by='other:1'))
+        with mock.patch.object(gledger.db.session, 'rollback') as rollback:
+            with self.assertRaises(posts.LeaseLostError):
+                posts.Journals.process_claimed(claimed)
+        self.assertTrue(rollback.called, 'Batch not rolled back')
+
+
+class TestBulkJournals(unittest.TestCase):
+
+    def setUp(self):
+
+        create_accounts(self)
+        gledger.db.session.flush()
+        with open('jrn.json', 'r') as f:
+            self.journdict = json.load(f)
+        self.app = gledger.app.test_client()
+        self.app.testing = True
+        self.no_commit = mock.patch.object(gledger.db.session, 'commit',
+                                           gledger.db.session.flush)
+        self.no_commit.start()
+
+    def tearDown(self):
+
+        self.no_commit.stop()
+        gledger.db.session.rollback()
+
+    def bulk_body(self, extkeys):
+        """ Create a newline delimited body with a journal per key """
+
+        lines = []
+        for extkey in extkeys:
+            self.journdict['journal']['extkey'] = extkey
+            lines.append(json.dumps(self.journdict))
+        return '\n'.join(lines) + '\n'
+
+    def test_bulk_results_per_journal(self):
+        """ The bulk route returns a result per journal """
+
+        rv = self.app.post('/api/journal/bulk',
+                           data=self.bulk_body(['BK01', 'BK02', 'BK03']),
+                           content_type='application/x-ndjson')
+        results = [json.loads(line) for line in rv.data.splitlines()]
+        self.assertEqual([result['extkey'] for result in results],
+                         ['BK01', 'BK02', 'BK03'], 'Wrong results')
+        self.assertEqual({result['status'] for result in results}, {'OK'})
+
+    def test_bad_journal_isolated(self):
+        """ A journal in error does not stop the others """
+
+        body = self.bulk_body(['BK04'])
+        self.journdict['journal']['postings'][0]['account'] = 'nonexisting'
+        body += self.bulk_body(['BK05']) + 'no json\n' + \
+            self.bulk_body(['BK06']).replace('nonexisting', 'verkopen')
+        rv = self.app.post('/api/journal/bulk', data=body,
+                           content_type='application/x-ndjson')
+        results = [json.loads(line) for line in rv.data.splitlines()]
+        self.assertEqual([result['status'] for result in results],
+                         ['OK', 'Not correct', 'Not correct', 'OK'],
+                         'Wrong statuses')
+        self.assertEqual(results[1]['extkey'], 'BK05', 'Wrong key for error')
+
+    def test_failed_commit_one_by_one(self):
+        """ If the group does not commit, only the bad journal is refused """
+
+        pending = []
+
+        def create_batch(journdicts):
+            pending[:] = [posts.extkey_of(jd) for jd in journdicts]
+            return [mock.Mock() for _ in journdicts]
+
+        def create_from_dict(journdict):
+            pending[:] = [posts.extkey_of(journdict)]
+            return mock.Mock()
+
+        def commit():
+            if 'BK08' in pending:
+                raise DatabaseError('INSERT', None, Exception('Too long'))
+
+        with mock.patch.object(posts.Journals, 'create_batch',
+                               side_effect=create_batch),\
+                mock.patch.object(posts.Journals, 'create_from_dict',
+                                  side_effect=create_from_dict),\
+                mock.patch.object(gledger.db.session, 'commit',
+                                  side_effect=commit),\
+                mock.patch.object(gledger.db.session, 'rollback'):
+            rv = self.app.post('/api/journal/bulk',
+                               data=self.bulk_body(['BK07', 'BK08', 'BK09']),
+                               content_type='application/x-ndjson')
+        results = [json.loads(line) for line in rv.data.splitlines()]
+        self.assertEqual([result['status'] for result in results],
+                         ['OK', 'Not correct', 'OK'], 'Wrong statuses')
+        self.assertIn('Too long', results[1]['message'], 'Wrong error')
+
+
+class TestGroupCommit(unittest.TestCase):
+
+    def setUp(self):
+
+        create_accounts(self)
+        gledger.db.session.flush()
+        with open('jrn.json', 'r') as f:
+            self.journdict = json.load(f)
+        self.app = gledger.app.test_client()
+        self.app.testing = True
+        self.commit = mock.Mock(side_effect=gledger.db.session.flush)
+        self.no_commit = mock.patch.object(gledger.db.session, 'commit',
+                                           self.commit)
+        self.no_commit.start()
+
+    def tearDown(self):
+
+        self.no_commit.stop()
+        gledger.db.session.rollback()
+
+    def journal(self, extkey, account='verkopen'):
+        """ Return a copy of the test journal with extkey """
+
+        journdict = json.loads(json.dumps(self.journdict))
+        journdict['journal']['extkey'] = extkey
+        journdict['journal']['postings'][0]['account'] = account
+        return journdict
+
+    def test_group_in_one_commit(self):
+        """ A group is committed once; a refused journal is isolated """
+
+        group = [groupcommit._Waiter(self.journal('GC01')),
+                 groupcommit._Waiter(self.journal('GC02', 'nonexisting')),
+                 groupcommit._Waiter({'journal': {}}),
+                 groupcommit._Waiter(self.journal('GC03'))]
+        groupcommit.GroupCommitter().commit_group(group)
+        self.assertEqual(self.commit.call_count, 1, 'Not one commit')
+        self.assertEqual([waiter.extkey for waiter in group],
+                         ['GC01', None, None, 'GC03'], 'Wrong journals added')
+        self.assertIsInstance(group[1].error, posts.InvalidJournalError)
+        self.assertIsInstance(group[2].error, posts.InvalidJournalError)
+        self.assertEqual(posts.Journals.get_by_key('GC03').journalstat,
+                         posts.Journals.UNPROCESSED, 'Journal not added')
+
+    def test_collect_up_to_size(self):
+        """ Journals are collected in groups of at most max_journals """
+
+        committer = groupcommit.GroupCommitter(window=0.05, max_journals=3)
+        for number in range(5):
+            committer.waiting.put(number)
+        self.assertEqual(committer.collect(), [0, 1, 2])
+        self.assertEqual(committer.collect(), [3, 4])
+
+    def test_route_hands_over(self):
+        """ With GROUP_COMMIT the route waits for the group committer """
+
+        committer = mock.Mock()
+        committer.add.return_value = 'GC04'
+        with mock.patch.dict(gledger.app.config, {'GROUP_COMMIT': True}),\
+                mock.patch('gledger.postingapi.group_committer',
+                           return_value=committer):
+            rv = self.app.post('/api/journal/new',
+                               data=json.dumps(self.journal('GC04')),
+                               content_type='application/json')
+            self.assertIn(b'GC04 added', rv.data, 'Not added')
+            committer.add.side_effect = posts.InvalidJournalError('Refused')
+            rv = self.app.post('/api/journal/new',
+                               data=json.dumps(self.journal('GC05')),
+                               content_type='application/json')
+        self.assertEqual(rv.status_code, 400, 'Refusal not reported')
+        self.assertEqual(self.commit.call_count, 0, 'Committed in the request')
+
+    def test_route_timeout(self):
+        """ A journal not committed in time is answered with 503 """
+
+        committer = mock.Mock()
+        committer.add.side_effect = groupcommit.GroupCommitTimeout('Late')
+        with mock.patch.dict(gledger.app.config, {'GROUP_COMMIT': True}),\
+                mock.patch('gledger.postingapi.group_committer',
+                           return_value=committer):
+            rv = self.app.post('/api/journal/new',
+                               data=json.dumps(self.journal('GC05')),
+                               content_type='application/json')
+        self.assertEqual(rv.status_code, 503, 'Timeout not reported')
+
+    def test_add_times_out(self):
+        """ add does not wait longer than the timeout """
+
+        committer = groupcommit.GroupCommitter(timeout=0.05)
+        with mock.patch.object(committer, '_run', lambda: None):
+            with self.assertRaises(groupcommit.GroupCommitTimeout):
+                committer.add(self.journal('GC05'))
+
+
+class TestGroupCommitFailure(unittest.TestCase):
+    """ The commit of a group fails on one of its journals """
+
+    def setUp(self):
+
+        with open('jrn.json', 'r') as f:
+            self.journdict = json.load(f)
+        self.bad = 'GC07'
+        self.pending = []
+        self.patches = [
+            mock.patch.object(posts.Journals, 'create_batch',
+                              side_effect=self.create_batch),
+            mock.patch.object(posts.Journals, 'create_from_dict',
+                              side_effect=self.create_from_dict),
+            mock.patch.object(gledger.db.session, 'commit',
+                              side_effect=self.commit),
+            mock.patch.object(gledger.db.session, 'rollback'),
+            mock.patch.object(gledger.db.session, 'remove')]
+        for patch in self.patches:
+            patch.start()
+
+    def tearDown(self):
+
+        for patch in reversed(self.patches):
+            patch.stop()
+
+    def journal(self, extkey):
+        """ Return a copy of the test journal with extkey """
+
+        journdict = json.loads(json.dumps(self.journdict))
+        journdict['journal']['extkey'] = extkey
+        return journdict
+
+    def create_batch(self, journdicts):
+
+        self.pending = [jd['journal']['extkey'] for jd in journdicts]
+        return [None] * len(journdicts)
+
+    def create_from_dict(self, journdict):
+
+        self.pending = [journdict['journal']['extkey']]
+        return mock.Mock(extkey=journdict['journal']['extkey'])
+
+    def commit(self):
+        """ Fail the commit of any transaction holding the bad journal """
+
+        pending, self.pending = self.pending, []
+        if self.bad in pending:
+            raise DatabaseError('INSERT', None, Exception('Deadlock'))
+
+    def test_one_by_one(self):
+        """ After a failed group commit only the bad journal is refused """
+
+        group = [groupcommit._Waiter(self.journal(extkey))
+                 for extkey in ('GC06', 'GC07', 'GC08')]
+        groupcommit.GroupCommitter().commit_group(group)
+        self.assertEqual([waiter.extkey for waiter in group],
+                         ['GC06', None, 'GC08'], 'Wrong journals added')
+        self.assertEqual([waiter.error is None for waiter in group],
+                         [True, False, True], 'Wrong journals refused')
+        self.assertIsInstance(group[1].error, DatabaseError)
+
+    def test_threaded_add(self):
+        """ Requests adding at the same time each get their own result """
+
+        committer = groupcommit.GroupCommitter(window=0.5, max_journals=3,
+                                               timeout=5)
+        results = dict()
+
+        def add(extkey):
+            try:
+                results[extkey] = committer.add(self.journal(extkey))
+            except Exception as exc:
+                results[extkey] = exc
+
+        threads = [threading.Thread(target=add, args=(extkey,))
+                   for extkey in ('GC06', 'GC07', 'GC08')]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(results['GC06'], 'GC06', 'Journal not added')
+        self.assertEqual(results['GC08'], 'GC08', 'Journal not added')
+        self.assertIsInstance(results['GC07'], DatabaseError,
+                              'Bad journal not refused')
+
+
+class TestJournalSpool(unittest.TestCase):
+
+    def setUp(self):
+
+        create_accounts(self)
+        gledger.db.session.flush()
+        with open('jrn.json', 'r') as f:
+            self.journdict = json.load(f)
+        self.directory = tempfile.mkdtemp()
+        self.app = gledger.app.test_client()
+        self.app.testing = True
+        self.no_commit = mock.patch.object(gledger.db.session, 'commit',
+                                           gledger.db.session.flush)
+        self.no_commit.start()
+
+    def tearDown(self):
+
+        self.no_commit.stop()
+        gledger.db.session.rollback()
+        for filename in os.listdir(self.directory):
+            os.remove(os.path.join(self.directory, filename))
+        os.rmdir(self.directory)
+
+    def journal(self, extkey, account='verkopen'):
+        """ Return a copy of the test journal with extkey """
+
+        journdict = json.loads(json.dumps(self.journdict))
+        journdict['journal']['extkey'] = extkey
+        journdict['journal']['postings'][0]['account'] = account
+        return journdict
+
+    def test_segments_rotate(self):
+        """ Full segments are sealed and a new one is started """
+
+        journal_spool = spool.JournalSpool(self.directory, segment_bytes=600)
+        for number in range(3):
+            journal_spool.append(self.journal('SP0' + str(number)))
+        names = sorted(os.listdir(self.directory))
+        self.assertEqual([os.path.splitext(name)[1] for name in names],
+                         ['.log', '.open'], 'Segments not rotated')
+        lines, end = spool.read_lines(os.path.join(self.directory, names[0]),
+                                      0, 10)
+        self.assertEqual(len(lines), 2, 'Journals not in first segment')
+        self.assertEqual(json.loads(lines[1][1].decode())['journal']['extkey'],
+                         'SP01', 'Wrong journal spooled')
+
+    def test_incomplete_line_not_read(self):
+        """ A line that is being written is not read """
+
+        path = os.path.join(self.directory, 'segment.log')
+        with open(path, 'wb') as segment:
+            segment.write(b'{"a": 1}\n{"b"')
+        lines, end = spool.read_lines(path, 0, 10)
+        self.assertEqual(len(lines), 1, 'Incomplete line read')
+        self.assertEqual(end, 9, 'Wrong position')
+
+    def test_drain(self):
+        """ Spooled journals are added once, refused ones are rejected """
+
+        journal_spool = spool.JournalSpool(self.directory)
+        journal_spool.append(self.journal('SP10'))
+        journal_spool.append(self.journal('SP11', 'nonexisting'))
+        journal_spool.append(self.journal('SP12'))
+        journal_spool.close()
+        drainer = spool.SpoolDrainer(self.directory, batch_size=2, post=False)
+        self.assertEqual(drainer.drain(), 3, 'Not all journals read')
+        self.assertEqual(drainer.drain(), 0, 'Journals read twice')
+        for extkey in ['SP10', 'SP12']:
+            self.assertEqual(posts.Journals.get_by_key(extkey).journalstat,
+                             posts.Journals.UNPROCESSED, 'Journal not added')
+        self.assertEqual(os.listdir(self.directory), [spool.REJECTED],
+                         'Drained segment not removed')
+        with open(os.path.join(self.directory, spool.REJECTED)) as rejects:
+            rejected = [json.loads(line) for line in rejects]
+        self.assertEqual(len(rejected), 1, 'Refused journal not rejected')
+        self.assertIn('SP11', rejected[0]['journal'], 'Wrong journal rejected')
+
+    def rejected_keys(self):
+        """ Return the extkeys in the rejected file """
+
+        with open(os.path.join(self.directory, spool.REJECTED)) as rejects:
+            return [json.loads(json.loads(line)['journal'])['journal']
+                    ['extkey'] for line in rejects]
+
+    def test_rejects_before_checkpoint(self):
+        """ Rejects are written before the checkpoint is committed """
+
+        journal_spool = spool.JournalSpool(self.directory)
+        journal_spool.append(self.journal('SP13'))
+        journal_spool.append(self.journal('SP14', 'nonexisting'))
+        name, path, _ = spool.SpoolDrainer(self.directory).segments()[0]
+        lines, end = spool.read_lines(path, 0, 10)
+        drainer = spool.SpoolDrainer(self.directory, post=False)
+        with mock.patch.object(gledger.db.session, 'commit',
+                               side_effect=OperationalError('COMMIT', None,
+                                                            Exception('Gone'))),\
+                mock.patch.object(gledger.db.session, 'rollback'):
+            with self.assertRaises(OperationalError):
+                drainer.add_batch(name, lines, end)
+        self.assertEqual(self.rejected_keys(), ['SP14'], 'Reject lost')
+
+    def test_failed_batch_rejects_once(self):
+        """ A batch added again one by one does not reject twice """
+
+        journal_spool = spool.JournalSpool(self.directory)
+        journal_spool.append(self.journal('SP15', 'nonexisting'))
+        journal_spool.append(self.journal('SP16'))
+        journal_spool.close()
+        drainer = spool.SpoolDrainer(self.directory, post=False)
+        advance = posts.SpoolCheckpoints.advance
+        failures = [DatabaseError('UPDATE', None, Exception('Deadlock'))]
+
+        def advance_once(segment, position):
+            if failures:
+                raise failures.pop()
+            advance(segment, position)
+
+        with mock.patch.object(posts.SpoolCheckpoints, 'advance',
+                               side_effect=advance_once),\
+                mock.patch.object(drainer, 'add_journals',
+                                  side_effect=lambda journdicts, rejected:
+                                  rejected.extend(
+                                      (line, 'Refused') for line, journdict
+                                      in journdicts if journdict['journal']
+                                      ['extkey'] == 'SP15')),\
+                mock.patch.object(gledger.db.session, 'rollback'):
+            self.assertEqual(drainer.drain(), 2, 'Not all journals read')
+        self.assertEqual(self.rejected_keys(), ['SP15'],
+                         'Journal not rejected once')
+
+    def test_drain_continues_at_checkpoint(self):
+        """ The drainer continues after the last journal committed """
+
+        journal_spool = spool.JournalSpool(self.directory)
+        journal_spool.append(self.journal('SP20'))
+        segment = journal_spool.segment.name
+        first_end = journal_spool.segment.size
+        posts.SpoolCheckpoints.advance(segment, first_end)
+        journal_spool.append(self.journal('SP21'))
+        drainer = spool.SpoolDrainer(self.directory, post=False)
+        with mock.patch.object(posts.Journals, 'process_claimed') as process:
+            self.assertEqual(drainer.drain(), 1, 'Checkpoint not used')
+        self.assertEqual(process.call_count, 0, 'Posted without post')
+        self.assertEqual(posts.SpoolCheckpoints.positions()[segment],
+                         journal_spool.segment.size, 'Checkpoint not advanced')
+        self.assertIn(segment + spool.OPEN, os.listdir(self.directory),
+                      'Open segment removed')
+
+    def test_drain_posts(self):
+        """ The drainer posts the journals in its transaction """
+
+        journal_spool = spool.JournalSpool(self.directory)
+        journal_spool.append(self.journal('SP30'))
+        drainer = spool.SpoolDrainer(self.directory)
+        with mock.patch.object(posts.Journals, 'process_claimed') as process:
+            drainer.drain()
+        (journals,), options = process.call_args
+        self.assertEqual([journal.extkey for journal in journals], ['SP30'])
+        self.assertEqual(len(journals[0].journalpostings), 3,
+                         'Postings not in journal once')
+        self.assertEqual(options, {'commit': False}, 'Posting committed apart')
+
+    def test_route_spools(self):
+        """ In spool mode a journal is accepted into the spool """
+
+        journal_spool = spool.JournalSpool(self.directory)
+        with mock.patch.dict(gledger.app.config, {'JOURNAL_SPOOL': True}),\
+                mock.patch('gledger.postingapi.journal_spool',
+                           return_value=journal_spool):
+            rv = self.app.post('/api/journal/new',
+                               data=json.dumps(self.journal('SP40')),
+                               content_type='application/json')
+            self.assertEqual(rv.status_code, 202, 'Journal not accepted')
+            rv = self.app.post('/api/journal/new', data=json.dumps({'a': 1}),
+                               content_type='application/json')
+        self.assertEqual(rv.status_code, 400, 'Non journal accepted')
+        self.assertEqual(journal_spool.segment.size,
+                         len(json.dumps(self.journal('SP40'),
+                                        separators=(',', ':'))) + 1,
+                         'Journal not spooled')
+        self.assertRaises(posts.NoJournalError, posts.Journals.get_by_key,
+                          'SP40')
+
+
+class TestIdempotentJournals(unittest.TestCase):
+
+    def setUp(self):
+
+        create_accounts(self)
+        gledger.db.session.flush()
+        with open('jrn.json', 'r') as f:
+            self.journdict = json.load(f)
+        self.journdict['journal']['extkey'] = 'ID01'
+        self.app = gledger.app.test_client()
+        self.app.testing = True
+        self.idempotent = mock.patch.dict(gledger.app.config,
+                                          {'JOURNAL_IDEMPOTENT': True})
+        self.idempotent.start()
+        self.no_commit = mock.patch.object(gledger.db.session, 'commit',
+                                           gledger.db.session.flush)
+        self.no_commit.start()
+
+    def tearDown(self):
+
+        self.no_commit.stop()
+        self.idempotent.stop()
+        gledger.db.session.rollback()
+
+    def count_journals(self, extkey):
+
+        return gledger.db.session.query(posts.Journals).\
+            filter_by(extkey=extkey).count()
+
+    def test_duplicate_returns_original(self):
+        """ A journal delivered again is not added again """
+
+        journal = posts.Journals.create_from_dict(self.journdict)
+        again = posts.Journals.create_from_dict(self.journdict)
+        self.assertIs(again, journal, 'Original not returned')
+        self.assertTrue(again.replayed, 'Not marked replayed')
+        self.assertEqual(self.count_journals('ID01'), 1, 'Journal added twice')
+
+    def test_not_idempotent(self):
+        """ Without JOURNAL_IDEMPOTENT a journal is added again """
+
+        posts.Journals.create_from_dict(self.journdict)
+        posts.Journals.create_from_dict(self.journdict, idempotent=False)
+        self.assertEqual(self.count_journals('ID01'), 2, 'Journal not added')
+
+    def test_batch(self):
+        """ Keys delivered before or repeated in the batch are not added """
+
+        first = posts.Journals.create_from_dict(self.journdict)
+        other = json.loads(json.dumps(self.journdict))
+        other['journal']['extkey'] = 'ID02'
+        results = posts.Journals.create_batch([self.journdict, other, other])
+        self.assertIs(results[0], first, 'Original not returned')
+        self.assertIs(results[2], results[1], 'Repeated key added')
+        self.assertFalse(results[1].replayed, 'New journal marked replayed')
+        gledger.db.session.flush()
+        self.assertEqual(self.count_journals('ID02'), 1, 'Journal added twice')
+
+    def test_other_content(self):
+        """ With the hash, other content under the same key is refused """
+
+        posts.Journals.create_from_dict(self.journdict)
+        self.journdict['journal']['postings'][0]['amount'] = '23001'
+        self.assertIs(posts.Journals.create_from_dict(self.journdict).replayed,
+                      True, 'Not replayed without hash')
+        with mock.patch.dict(gledger.app.config,
+                             {'JOURNAL_IDEMPOTENCY_HASH': True}):
+            self.assertRaises(posts.DuplicateJournalError,
+                              posts.Journals.create_from_dict, self.journdict)
+
+    def test_hash_ignores_format(self):
+        """ The content hash does not depend on the formatting """
+
+        reformatted = json.loads(json.dumps(self.journdict, indent=4))
+        self.assertEqual(posts.content_hash(reformatted),
+                         posts.content_hash(self.journdict))
+
+    @mock.patch.object(gledger.db.session, 'remove')
+    def test_route_replays(self, remove):
+        """ The route answers a journal delivered again like the first time """
+
+        body = json.dumps(self.journdict)
+        first = self.app.post('/api/journal/new', data=body,
+                              content_type='application/json')
+        again = self.app.post('/api/journal/new', data=body,
+                              content_type='application/json')
+        self.assertEqual(again.data, first.data, 'Other result')
+        self.journdict['journal']['postings'][0]['amount'] = '23001'
+        with mock.patch.dict(gledger.app.config,
+                             {'JOURNAL_IDEMPOTENCY_HASH': True}):
+            other = self.app.post('/api/journal/new',
+                                  data=json.dumps(self.journdict),
+                                  content_type='application/json')
+        self.assertEqual(other.status_code, 409, 'Other content accepted')
+        self.assertEqual(self.count_journals('ID01'), 1, 'Journal added twice')
+
+
+class TestCurrencyBalancing(unittest.TestCase):
+
+    def setUp(self):
+
+        create_accounts(self)
+        gledger.db.session.flush()
+
+    def tearDown(self):
+
+        gledger.db.session.rollback()
+
+    def journal(self, extkey, *postings):
+        """ Create a journal with postings of (account, currency, amount,
+        debitcredit) dated today
+        """
+
+        valuedate = date.today().strftime('%Y-%m-%d')
+        return posts.Journals.create_from_dict({'journal': {
+            'extkey': extkey,
+            'postings': [{'account': account, 'currency': currency,
+                          'amount': amount, 'debitcredit': debitcredit,
+                          'valuedate': valuedate}
+                         for (account, currency, amount, debitcredit)
+                         in postings]}})
+
+    def test_every_currency_balanced(self):
+        """ A journal balancing in each of its currencies passes """
+
+        journal = self.journal('CB01', ('kas', 'EUR', 100, 'Db'),
+                               ('verkopen', 'EUR', 100, 'Cr'),
+                               ('kas', 'USD', 120, 'Db'),
+                               ('verkopen', 'USD', 120, 'Cr'))
+        journal.check_balance()
+
+    def test_other_currency_checked(self):
+        """ A currency other than the first one is checked too """
+
+        journal = self.journal('CB02', ('kas', 'EUR', 100, 'Db'),
+                               ('verkopen', 'EUR', 100, 'Cr'),
+                               ('kas', 'USD', 120, 'Db'),
+                               ('verkopen', 'USD', 100, 'Cr'))
+        with self.assertRaises(posts.JournalBalanceError) as raised:
+            journal.check_balance()
+        self.assertEqual(raised.exception.imbalances, {journal: {'USD': 20}})
+        self.assertIn('CB02 does not balance: USD 20', str(raised.exception))
+
+    def test_all_failures_reported(self):
+        """ Every journal and currency that does not balance is reported,
+        before any balance is touched
+        """
+
+        journal1 = self.journal('CB03', ('kas', 'EUR', 100, 'Db'),
+                                ('kas', 'USD', 120, 'Cr'))
+        journal2 = self.journal('CB04', ('kas', 'GBP', 5, 'Db'),
+                                ('verkopen', 'GBP', 5, 'Cr'))
+        journal3 = self.journal('CB05', ('kas', 'GBP', 5, 'Db'))
+        with self.assertRaises(posts.JournalBalanceError) as raised:
+            posts.Journals.post_journals([journal1, journal2, journal3])
+        self.assertEqual(raised.exception.imbalances,
+                         {journal1: {'EUR': 100, 'USD': -120},
+                          journal3: {'GBP': 5}}, 'Wrong imbalances')
+        self.assertEqual(accmodel.Accounts.get_by_name("kas").current_balance(),
+                         0, 'Balance updated for unbalanced batch')
+
+
 def create_posting_to_kas(instance, posting_amount, postmonth, journal_id):
     """ Post an amount to kas for test purposes """
 
@@ -804,6 +1856,181 @@ def create_posting_to_kas(instance, posting_amount, postmonth, journal_id):
                             debcred='Db')
     postn.add()    
     
+class TestQueryBudgets(unittest.TestCase):
+
+    BUDGETS = {'/accountlist': 3, '/balance/kas': 5, '/posts/kas': 5,
+               '/journal/QB1701': 3}
+
+    def setUp(self):
+
+        add_postmonths([accmodel.postmonth_today()])
+        create_accounts(self)
+        self.journ17 = posts.Journals(journalstat=posts.Journals.UNPROCESSED,
+                                      extkey='QB1701')
+        self.journ17.add()
+        gledger.db.session.flush()
+        posting_to_journal(self.journ17)
+        gledger.db.session.flush()
+        self.app = gledger.app.test_client()
+        self.app.testing = True
+
+    def tearDown(self):
+
+        gledger.db.session.rollback()
+
+    def test_record_queries(self):
+        """ The statements in the block are counted and timed """
+
+        with record_queries() as stats:
+            gledger.db.session.query(accmodel.Accounts).all()
+            with record_queries() as inner:
+                gledger.db.session.query(posts.Journals).all()
+        self.assertEqual(stats.count, 2, 'Statements not counted')
+        self.assertEqual(inner.count, 1, 'Nested recording not counted')
+        self.assertGreater(stats.seconds, 0, 'Statements not timed')
+        self.assertEqual(len(stats.slowest), 2, 'Slowest not kept')
+
+    @mock.patch.object(gledger.db.session, 'remove')
+    def test_route_budgets(self, remove):
+        """ The pages stay within their budget of statements """
+
+        for url, budget in self.BUDGETS.items():
+            with record_queries() as stats:
+                rv = self.app.get(url)
+            self.assertEqual(rv.status_code, 200, url + ' failed')
+            self.assertLessEqual(stats.count, budget,
+                                 url + ' over its query budget')
+
+    @mock.patch.object(gledger.db.session, 'remove')
+    def test_headers(self, remove):
+        """ The statistics are sent in headers when configured """
+
+        rv = self.app.get('/posts/kas')
+        self.assertNotIn('X-Query-Count', rv.headers, 'Headers not in debug')
+        with mock.patch.dict(gledger.app.config, {'QUERY_STATS_HEADERS': True}):
+            with record_queries() as stats:
+                rv = self.app.get('/posts/kas')
+        self.assertEqual(rv.headers['X-Query-Count'], str(stats.count),
+                         'Wrong query count in header')
+        self.assertIn('db;dur=', rv.headers['Server-Timing'],
+                      'No Server-Timing header')
+
+    @mock.patch.object(gledger.db.session, 'remove')
+    def test_collector_and_log(self, remove):
+        """ The statistics go to the collectors and the log """
+
+        collector = mock.Mock()
+        add_collector(collector)
+        try:
+            with self.assertLogs(level='INFO') as logged:
+                self.app.get('/posts/kas')
+        finally:
+            remove_collector(collector)
+        self.assertEqual(collector.call_count, 1, 'Collector not called')
+        (_, response, stats) = collector.call_args[0]
+        self.assertEqual(response.status_code, 200)
+        self.assertGreater(stats.count, 0, 'No statements collected')
+        self.assertTrue(any('GET /posts/kas 200: ' in line
+                            for line in logged.output), 'No log line')
+
+
+class TestMetrics(unittest.TestCase):
+
+    def setUp(self):
+
+        create_accounts(self)
+        self.journ18 = posts.Journals(journalstat=posts.Journals.UNPROCESSED,
+                                      extkey='MT1801')
+        self.journ18.add()
+        gledger.db.session.flush()
+        posting_to_journal(self.journ18)
+        gledger.db.session.flush()
+        self.app = gledger.app.test_client()
+        self.app.testing = True
+
+    def tearDown(self):
+
+        gledger.db.session.rollback()
+        gledger.db.session.info.pop('metrics', None)
+
+    def test_metric_kinds(self):
+        """ A metric must be of a kind, and only recorded metrics are
+        recorded on commit
+        """
+
+        with self.assertRaises(TypeError):
+            glmetrics.Metric('gledger_test_abstract', 'Not a kind')
+        self.assertFalse(hasattr(glmetrics.Gauge, 'on_commit'))
+        self.assertTrue(issubclass(glmetrics.Counter,
+                                   glmetrics.RecordedMetric))
+
+    def test_scrape_removes_session(self):
+        """ The session of a scrape is removed, not left open """
+
+        start_response = mock.Mock()
+        with mock.patch.object(gledger.db.session, 'remove') as remove:
+            page = glmetrics.metrics_app({}, start_response)
+        self.assertIn(b'gledger_journals{journalstat="U"}', page[0],
+                      'Gauge not scraped')
+        self.assertTrue(remove.called, 'Session not removed')
+        self.assertEqual(start_response.call_args[0][0], '200 OK')
+
+    def test_recorded_on_commit(self):
+        """ Journals posted are counted when the transaction commits """
+
+        processed = posts.journals_processed.value(journalstat='P')
+        latencies = posts.posting_latency.count()
+        posts.Journals.post_journals([self.journ18])
+        self.assertEqual(posts.journals_processed.value(journalstat='P'),
+                         processed, 'Counted before commit')
+        glmetrics.record_committed(gledger.db.session())
+        self.assertEqual(posts.journals_processed.value(journalstat='P'),
+                         processed + 1, 'Not counted on commit')
+        self.assertEqual(posts.posting_latency.count(), latencies + 1,
+                         'Latency not observed')
+
+    def test_dropped_on_rollback(self):
+        """ Counts of a savepoint rolled back are dropped """
+
+        received = posts.journals_received.value()
+        posts.journals_received.on_commit(gledger.db.session)
+        savepoint = gledger.db.session.begin_nested()
+        posts.journals_received.on_commit(gledger.db.session, 5)
+        savepoint.rollback()
+        glmetrics.record_committed(gledger.db.session())
+        self.assertEqual(posts.journals_received.value(), received + 1,
+                         'Rolled back count recorded')
+
+    def test_histogram_text(self):
+        """ A histogram is shown with cumulative buckets """
+
+        histogram = glmetrics.Histogram('test_seconds', 'Test', buckets=[1, 5])
+        glmetrics.registry.remove(histogram)
+        histogram.observe(0.5)
+        histogram.observe(3)
+        histogram.observe(8)
+        self.assertEqual(histogram.render().splitlines()[2:],
+                         ['test_seconds_bucket{le="1"} 1',
+                          'test_seconds_bucket{le="5"} 2',
+                          'test_seconds_bucket{le="+Inf"} 3',
+                          'test_seconds_sum 11.5',
+                          'test_seconds_count 3'])
+
+    @mock.patch.object(gledger.db.session, 'remove')
+    def test_metrics_page(self, remove):
+        """ The metrics are shown in the Prometheus text format """
+
+        rv = self.app.get('/metrics')
+        self.assertEqual(rv.status_code, 200)
+        self.assertTrue(rv.content_type.startswith('text/plain'))
+        self.assertIn(b'# TYPE gledger_journals_received_total counter',
+                      rv.data, 'No received counter')
+        self.assertIn(b'gledger_journals{journalstat="U"}', rv.data,
+                      'No journals by journalstat')
+        self.assertIn(b'gledger_post_journals_seconds_count', rv.data,
+                      'No post_journals histogram')
+
+
 def create_accounts(instance):
 
     instance.acc6 = accmodel.Accounts(name = 'verkopen', role = 'E')
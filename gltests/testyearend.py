@@ -16,6 +16,7 @@
 #    along with gledger.  If not, see <http://www.gnu.org/licenses/>.
 
 import unittest
+from unittest import mock
 from datetime import date, datetime
 from dateutil.relativedelta import relativedelta
 import logging
@@ -179,6 +180,163 @@ class TestYearEndSplit(unittest.TestCase):
                                        num_accounts=None)
         self.assertEqual(len(jrn13['journal']['postings']), 7, 'Wrong number of accounts')
 
+    def test_last_balance_closed(self):
+        """ The last known balance of an account is nullified """
+
+        pm201506 = gledger.db.session.query(accmodel.Postmonths).\
+            filter_by(postmonth=201506).first()
+        pm201506.monthstat = 'a'
+        bal9 = accmodel.Balances(postmonth=201506, amount=999,
+                                 value_date=datetime(2015, 6, 30))
+        self.acc5.balances.append(bal9)
+        gledger.db.session.flush()
+        pm201506.monthstat = 'c'
+        jrn15 = yearend.YearEndJournal(start_next_year=datetime(2016, 1, 1),
+                                       num_accounts=None)
+        amounts = {posting['account']: posting['amount']
+                   for posting in jrn15['journal']['postings']}
+        self.assertEqual(amounts['kantoorart'], -3316, 'Wrong balance closed')
+        self.assertEqual(amounts['ontvangen rente'], -5764,
+                         'Wrong balance closed')
+
+    def test_balances_in_one_query(self):
+        """ The balances of all accounts are read in one query """
+
+        with mock.patch.object(accmodel.Accounts, 'current_balance') as current:
+            yearend.YearEndJournal(start_next_year=datetime(2016, 1, 1),
+                                   num_accounts=None)
+        current.assert_not_called()
+        balances = yearend.YearEndJournal.get_applicable_balances()
+        self.assertEqual(len(balances), 6, 'Wrong number of accounts')
+
+
+class TestYearEndJournals(unittest.TestCase):
+
+    def setUp(self):
+
+        create_standard_accountlist_testset(self)
+        create_accounts_for_more(self)
+        gledger.db.session.flush()
+        self.start_next_year = datetime(2016, 1, 1)
+
+    def tearDown(self):
+
+        gledger.db.session.rollback()
+
+    def test_journals_are_bounded(self):
+        """ The accounts are spread over journals of a maximum size """
+
+        journals = list(yearend.year_end_journals(
+            start_next_year=self.start_next_year, num_accounts=4))
+        self.assertEqual(len(journals), 2, 'Wrong number of journals')
+        self.assertEqual(len(journals[0]['journal']['postings']), 5,
+                         'Wrong number of postings')
+        self.assertEqual(len(journals[1]['journal']['postings']), 3,
+                         'Wrong number of postings')
+
+    def test_journals_balance(self):
+        """ Each journal balances by its own profit posting """
+
+        for journal in yearend.year_end_journals(
+                start_next_year=self.start_next_year, num_accounts=4):
+            total = sum(posting['amount'] if posting['debitcredit'] == 'Db'
+                        else -posting['amount']
+                        for posting in journal['journal']['postings'])
+            self.assertEqual(total, 0, 'Journal does not balance')
+
+    def test_journals_have_extkey(self):
+        """ Every journal has its own extkey """
+
+        extkeys = [journal['journal']['extkey'] for journal in
+                   yearend.year_end_journals(
+                       start_next_year=self.start_next_year, num_accounts=4)]
+        self.assertEqual(extkeys, ['yearend-20160101-00001',
+                                   'yearend-20160101-00002'],
+                         'Wrong extkeys')
+
+    def test_date_from_last_close(self):
+        """ Without a date the journals are for a year after the last close """
+
+        last_close = accmodel.CloseDates(closing_date=datetime(2015, 1, 1))
+        last_close.add()
+        gledger.db.session.flush()
+        extkeys = [journal['journal']['extkey'] for journal in
+                   yearend.year_end_journals(num_accounts=4)]
+        self.assertEqual(extkeys, ['yearend-20160101-00001',
+                                   'yearend-20160101-00002'],
+                         'Wrong extkeys')
+
+    def test_resume_skips_delivered(self):
+        """ Journals delivered before are not generated again """
+
+        delivered = posts.Journals(journalstat=posts.Journals.UNPROCESSED,
+                                   extkey='yearend-20160101-00001')
+        delivered.add()
+        gledger.db.session.flush()
+        journals = list(yearend.year_end_journals(
+            start_next_year=self.start_next_year, num_accounts=4))
+        self.assertEqual(len(journals), 1, 'Wrong number of journals')
+        self.assertEqual(journals[0]['journal']['extkey'],
+                         'yearend-20160101-00002', 'Wrong journal')
+
+
+class TestYearEndCurrencies(unittest.TestCase):
+
+    def setUp(self):
+
+        add_postmonths([201507])
+        self.acc70 = accmodel.Accounts(name='yc inkopen', role='E')
+        self.acc70.add()
+        self.acc71 = accmodel.Accounts(name='yc verkopen', role='I')
+        self.acc71.add()
+        accmodel.Accounts(name='winst', role='L').add()
+        gledger.db.session.flush()
+        for account, currency, amount in [(self.acc70, 'EUR', 400),
+                (self.acc70, 'USD', 250), (self.acc71, 'USD', 900)]:
+            account.balances.append(accmodel.Balances(postmonth=201507,
+                currency=currency, amount=amount,
+                value_date=datetime(2015, 7, 10)))
+        gledger.db.session.query(accmodel.Postmonths).\
+            filter_by(postmonth=201507).first().monthstat = 'c'
+        gledger.db.session.flush()
+
+    def tearDown(self):
+
+        gledger.db.session.rollback()
+
+    def test_closed_per_currency(self):
+        """ Every currency of an account is closed in that currency, the
+        profit is posted per currency and the journal balances in each
+        """
+
+        journal = yearend.YearEndJournal(start_next_year=datetime(2016, 1, 1))
+        postings = journal['journal']['postings']
+        self.assertEqual(sorted((posting['currency'], posting['amount'])
+                                for posting in postings
+                                if posting['account'] == 'yc inkopen'),
+                         [('EUR', -400), ('USD', -250)])
+        self.assertEqual(sorted(posting['currency'] for posting in postings
+                                if posting['account'] == 'winst'),
+                         ['EUR', 'USD'], 'No profit posting per currency')
+        totals = dict()
+        for posting in postings:
+            totals[posting['currency']] = totals.get(posting['currency'], 0)\
+                + (posting['amount'] if posting['debitcredit'] == 'Db'
+                   else -posting['amount'])
+        self.assertEqual(totals, {'EUR': 0, 'USD': 0},
+                         'Journal does not balance per currency')
+
+    def test_balances_per_currency(self):
+        """ The applicable balances have a line per currency """
+
+        balances = [(balance.name, balance.currency, balance.balance)
+                    for balance in
+                    yearend.YearEndJournal.get_applicable_balances()
+                    if balance.name.startswith('yc ')]
+        self.assertEqual(balances, [('yc inkopen', 'EUR', 400),
+                                    ('yc inkopen', 'USD', 250),
+                                    ('yc verkopen', 'USD', 900)])
+
 # TODO test_no_limit does not test that more than 250 accounts can be 
 # processed!
 
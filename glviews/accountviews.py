@@ -19,6 +19,8 @@ of model instances.
 """
 
 from glmodels import PaginatorMixin
+from glmodels.glcache import view_results
+from glmodels.glrates import exchange_rates
 import glmodels.glaccount as model
 
 class AccountView() :
@@ -115,17 +117,38 @@ class BalanceView():
         self.account_name = None
         self.postmonth = None
         self.balance = None
+        self.currency = None
 
     @classmethod
-    def create_view(cls, id=None, postmonth=None, name=None):
+    def create_view(cls, id=None, postmonth=None, name=None, version=None):
         """ Create a view for the balance of an account
 
         We prefer the id, which is the primary key. Name is acceptable,
         as it must be unique.
 
         The postmonth determines which balance we need, None means latest.
+        Views are cached, for a closed postmonth until dropped for space.
+        The version, if passed, is part of the key of the cached view: it
+        must change when the balance does, like the validator of a page.
+        For a closed month it defaults to the time its snapshot was
+        written, so a month reopened and closed again elsewhere is not
+        shown from its former view.
         """
 
+        final = bool(postmonth) and model.Postmonths.status_of(postmonth)\
+            == model.Postmonths.CLOSED
+        if final and version is None:
+            version = model.UltimoBalances.last_change(postmonth)
+            final = version is not None
+        return view_results.get_or_compute(
+            ('balance', id, name, postmonth, version),
+            lambda: cls._create_view(id=id, postmonth=postmonth, name=name),
+            final=final)
+
+    @classmethod
+    def _create_view(cls, id=None, postmonth=None, name=None):
+        """ Create a view for the balance of an account, without cache """
+
         if id:
             account = model.Accounts.get_by_id(id)
         elif name:
@@ -135,6 +158,7 @@ class BalanceView():
         view = cls()
         view.id = account.id
         view.account_name = account.name
+        view.currency = exchange_rates.currency
         if postmonth:
             view.balance = account.balance_ultimo(postmonth)
             view.postmonth = postmonth
@@ -149,10 +173,41 @@ class BalanceView():
 
         as_dictionary = {'id': self.id, 'name': self.account_name}
         as_dictionary['balance'] = "{0:.2f}".format(self.balance/100)
+        as_dictionary['currency'] = self.currency
         as_dictionary['postmonth'] = model.Postmonths.external(self.postmonth)
         return as_dictionary
 
 
+class TrialBalanceView(list):
+    """ Gathers the information to display the trial balance of a
+    postmonth.
+
+    Every line is a dictionary with the account name and role, the
+    level in the hierarchy and the amounts, edited for showing.
+    """
+
+    def __init__(self, postmonth=None):
+
+        trial_balance = model.TrialBalance(postmonth=postmonth)
+        self.postmonth = model.Postmonths.external(trial_balance.postmonth)
+        self.currency = trial_balance.currency
+        for line in trial_balance:
+            self.append({"id": line.id, "name": line.name,
+                         "role": model.Accounts.ROLE_NAME[line.role],
+                         "level": line.level,
+                         "debit": self.edited(line.debit),
+                         "credit": self.edited(line.credit),
+                         "subtotal": self.edited(line.subtotal)})
+        self.total_debit = self.edited(trial_balance.total_debit)
+        self.total_credit = self.edited(trial_balance.total_credit)
+
+    @staticmethod
+    def edited(amount):
+        """ Return an amount in cents as an edited string """
+
+        return "{0:.2f}".format(amount / 100)
+
+
 class AccountListView(PaginatorMixin, list):
     """ Gathers the information to display a list of accounts.
 
@@ -19,9 +19,13 @@ user readable string. This includes setting up fields like extkey, which is a
 human readable key to a journal, supplied by the source system of the journal.
 """
 
+import csv
+import io
+import json
 import glmodels.glaccount as accounts
 import glmodels.glposting as posts
 from glmodels import PaginatorMixin
+from glmodels.glcache import view_results
 
 class PostingView():
     """ The data from a posting, worked out to be in the format for the user
@@ -38,24 +42,36 @@ class PostingView():
         else:
             self.posting = posts.Postings.get_by_id(posting_id)
 
-    def _accountname_for_posting(self):
-        """ Get the account name this posting should be applied to """
-
-        return accounts.Accounts.get_by_id(self.posting.accounts_id).name
-
     def as_dict(self):
         """ Return a dictionary for the posting in this view.
         """
 
-        posting_dict = {'id' : self.posting.id, 'postmonth' :
-                            accounts.Postmonths.external(self.posting.postmonth),
-                        'amount' : "{0:.2f}".format(self.posting.amount / 100),
-                        'currency' : self.posting.currency,
-                        'debcred' : self.posting.debcred}
-        posting_dict['account'] = self._accountname_for_posting()
-        posting_dict['extkey'] = posts.Journals.get_by_id(self.posting.journals_id).extkey
+        return self.dicts_for_postings([self.posting.id])[0]
 
-        return posting_dict
+    @classmethod
+    def dicts_for_postings(cls, posting_ids=None, journal_id=None):
+        """ Return the dictionaries for many postings at once.
+
+        The postings are given by their ids or by the id of their journal.
+        The account names and journal keys are read with the postings in
+        one query, instead of a few queries per posting.
+        """
+
+        return [cls.dict_for_row(row) for row in
+                posts.Postings.view_rows(posting_ids=posting_ids,
+                                         journal_id=journal_id)]
+
+    @staticmethod
+    def dict_for_row(row):
+        """ Return the dictionary for a row of Postings.view_rows """
+
+        return {'id' : row.id,
+                'postmonth' : accounts.Postmonths.external(int(row.postmonth)),
+                'amount' : "{0:.2f}".format(row.amount / 100),
+                'currency' : row.currency,
+                'debcred' : row.debcred,
+                'account' : row.account,
+                'extkey' : row.extkey}
 
 class JournalView():
     """ A journal is prepared for showing on a page.
@@ -67,7 +83,7 @@ class JournalView():
     def __init__(self, journal_id=None, journal_key=None):
 
         if journal_id is None and journal_key is None:
-            raise NoJournalError('A valid journal is required to create a JournalView')
+            raise posts.NoJournalError('A valid journal is required to create a JournalView')
         if journal_id:
             self.journal = posts.Journals.get_by_id(journal_id)
         else:
@@ -80,14 +96,15 @@ class JournalView():
         in the journal with the id or extkey entered.
         """
 
-        if postings is None:
-            if journal_id:
-                postings = posts.Journals.postings_for_id(journal_id)
-            else:
-                postings = posts.Journals.postings_for_key(extkey)
-        postingviews = []
-        for posting in postings:
-            postingviews.append(PostingView(posting.id).as_dict())
+        if postings is not None:
+            return PostingView.dicts_for_postings(
+                posting_ids=[posting.id for posting in postings])
+        if not journal_id:
+            journal_id = posts.Journals.get_by_key(extkey).id
+        postingviews = PostingView.dicts_for_postings(journal_id=journal_id)
+        if postingviews == []:
+            raise posts.NoJournalError('Journal ' + str(journal_id) +
+                                       ' does not exist')
         return postingviews
 
     def as_dict(self):
@@ -100,26 +117,58 @@ class JournalView():
         journ = self.journal
         journal_dict = {"id":journ.id, "extkey":journ.extkey,
                         "status": journ.journalstat}
-        journal_dict['postings'] =\
-            self.createpostingviews_for_journal(journal_id=self.journal.id)
+        journal_dict['postings'] = self.postingviews
         return journal_dict
 
 
 class PostingByAccountView(PaginatorMixin):
-    """ The view holds the data of a list of postings by account."""
+    """ The view holds the data of a list of postings by account.
 
-    def __init__(self, account=None, month=None, page=1):
+    The page is found by number or by the cursor of the page before it.
+    A view found by cursor has no total number of pages.
+    """
+
+    def __init__(self, account=None, month=None, page=1, cursor=None):
 
         if account is None:
             raise accounts.NoAccountError('An account is required')
         self.account = account
+        self.month = month
         self.postings = posts.Postings.postings_for_account(account,\
-            month=month, page=page)
+            month=month, page=page, cursor=cursor)
         super().__init__(page=self.postings.page,\
             pagelength=self.postings.pagelength)
         self.num_records = self.postings.num_records
-        self.total_pages = self.num_pages()
+        self.next_cursor = self.postings.next_cursor
+        if self.num_records is None:
+            self.total_pages = None
+        else:
+            self.total_pages = self.num_pages()
         
+    @classmethod
+    def cached_dict(cls, account, month=None, page=1, cursor=None,
+                    version=None):
+        """ Return the view as a dictionary, from the cache if possible.
+
+        The dictionary for a closed month is kept until dropped for space,
+        others expire or are dropped when the ledger changes. The version,
+        if passed, is part of the key of the cached dictionary: it must
+        change when the postings do, like the validator of a page. For a
+        closed month it defaults to the last change to the postings of
+        the account in the month.
+        """
+
+        final = bool(month) and accounts.Postmonths.status_of(
+            accounts.Postmonths.internal(month)) == accounts.Postmonths.CLOSED
+        if final and version is None:
+            version = tuple(posts.Postings.last_change(account.id,
+                                                       month=month))
+        return view_results.get_or_compute(
+            ('postings', account.id, month, page, cursor, version),
+            lambda: cls(account, month=month, page=page,
+                        cursor=cursor).as_dict(),
+            final=final)
+
     def num_recs(self):
 
         return self.num_records
@@ -129,19 +178,81 @@ class PostingByAccountView(PaginatorMixin):
         access for showing field values on the browser.
         """
         acc = self.account
-        posting_dict = {'id' : acc.id, 'name' : acc.name, 'role' : acc.role}
-        posting_list = []
-        for posting in self.postings:
-            posting_list.append(PostingView(posting.id).as_dict())
-        posting_dict['postings'] = posting_list
+        posting_dict = {'id' : acc.id, 'name' : acc.name, 'role' : acc.role,
+                        'month' : self.month}
+        posting_dict['postings'] = PostingView.dicts_for_postings(
+            posting_ids=[posting.id for posting in self.postings])
         if self.page is not None:
             posting_dict['page'] = self.page
         if self.pagelength is not None:
             posting_dict['pagelength'] = self.pagelength
         if self.total_pages is not None:
             posting_dict['total_pages'] = self.total_pages
+        posting_dict['next_cursor'] = self.next_cursor
         return posting_dict
 
+class PostingExport():
+    """ The postings of an account, edited for export.
+
+    The export is in CSV (with a header line) or in newline delimited
+    JSON (ndjson), one line per posting. The lines are generated one by
+    one from the rows streamed from the database, so an export of any
+    size is made in constant memory.
+    """
+
+    MIMETYPES = {'csv': 'text/csv', 'ndjson': 'application/x-ndjson'}
+    FIELDS = ['id', 'extkey', 'account', 'postmonth', 'valuedate',
+              'debcred', 'amount', 'currency']
+
+    def __init__(self, account=None, export_format='csv', subtree=False,
+                 from_month=None, to_month=None):
+
+        if account is None:
+            raise accounts.NoAccountError('An account is required')
+        if export_format not in self.MIMETYPES:
+            raise ValueError('Unknown export format ' + str(export_format))
+        self.account = account
+        self.export_format = export_format
+        self.mimetype = self.MIMETYPES[export_format]
+        self.subtree = subtree
+        self.from_month = from_month
+        self.to_month = to_month
+        # Fail on invalid months now, not halfway the export
+        for month in (from_month, to_month):
+            if month:
+                accounts.Postmonths.internal(month)
+
+    def lines(self):
+        """ Generate the lines of the export """
+
+        rows = posts.Postings.export_rows(self.account, subtree=self.subtree,
+                                          from_month=self.from_month,
+                                          to_month=self.to_month)
+        if self.export_format == 'csv':
+            buffer = io.StringIO()
+            writer = csv.DictWriter(buffer, fieldnames=self.FIELDS)
+            writer.writeheader()
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+            for row in rows:
+                writer.writerow(self.dict_for_row(row))
+                yield buffer.getvalue()
+                buffer.seek(0)
+                buffer.truncate()
+        else:
+            for row in rows:
+                yield json.dumps(self.dict_for_row(row)) + '\n'
+
+    @staticmethod
+    def dict_for_row(row):
+        """ Return the exported fields of a row of Postings.export_rows """
+
+        posting_dict = PostingView.dict_for_row(row)
+        posting_dict['valuedate'] = row.value_date.strftime('%Y-%m-%d')
+        return posting_dict
+
+
 class JournalListView(PaginatorMixin, list):
     """ This class holds the extract for a journallist 
     for showing on a page